@@ -0,0 +1,147 @@
+# ruff: noqa: T201
+"""
+Benchmark of the page group merge on a long statement, the k-way merge used by the
+PageAggregator against a left to right fold of the pairwise merge it replaced, which is
+kept here as the reference implementation:
+
+    OUTPUT_PATH=/tmp/bench python -m benchmarks.merge_benchmark --items 5000 --pages 50
+"""
+
+import argparse
+import random
+import time
+from collections.abc import Callable
+from functools import reduce
+
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice, Item, TaxComponents
+
+
+def statement_pages(item_count: int, page_count: int, seed: int) -> list[Invoice]:
+    """Formatted pages of one statement, header on the first page and totals on the last."""
+    rng = random.Random(seed)  # noqa: S311
+    per_page = -(-item_count // page_count)
+    pages = []
+    for page_index in range(page_count):
+        first = page_index * per_page + 1
+        items = [
+            Item(
+                slno=slno,
+                description=f"Item {slno}",
+                quantity=float(rng.randint(1, 20)),
+                price=round(rng.uniform(1, 500), 2),
+                tax=[TaxComponents(Tax_Type="IGST", Tax_Rate=18.0, Tax_Amount=round(rng.uniform(1, 90), 2))],
+                amount=round(rng.uniform(1, 10000), 2),
+            )
+            for slno in range(first, min(first + per_page, item_count + 1))
+        ]
+        header = page_index == 0
+        footer = page_index == page_count - 1
+        pages.append(
+            Invoice(
+                invoice_number="STM-0001" if header else "NOT_AVAILABLE",
+                invoice_date="2025-01-31" if header else "NOT_AVAILABLE",
+                seller_details=CompanyDetails(
+                    name="Acme Supplies",
+                    BIN_Details=[BusinessIdNumber(BIN_Type="GSTIN", BIN_Number="29ABCDE1234F1Z5")] if header else [],
+                ),
+                items=items,
+                total_tax=[TaxComponents(Tax_Type="IGST", Tax_Rate=18.0, Tax_Amount=1000.0)] if footer else [],
+                total_amount=123456.0 if footer else 0.0,
+                page_no=str(page_index + 1),
+            )
+        )
+    return pages
+
+
+def _choose_best_value(self_val: str, other_val: str) -> str:
+    if self_val.upper() != "NOT_AVAILABLE":
+        return self_val
+    if other_val.upper() != "NOT_AVAILABLE":
+        return other_val
+    return "NOT_AVAILABLE"
+
+
+def _choose_best_amount(self_val: float, other_val: float) -> float:
+    if self_val != 0.0:
+        return self_val
+    if other_val != 0.0:
+        return other_val
+    return 0.0
+
+
+def _merge_page_numbers(page1: str, page2: str) -> str:
+    if not page1 or not page2:
+        return page1 or page2
+    return "-".join(sorted({p.strip() for p in page1.split("-") + page2.split("-")}))
+
+
+def pairwise_merge_companies(company: CompanyDetails, other: CompanyDetails) -> CompanyDetails:
+    """`CompanyDetails.merge_with` as it was before the k-way merge, kept as the reference."""
+    bin_dict = {}
+    for bin_item in list(company.BIN_Details) + list(other.BIN_Details):
+        if not bin_item.is_empty and (bin_item.BIN_Type not in bin_dict or bin_item in company.BIN_Details):
+            bin_dict[bin_item.BIN_Type] = bin_item
+    return CompanyDetails(
+        name=_choose_best_value(company.name, other.name),
+        address=_choose_best_value(company.address, other.address),
+        state=_choose_best_value(company.state, other.state),
+        country=_choose_best_value(company.country, other.country),
+        pin_code=_choose_best_value(company.pin_code, other.pin_code),
+        phone_number=_choose_best_value(company.phone_number, other.phone_number),
+        email=_choose_best_value(company.email, other.email),
+        BIN_Details=list(bin_dict.values()),
+    )
+
+
+def pairwise_merge(invoice: Invoice, other: Invoice) -> Invoice:
+    """`Invoice.merge_with` as it was before the k-way merge, kept as the reference."""
+    return Invoice(
+        invoice_number=_choose_best_value(invoice.invoice_number, other.invoice_number),
+        invoice_date=_choose_best_value(invoice.invoice_date, other.invoice_date),
+        invoice_due_date=_choose_best_value(invoice.invoice_due_date, other.invoice_due_date),
+        seller_details=pairwise_merge_companies(invoice.seller_details, other.seller_details),
+        buyer_details=pairwise_merge_companies(invoice.buyer_details, other.buyer_details),
+        items=list(invoice.items) + list(other.items),
+        total_tax=list(invoice.total_tax) + list(other.total_tax),
+        total_charge=_choose_best_amount(invoice.total_charge, other.total_charge),
+        total_discount=_choose_best_amount(invoice.total_discount, other.total_discount),
+        total_amount=_choose_best_amount(invoice.total_amount, other.total_amount),
+        amount_paid=_choose_best_amount(invoice.amount_paid, other.amount_paid),
+        amount_due=_choose_best_amount(invoice.amount_due, other.amount_due),
+        page_no=_merge_page_numbers(invoice.page_no, other.page_no),
+    )
+
+
+def pairwise_fold(invoices: list[Invoice]) -> Invoice:
+    return reduce(pairwise_merge, invoices)
+
+
+def best_of(merge: Callable[[list[Invoice]], Invoice], invoices: list[Invoice], repeat: int) -> tuple[float, Invoice]:
+    timings, result = [], invoices[0]
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = merge(invoices)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=5000, help="Line items of the statement")
+    parser.add_argument("--pages", type=int, default=50, help="Pages the items are spread across")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per merge, the best one is reported")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    pages = statement_pages(args.items, args.pages, args.seed)
+    fold_seconds, folded = best_of(pairwise_fold, pages, args.repeat)
+    kway_seconds, merged = best_of(Invoice.merge_all, pages, args.repeat)
+    if merged.model_dump() != folded.model_dump():
+        raise SystemExit("k-way merge differs from the pairwise fold")
+    print(f"{args.items} items across {args.pages} pages, {len(merged.items)} merged items")
+    print(f"pairwise fold   {fold_seconds * 1000:9.2f} ms")
+    print(f"k-way merge     {kway_seconds * 1000:9.2f} ms  ({fold_seconds / kway_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# ruff: noqa: T201
+"""
+Offline benchmark of the invoice workflow.
+
+Generates a synthetic invoice corpus, records the responses of a synthetic model into a
+replay store once, then runs the workflow against the replay store with injected
+latencies and reports throughput, document latency percentiles, peak RSS and CPU time
+per stage. No provider is called, so it runs on a CPU only CI box:
+
+    OUTPUT_PATH=/tmp/bench python -m benchmarks.run_benchmark --documents 6
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+from benchmarks.synthetic import SyntheticDocument, generate_corpus, invoice_matches, synthetic_model
+from src.config import app_config
+from src.metrics import metrics
+from src.parties import party_index
+from src.replay import LatencyDistribution, replay_session
+from src.scheduler import Lane
+from src.state import WorkflowState
+from src.templates import vendor_template_store
+from src.workflow import run_workflow
+
+DEFAULT_LATENCIES = [
+    f"{app_config.IMAGE_TO_TEXT_MODEL}=lognormal:2.5,0.35",
+    f"{app_config.PAGE_GROUPPER_MODEL}=lognormal:4.0,0.3",
+    "*=lognormal:1.2,0.3",
+]
+
+
+def peak_rss_mb() -> float | None:
+    try:
+        import resource  # noqa: PLC0415
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 if sys.platform != "darwin" else peak / (1024 * 1024)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def parse_latencies(specs: list[str], seed: int) -> dict[str, LatencyDistribution]:
+    latencies = {}
+    for spec in specs:
+        model_name, _, distribution = spec.rpartition("=")
+        latencies[model_name or "*"] = LatencyDistribution.parse(distribution, seed=seed)
+    return latencies
+
+
+def document_lanes(corpus: list[SyntheticDocument], interactive_every: int) -> list[Lane]:
+    """Every `interactive_every`-th document is interactive and the rest bulk, all interactive when 0."""
+    if interactive_every <= 0:
+        return ["interactive"] * len(corpus)
+    return ["interactive" if index % interactive_every == 0 else "bulk" for index in range(len(corpus))]
+
+
+async def run_corpus(
+    corpus: list[SyntheticDocument], concurrency: int, lanes: list[Lane]
+) -> list[tuple[float, WorkflowState]]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_document(document: SyntheticDocument, lane: Lane) -> tuple[float, WorkflowState]:
+        async with semaphore:
+            start = time.perf_counter()
+            state = await run_workflow(document.pdf_path, lane=lane)
+            return time.perf_counter() - start, state
+
+    return await asyncio.gather(*[run_document(document, lane) for document, lane in zip(corpus, lanes, strict=True)])
+
+
+def latency_percentiles(latencies: list[float]) -> dict[str, float]:
+    return {
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+def stage_times(metric_name: str) -> dict[str, float]:
+    return {
+        dict(labels).get("node", ""): histogram.total
+        for labels, histogram in metrics.histograms.get(metric_name, {}).items()
+    }
+
+
+def build_report(
+    corpus: list[SyntheticDocument], results: list[tuple[float, WorkflowState]], lanes: list[Lane], wall_time: float
+) -> dict[str, Any]:
+    latencies = [latency for latency, _ in results]
+    pages = sum(document.page_count for document in corpus)
+    expected = sum(len(document.invoices) for document in corpus)
+    matched = 0
+    for document, (_, state) in zip(corpus, results, strict=True):
+        outputs = {invoice.invoice_number.lower(): invoice for invoice in state.final_output}
+        matched += sum(
+            1
+            for invoice in document.invoices
+            if invoice.invoice_number.lower() in outputs
+            and invoice_matches(invoice, outputs[invoice.invoice_number.lower()])
+        )
+    return {
+        "documents": len(corpus),
+        "pages": pages,
+        "wall_time_seconds": wall_time,
+        "pages_per_second": pages / wall_time if wall_time else 0.0,
+        "document_latency_seconds": latency_percentiles(latencies),
+        "lane_latency_seconds": {
+            lane: latency_percentiles(
+                [latency for latency, lane_ in zip(latencies, lanes, strict=True) if lane_ == lane]
+            )
+            for lane in sorted(set(lanes))
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "stage_wall_seconds": stage_times("node_duration_seconds"),
+        "stage_cpu_seconds": stage_times("node_cpu_seconds"),
+        "response_tokens": {
+            dict(labels).get("model", ""): total
+            for labels, total in metrics.counters.get("llm_response_tokens_total", {}).items()
+        },
+        "failed_documents": sum(1 for _, state in results if state.error),
+        "invoices_expected": expected,
+        "invoices_matched": matched,
+    }
+
+
+def check_regression(report: dict[str, Any], baseline_path: Path, tolerance: float) -> list[str]:
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    regressions = []
+    if report["pages_per_second"] < baseline["pages_per_second"] * (1 - tolerance):
+        regressions.append(f"pages/sec {report['pages_per_second']:.2f} < baseline {baseline['pages_per_second']:.2f}")
+    for quantile in ["p50", "p95", "p99"]:
+        current, previous = report["document_latency_seconds"][quantile], baseline["document_latency_seconds"][quantile]
+        if current > previous * (1 + tolerance):
+            regressions.append(f"{quantile} latency {current:.2f}s > baseline {previous:.2f}s")
+    if report["invoices_matched"] < baseline["invoices_matched"]:
+        regressions.append(f"invoices matched {report['invoices_matched']} < baseline {baseline['invoices_matched']}")
+    return regressions
+
+
+def print_report(report: dict[str, Any]) -> None:
+    print(f"documents {report['documents']}, pages {report['pages']}, wall time {report['wall_time_seconds']:.2f}s")
+    print(f"pages/sec {report['pages_per_second']:.3f}")
+    latency = report["document_latency_seconds"]
+    print(f"document latency p50 {latency['p50']:.2f}s p95 {latency['p95']:.2f}s p99 {latency['p99']:.2f}s")
+    if len(report["lane_latency_seconds"]) > 1:
+        for lane, lane_latency in report["lane_latency_seconds"].items():
+            print(f"  {lane:<12} p50 {lane_latency['p50']:.2f}s p95 {lane_latency['p95']:.2f}s")
+    print(f"peak RSS {report['peak_rss_mb'] or 0:.0f} MB")
+    for stage, wall in sorted(report["stage_wall_seconds"].items()):
+        print(f"  {stage:<20} wall {wall:8.2f}s  cpu {report['stage_cpu_seconds'].get(stage, 0.0):8.2f}s")
+    for model_name, tokens in sorted(report["response_tokens"].items()):
+        print(f"  {model_name:<44} response tokens {tokens:10,.0f}")
+    print(f"invoices matched {report['invoices_matched']}/{report['invoices_expected']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the invoice workflow")
+    parser.add_argument("--documents", type=int, default=6, help="Synthetic PDFs in the corpus")
+    parser.add_argument("--concurrency", type=int, default=1, help="Documents processed concurrently")
+    parser.add_argument(
+        "--interactive-every", type=int, default=0, help="Every Nth document runs in the interactive lane, others bulk"
+    )
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--work-dir", type=Path, default=Path(app_config.OUTPUT_PATH) / "benchmark")
+    parser.add_argument(
+        "--latency",
+        action="append",
+        help="[model=]recorded|fixed:s|uniform:low,high|lognormal:median,sigma|tokens:s,s_per_token, repeatable",
+    )
+    parser.add_argument("--renderer", choices=["pdfium", "poppler"], default="pdfium")
+    parser.add_argument("--output", type=Path, help="Write the JSON report here")
+    parser.add_argument("--baseline", type=Path, help="Fail when the report regresses against this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+    app_config.PDF_RENDERER = args.renderer
+
+    corpus = generate_corpus(args.work_dir / "corpus", args.documents, seed=args.seed)
+    lanes = document_lanes(corpus, args.interactive_every)
+    store_dir = args.work_dir / f"replay_{args.documents}_{args.seed}"
+    # Both runs learn the vendor templates and the party index from scratch, which repeats at concurrency 1
+    template_store, parties = vendor_template_store(app_config), party_index(app_config)
+    if template_store is not None:
+        template_store.clear()
+    if parties is not None:
+        parties.clear()
+    with replay_session("record", store_dir, record_target=synthetic_model(corpus)):
+        asyncio.run(run_corpus(corpus, args.concurrency, lanes))
+
+    metrics.reset()
+    if template_store is not None:
+        template_store.clear()
+    if parties is not None:
+        parties.clear()
+    latencies = parse_latencies(args.latency or DEFAULT_LATENCIES, args.seed)
+    with replay_session("replay", store_dir, latencies=latencies):
+        start = time.perf_counter()
+        results = asyncio.run(run_corpus(corpus, args.concurrency, lanes))
+        wall_time = time.perf_counter() - start
+
+    report = build_report(corpus, results, lanes, wall_time)
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    if args.baseline:
+        regressions = check_regression(report, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,16 @@
+from .batch import BatchWorkflowRunner, LocalBatchProvider, run_batch_workflow
 from .output_format import InvoiceData
 from .state import PageDetails, WorkflowState
 from .workflow import iter_workflow, run_workflow, workflow
 
-__all__ = ("InvoiceData", "PageDetails", "WorkflowState", "iter_workflow", "run_workflow", "workflow")
+__all__ = (
+    "BatchWorkflowRunner",
+    "InvoiceData",
+    "LocalBatchProvider",
+    "PageDetails",
+    "WorkflowState",
+    "iter_workflow",
+    "run_batch_workflow",
+    "run_workflow",
+    "workflow",
+)
@@ -0,0 +1,637 @@
+import asyncio
+import base64
+import json
+import logging
+import uuid
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from pydantic import BaseModel, ValidationError
+from pydantic_ai.usage import Usage
+
+from src.config import InvoiceParserConfig, app_config
+from src.output_format import Invoice, TokenCount
+from src.parties import party_index
+from src.scheduler import scheduling_lane
+from src.utility import get_aws_keys, image_to_byte_string
+
+from .nodes import ImageToTextConverter, SinglePageFormator, pdf_converter_factory
+from .nodes.image_to_text import known_parties_note
+from .nodes.messages import (
+    IMAGE_TO_TEXT_USER_MESSAGE,
+    SP_FORMATOR_SYSTEM_MESSAGE,
+)
+from .nodes.page_formator import LOCAL_PARSER_NAME, output_invoice
+from .state import PageDetails, WorkflowState
+from .workflow import (
+    TextExtractionNode,
+    check_budget,
+    export_metrics,
+    learn_templates,
+    match_parties,
+    match_templates,
+    record_parties,
+    workflow,
+)
+
+logger = logging.getLogger("asyncio")
+
+BATCH_RUNNING, BATCH_COMPLETED, BATCH_FAILED = "running", "completed", "failed"
+
+
+class BatchRequest(BaseModel):
+    custom_id: str
+    model_name: str
+    system_prompt: str
+    user_prompt: str
+    image_path: Path | None = None
+    image_scale: float = 1.0
+    output_schema: dict[str, Any] | None = None
+
+    def encoded_image(self) -> tuple[str, str] | None:
+        """The base64 encoded page image and its media type, read when the request is written."""
+        if self.image_path is None:
+            return None
+        img_byte, mimetype = image_to_byte_string(self.image_path, self.image_scale)
+        return base64.b64encode(img_byte).decode("ascii"), mimetype
+
+
+class BatchResult(BaseModel):
+    custom_id: str
+    output: str = ""
+    request_tokens: int | None = None
+    response_tokens: int | None = None
+    cached_tokens: int | None = None
+    error: str | None = None
+
+
+class BatchProvider(ABC):
+    """
+    A provider side batch job backend. Requests are written to provider specific JSONL
+    files within the request count and file size limits of a job, each file is submitted
+    as a job, polled until done and read back as `BatchResult`.
+    """
+
+    # Default job limits of the OpenAI Batch API
+    max_requests = 50_000
+    max_file_bytes = 200 * 1024 * 1024
+
+    def __init__(self, work_dir: Path) -> None:
+        self.work_dir = work_dir
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+
+    @abstractmethod
+    def request_record(self, request: BatchRequest) -> dict[str, Any]: ...
+
+    @abstractmethod
+    async def submit(self, input_file: Path, model_name: str) -> str: ...
+
+    @abstractmethod
+    async def status(self, job_id: str) -> str: ...
+
+    @abstractmethod
+    async def results(self, job_id: str) -> list[BatchResult]: ...
+
+    def write_requests(self, requests: list[BatchRequest], prefix: str) -> list[Path]:
+        """
+        Write the requests into as many JSONL files as the job limits require. Page images
+        are encoded as their record is written, only one record is held in memory at a time.
+        """
+        paths: list[Path] = []
+        count = size = 0
+        file = None
+        try:
+            for request in requests:
+                line = (json.dumps(self.request_record(request)) + "\n").encode("utf-8")
+                if file is None or count == self.max_requests or size + len(line) > self.max_file_bytes:
+                    if file is not None:
+                        file.close()
+                    paths.append(self.work_dir / f"{prefix}_{len(paths)}.jsonl")
+                    file = paths[-1].open("wb")
+                    count = size = 0
+                file.write(line)
+                count += 1
+                size += len(line)
+        finally:
+            if file is not None:
+                file.close()
+        return paths
+
+    async def run_job(self, input_file: Path, model_name: str, poll_interval: float) -> list[BatchResult]:
+        """Submit one JSONL file as a job and wait for its results."""
+        job_id = await self.submit(input_file, model_name)
+        logger.info(f"Submitted batch job {job_id} for {input_file.name}")
+        status = await self.status(job_id)
+        while status == BATCH_RUNNING:
+            await asyncio.sleep(poll_interval)
+            status = await self.status(job_id)
+        if status == BATCH_FAILED:
+            # The pages of a failed job are served by the live agents like any other missing result
+            logger.error(f"Batch job {job_id} failed, its requests will run live")
+            return []
+        results = await self.results(job_id)
+        logger.info(f"Batch job {job_id} returned {len(results)} results")
+        return results
+
+    async def run(self, requests: list[BatchRequest], poll_interval: float) -> dict[str, BatchResult]:
+        """Submit the requests as one or more jobs and wait for the results, keyed by `custom_id`."""
+        if not requests:
+            return {}
+        input_files = await asyncio.to_thread(self.write_requests, requests, f"batch_{uuid.uuid4().hex[:12]}")
+        logger.info(f"Submitting {len(requests)} batch requests as {len(input_files)} jobs")
+        jobs = await asyncio.gather(
+            *(self.run_job(input_file, requests[0].model_name, poll_interval) for input_file in input_files)
+        )
+        return {result.custom_id: result for results in jobs for result in results}
+
+
+class OpenAIBatchProvider(BatchProvider):
+    """OpenAI Batch API over `/v1/chat/completions`."""
+
+    endpoint = "/v1/chat/completions"
+
+    def __init__(self, work_dir: Path) -> None:
+        super().__init__(work_dir)
+        self._client = None
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            from openai import AsyncOpenAI  # noqa: PLC0415
+
+            self._client = AsyncOpenAI()
+        return self._client
+
+    @staticmethod
+    def request_body(request: BatchRequest) -> dict[str, Any]:
+        user_content: list[dict[str, Any]] = [{"type": "text", "text": request.user_prompt}]
+        image = request.encoded_image()
+        if image is not None:
+            image_base64, media_type = image
+            user_content.append(
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{media_type};base64,{image_base64}"},
+                }
+            )
+        body: dict[str, Any] = {
+            "model": request.model_name,
+            "temperature": 0,
+            "messages": [
+                {"role": "system", "content": request.system_prompt},
+                {"role": "user", "content": user_content},
+            ],
+        }
+        if request.output_schema is not None:
+            body["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "Invoice", "schema": request.output_schema, "strict": False},
+            }
+        return body
+
+    def request_record(self, request: BatchRequest) -> dict[str, Any]:
+        return {
+            "custom_id": request.custom_id,
+            "method": "POST",
+            "url": self.endpoint,
+            "body": self.request_body(request),
+        }
+
+    async def submit(self, input_file: Path, model_name: str) -> str:
+        with input_file.open("rb") as file:
+            uploaded = await self.client.files.create(file=file, purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=self.endpoint,
+            completion_window="24h",
+            metadata={"model": model_name},
+        )
+        return batch.id
+
+    async def status(self, job_id: str) -> str:
+        batch = await self.client.batches.retrieve(job_id)
+        if batch.status == "completed":
+            return BATCH_COMPLETED
+        if batch.status in ["failed", "expired", "cancelled"]:
+            return BATCH_FAILED
+        return BATCH_RUNNING
+
+    async def results(self, job_id: str) -> list[BatchResult]:
+        batch = await self.client.batches.retrieve(job_id)
+        if batch.output_file_id is None:
+            return []
+        content = await self.client.files.content(batch.output_file_id)
+        return self.parse_output_lines(content.text.splitlines())
+
+    @staticmethod
+    def parse_output_lines(lines: list[str]) -> list[BatchResult]:
+        results = []
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            if record.get("error") or response.get("status_code") != 200:  # noqa: PLR2004
+                results.append(BatchResult(custom_id=record["custom_id"], error=str(record.get("error") or body)))
+                continue
+            usage = body.get("usage") or {}
+            results.append(
+                BatchResult(
+                    custom_id=record["custom_id"],
+                    output=body["choices"][0]["message"]["content"] or "",
+                    request_tokens=usage.get("prompt_tokens") or None,
+                    response_tokens=usage.get("completion_tokens") or None,
+                    cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens") or None,
+                )
+            )
+        return results
+
+
+class BedrockBatchProvider(BatchProvider):
+    """
+    Bedrock batch inference (`CreateModelInvocationJob`). The JSONL file is staged on S3,
+    each record carries the native InvokeModel body of the model. Bedrock enforces a
+    minimum number of records per job, small backlogs are better served by the live graph.
+    """
+
+    max_file_bytes = 1024 * 1024 * 1024
+
+    def __init__(self, work_dir: Path, s3_uri: str | None, role_arn: str | None) -> None:
+        if not s3_uri or not role_arn:
+            raise ValueError("BATCH_BEDROCK_S3_URI and BATCH_BEDROCK_ROLE_ARN are required for Bedrock batch jobs")
+        super().__init__(work_dir)
+        self.bucket, _, prefix = s3_uri.removeprefix("s3://").partition("/")
+        self.prefix = prefix.strip("/")
+        self.role_arn = role_arn
+        import boto3  # noqa: PLC0415
+
+        self.bedrock = boto3.client("bedrock", **get_aws_keys())
+        self.s3 = boto3.client("s3", **get_aws_keys())
+        self._input_names: dict[str, str] = {}
+
+    @staticmethod
+    def model_input(request: BatchRequest) -> dict[str, Any]:
+        image = request.encoded_image()
+        if "anthropic" in request.model_name:
+            content: list[dict[str, Any]] = [{"type": "text", "text": request.user_prompt}]
+            if image is not None:
+                image_base64, media_type = image
+                content.insert(
+                    0,
+                    {
+                        "type": "image",
+                        "source": {"type": "base64", "media_type": media_type, "data": image_base64},
+                    },
+                )
+            return {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": 8192,
+                "temperature": 0,
+                "system": request.system_prompt,
+                "messages": [{"role": "user", "content": content}],
+            }
+        image_tag = "<|image|>" if image is not None else ""
+        prompt = (
+            "<|begin_of_text|><|header_start|>system<|header_end|>\n\n"
+            f"{request.system_prompt}<|eot|><|header_start|>user<|header_end|>\n\n"
+            f"{image_tag}{request.user_prompt}<|eot|><|header_start|>assistant<|header_end|>\n\n"
+        )
+        body: dict[str, Any] = {"prompt": prompt, "temperature": 0, "max_gen_len": 8192}
+        if image is not None:
+            body["images"] = [image[0]]
+        return body
+
+    def request_record(self, request: BatchRequest) -> dict[str, Any]:
+        return {"recordId": request.custom_id, "modelInput": self.model_input(request)}
+
+    async def submit(self, input_file: Path, model_name: str) -> str:
+        input_key = f"{self.prefix}/input/{input_file.name}".lstrip("/")
+        await asyncio.to_thread(self.s3.upload_file, str(input_file), self.bucket, input_key)
+        response = await asyncio.to_thread(
+            self.bedrock.create_model_invocation_job,
+            jobName=f"invoice-parser-{input_file.stem.replace('_', '-')}",
+            roleArn=self.role_arn,
+            modelId=model_name,
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{self.bucket}/{input_key}"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{self.bucket}/{self.prefix}/output/"}},
+        )
+        job_arn = response["jobArn"]
+        self._input_names[job_arn] = input_file.name
+        return job_arn
+
+    async def status(self, job_id: str) -> str:
+        job = await asyncio.to_thread(self.bedrock.get_model_invocation_job, jobIdentifier=job_id)
+        if job["status"] in ["Completed", "PartiallyCompleted"]:
+            return BATCH_COMPLETED
+        if job["status"] in ["Failed", "Stopped", "Expired"]:
+            return BATCH_FAILED
+        return BATCH_RUNNING
+
+    async def results(self, job_id: str) -> list[BatchResult]:
+        output_key = f"{self.prefix}/output/{job_id.rsplit('/', 1)[-1]}/{self._input_names[job_id]}.out".lstrip("/")
+        response = await asyncio.to_thread(self.s3.get_object, Bucket=self.bucket, Key=output_key)
+        lines = response["Body"].read().decode("utf-8").splitlines()
+        results = []
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            output = record.get("modelOutput")
+            if record.get("error") or output is None:
+                results.append(BatchResult(custom_id=record["recordId"], error=str(record.get("error"))))
+                continue
+            if "generation" in output:
+                text = output["generation"]
+                request_tokens, response_tokens = output.get("prompt_token_count"), output.get("generation_token_count")
+            else:
+                text = "".join(part.get("text", "") for part in output.get("content", []))
+                usage = output.get("usage", {})
+                request_tokens, response_tokens = usage.get("input_tokens"), usage.get("output_tokens")
+            results.append(
+                BatchResult(
+                    custom_id=record["recordId"],
+                    output=text,
+                    request_tokens=request_tokens or None,
+                    response_tokens=response_tokens or None,
+                )
+            )
+        return results
+
+
+def _default_local_responder(_: str, body: dict[str, Any]) -> str:
+    if "response_format" in body:
+        return Invoice().model_dump_json()
+    return "NO_INVOICE_FOUND"
+
+
+class LocalBatchProvider(OpenAIBatchProvider):
+    """
+    Offline stand-in for a batch provider. Jobs are answered by `responder` from the
+    OpenAI formatted JSONL file and the output file is written in the OpenAI output format,
+    so the full file round trip is exercised without network access.
+    """
+
+    def __init__(
+        self,
+        work_dir: Path,
+        responder: Callable[[str, dict[str, Any]], str] | None = None,
+        pending_polls: int = 0,
+    ) -> None:
+        super().__init__(work_dir)
+        self.responder = responder or _default_local_responder
+        self.pending_polls = pending_polls
+        self._polls: dict[str, int] = {}
+
+    async def submit(self, input_file: Path, model_name: str) -> str:
+        job_id = f"local_{input_file.stem}"
+        output_file = self.work_dir / f"{job_id}_output.jsonl"
+        with input_file.open(encoding="utf-8") as src, output_file.open("w", encoding="utf-8") as dst:
+            for line in src:
+                record = json.loads(line)
+                try:
+                    content = self.responder(record["custom_id"], record["body"])
+                    response = {
+                        "status_code": 200,
+                        "body": {
+                            "model": model_name,
+                            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+                            "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+                        },
+                    }
+                    error = None
+                except Exception as err:
+                    response, error = None, {"message": str(err)}
+                dst.write(json.dumps({"custom_id": record["custom_id"], "response": response, "error": error}) + "\n")
+        self._polls[job_id] = 0
+        return job_id
+
+    async def status(self, job_id: str) -> str:
+        self._polls[job_id] += 1
+        return BATCH_COMPLETED if self._polls[job_id] > self.pending_polls else BATCH_RUNNING
+
+    async def results(self, job_id: str) -> list[BatchResult]:
+        output_file = self.work_dir / f"{job_id}_output.jsonl"
+        return self.parse_output_lines(output_file.read_text(encoding="utf-8").splitlines())
+
+
+def batch_provider_factory(provider: str, config: InvoiceParserConfig, work_dir: Path) -> BatchProvider:
+    """
+    Factory function to create a batch provider instance.
+
+    Args:
+        provider: The provider name, one of "openai", "aws_bedrock" or "local".
+        config: The application config.
+        work_dir: Directory where the batch JSONL files are written.
+
+    Returns:
+        An instance of the specified batch provider.
+    """
+    if provider == "openai":
+        return OpenAIBatchProvider(work_dir)
+    if provider == "aws_bedrock":
+        return BedrockBatchProvider(work_dir, config.BATCH_BEDROCK_S3_URI, config.BATCH_BEDROCK_ROLE_ARN)
+    if provider == "local":
+        return LocalBatchProvider(work_dir)
+    raise ValueError(f"Unsupported batch provider: {provider}")
+
+
+class BatchWorkflowRunner:
+    """
+    Runs the workflow for a set of PDFs with the vision and formatting stages collected
+    into provider batch jobs. The batch results are written into each `WorkflowState`
+    and the normal graph is resumed from `TextExtractionNode`, which only calls the
+    live agents for the pages the batch jobs could not serve.
+    """
+
+    def __init__(self, config: InvoiceParserConfig, provider: BatchProvider | None = None) -> None:
+        self.config = config
+        self.work_dir = Path(config.OUTPUT_PATH) / "batch"
+        self.provider = provider
+
+    def _provider_for(self, stage_provider: str) -> BatchProvider:
+        if self.provider is not None:
+            return self.provider
+        return batch_provider_factory(self.config.BATCH_PROVIDER or stage_provider, self.config, self.work_dir)
+
+    async def _render(self, pdf_path: Path, tenant: str) -> WorkflowState:
+        state = WorkflowState(pdf_name=pdf_path.name, pdf_path=str(pdf_path), tenant=tenant)
+        try:
+            image_directory, page_details = await pdf_converter_factory(self.config).run(pdf_path)
+        except Exception as err:
+            logger.error(f"Batch rendering failed for {pdf_path.name} - {err!s}")
+            state.error = str(err)
+            return state
+        state.add_rendered_pages(image_directory, page_details)
+        error = check_budget(state)
+        if error:
+            state.error = error
+        return state
+
+    async def _extract_text(self, states: list[WorkflowState]) -> None:
+        converter = ImageToTextConverter(self.config)
+        requests, targets = [], {}
+        for doc_index, state in enumerate(states):
+            if state.error:
+                continue
+            # Vendor template pages are left to the live graph, which only reads their line items
+            templates = await match_templates(state, state.pages_pending_extraction())
+            pages = [page for page in state.pages_pending_extraction() if page not in templates]
+            known_parties = await match_parties(state, pages)
+            for p_data in state.page_details:
+                if p_data.page_index not in pages:
+                    continue
+                custom_id = f"D{doc_index}-P{p_data.page_index}"
+                requests.append(
+                    BatchRequest(
+                        custom_id=custom_id,
+                        model_name=converter.model_name,
+                        system_prompt=converter.system_prompt,
+                        user_prompt="\n".join(
+                            [IMAGE_TO_TEXT_USER_MESSAGE, *known_parties_note(known_parties, p_data.page_index)]
+                        ),
+                        image_path=Path(state.image_dir) / p_data.image_path,
+                        image_scale=state.budget.image_scale if state.budget else 1.0,
+                    )
+                )
+                targets[custom_id] = (state, p_data)
+        results = await self._provider_for("aws_bedrock").run(requests, self.config.BATCH_POLL_INTERVAL)
+        for custom_id, (state, p_data) in targets.items():
+            result = results.get(custom_id)
+            if result is None or result.error:
+                logger.warning(f"No batch text extraction for {state.pdf_name} {custom_id}, will run live")
+                continue
+            usage = Usage(
+                request_tokens=result.request_tokens,
+                response_tokens=result.response_tokens,
+                details={"cached_tokens": result.cached_tokens or 0},
+            )
+            _, text_content, metadata, t_count = converter.parse_output(p_data.page_index, result.output, usage)
+            p_data.text_content = text_content
+            p_data.metadata = metadata
+            state.add_token_counts([t_count])
+
+    async def _format_requests(
+        self, states: list[WorkflowState], formatter: SinglePageFormator
+    ) -> tuple[list[BatchRequest], dict[str, tuple[int, WorkflowState, PageDetails, bool]], dict[int, list[int]]]:
+        """
+        The formatting requests of the invoice pages, the pages the structured text parser
+        formats reliably are formatted locally as in the live cascade and need no request.
+        """
+        output_schema = formatter.output_type.model_json_schema()
+        requests, targets, formatted = [], {}, {}
+        for doc_index, state in enumerate(states):
+            if state.error:
+                continue
+            # Totals only reconcile when every page holds an invoice of its own, as in the live graph
+            reconcile_totals = state.valid_invoice_count() == state.unique_invoice_count()
+            for p_data in state.page_details:
+                if not p_data.is_invoice_page or p_data.invoice is not None:
+                    continue
+                text_content = p_data.append_page_no()
+                invoice = formatter.local_format(text_content, p_data.page_index, p_data.metadata, reconcile_totals)
+                if invoice is not None:
+                    p_data.invoice = invoice
+                    state.add_token_counts([TokenCount(model_name=LOCAL_PARSER_NAME, page_no=f"P{p_data.page_index}")])
+                    formatted.setdefault(doc_index, []).append(p_data.page_index)
+                    continue
+                custom_id = f"D{doc_index}-P{p_data.page_index}"
+                requests.append(
+                    BatchRequest(
+                        custom_id=custom_id,
+                        model_name=formatter.model_name,
+                        system_prompt=SP_FORMATOR_SYSTEM_MESSAGE,
+                        user_prompt=await formatter.user_prompt(text_content),
+                        output_schema=output_schema,
+                    )
+                )
+                targets[custom_id] = (doc_index, state, p_data, reconcile_totals)
+        return requests, targets, formatted
+
+    async def _format_pages(self, states: list[WorkflowState]) -> dict[int, list[int]]:
+        """
+        Format the invoice pages in a batch job, returning the pages formatted of each document.
+        Batch invoices failing the checks a live run would correct or escalate are left to the
+        live formatter, which formats those pages again with its correction and escalation calls.
+        """
+        formatter = SinglePageFormator(self.config)
+        requests, targets, formatted = await self._format_requests(states, formatter)
+        results = await self._provider_for("openai").run(requests, self.config.BATCH_POLL_INTERVAL)
+        index = party_index(self.config)
+        for custom_id, (doc_index, state, p_data, reconcile_totals) in targets.items():
+            result = results.get(custom_id)
+            if result is None or result.error:
+                logger.warning(f"No batch formatting for {state.pdf_name} {custom_id}, will run live")
+                continue
+            state.add_token_counts(
+                [
+                    TokenCount(
+                        model_name=formatter.model_name,
+                        page_no=f"P{p_data.page_index}",
+                        request_tokens=result.request_tokens,
+                        response_tokens=result.response_tokens,
+                        cached_tokens=result.cached_tokens,
+                    )
+                ]
+            )
+            try:
+                output = formatter.output_type.model_validate_json(result.output)
+            except ValidationError as err:
+                logger.warning(f"Invalid batch Invoice for {state.pdf_name} {custom_id}, will run live - {err!s}")
+                continue
+            invoice = output_invoice(output, str(p_data.page_index))
+            if not formatter.accepts(invoice, reconcile_totals):
+                logger.info(f"Batch Invoice for {state.pdf_name} {custom_id} fails the checks, will run live")
+                continue
+            p_data.invoice = await asyncio.to_thread(index.fill_invoice, invoice) if index is not None else invoice
+            formatted.setdefault(doc_index, []).append(p_data.page_index)
+        return formatted
+
+    async def _resume(self, state: WorkflowState, batch_pages: list[int]) -> None:
+        """Finish a document in the live graph, followed by the post-run hooks of `run_workflow`."""
+        if not state.error:
+            try:
+                _ = await workflow.run(TextExtractionNode(), state=state)
+            except Exception as err:
+                logger.error(f"Workflow failed for {state.pdf_name} with error: {err!s}")
+                state.error = str(err)
+        if not state.error and batch_pages:
+            # The live formatter learns from the pages holding a whole invoice, the batch pages are never seen by it
+            single_pages = (
+                {group.pages[0] for group in state.page_group_info if group.is_single_page and group.pages}
+                if state.page_group_info
+                else set(batch_pages)
+            )
+            await learn_templates(
+                state,
+                [
+                    (p_data.page_index, p_data.invoice, [])
+                    for p_data in state.page_details
+                    if p_data.page_index in batch_pages and p_data.page_index in single_pages and p_data.invoice
+                ],
+            )
+        await record_parties(state)
+        export_metrics(state)
+
+    async def run(self, pdf_paths: list[Path], tenant: str = "default") -> list[WorkflowState]:
+        states = await asyncio.gather(*[self._render(pdf_path, tenant) for pdf_path in pdf_paths])
+        await self._extract_text(states)
+        batch_pages = await self._format_pages(states)
+        # Live calls for the pages the batch jobs missed must not hold up interactive uploads
+        with scheduling_lane("bulk"):
+            await asyncio.gather(
+                *(self._resume(state, batch_pages.get(doc_index, [])) for doc_index, state in enumerate(states))
+            )
+        return states
+
+
+async def run_batch_workflow(
+    pdf_paths: list[Path], provider: BatchProvider | None = None, tenant: str = "default"
+) -> list[WorkflowState]:
+    """
+    Run the workflow for a backlog of PDFs using provider side batch inference.
+    """
+    logger.info(f"Starting batch workflow for {len(pdf_paths)} PDFs")
+    return await BatchWorkflowRunner(app_config, provider=provider).run(pdf_paths, tenant=tenant)
@@ -0,0 +1,243 @@
+import json
+import threading
+from collections.abc import Iterable
+from datetime import UTC, date, datetime
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+from src.compact_format import CompactInvoice
+from src.config import InvoiceParserConfig
+from src.nodes.messages import (
+    IMAGE_TO_TEXT_JSON_SYSTEM_MESSAGE,
+    IMAGE_TO_TEXT_SYSTEM_MESSAGE,
+    IMAGE_TO_TEXT_USER_MESSAGE,
+    PAGE_GROUPPER_SYSTEM_MESSAGE,
+    SP_FORMATOR_SYSTEM_MESSAGE,
+)
+from src.output_format import Invoice, TokenCount
+from src.utility import estimate_image_tokens
+
+CHARS_PER_TOKEN = 4
+# Expected completion sizes per page, the structured text of a page is also the formatter input
+VISION_OUTPUT_TOKENS_PER_PAGE = 1500
+GROUPER_INPUT_TOKENS_PER_PAGE = 120
+GROUPER_OUTPUT_TOKENS_PER_PAGE = 150
+FORMATTER_OUTPUT_TOKENS_PER_PAGE = 1800
+# Linear downscale factors of the page images tried before a document is rejected
+REDUCED_IMAGE_SCALES = [0.75, 0.5, 0.35, 0.25]
+
+BudgetMode = Literal["full", "reduced_resolution", "rejected"]
+
+
+def text_tokens(text: str) -> int:
+    """Rough token count of a prompt text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def token_cost(t_count: TokenCount, prices: dict[str, tuple[float, float, float]]) -> float:
+    """Cost in USD of a recorded model call, zero for models without a price."""
+    if t_count.model_name not in prices:
+        return 0.0
+    input_price, output_price, cached_price = prices[t_count.model_name]
+    cached = t_count.cached_tokens or 0
+    uncached = max((t_count.request_tokens or 0) - cached, 0)
+    return (uncached * input_price + cached * cached_price + (t_count.response_tokens or 0) * output_price) / 1e6
+
+
+class UsageTotals(BaseModel):
+    request_tokens: int = 0
+    response_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.request_tokens + self.response_tokens
+
+    def add(self, t_count: TokenCount, prices: dict[str, tuple[float, float, float]]) -> None:
+        self.request_tokens += t_count.request_tokens or 0
+        self.response_tokens += t_count.response_tokens or 0
+        self.cached_tokens += t_count.cached_tokens or 0
+        self.cost += token_cost(t_count, prices)
+
+
+class StageEstimate(BaseModel):
+    stage: str
+    model_name: str
+    request_tokens: int
+    response_tokens: int
+    cost: float
+
+
+class BudgetEstimate(BaseModel):
+    stages: list[StageEstimate] = Field(default_factory=list)
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(stage.request_tokens + stage.response_tokens for stage in self.stages)
+
+    @property
+    def cost(self) -> float:
+        return sum(stage.cost for stage in self.stages)
+
+
+class BudgetDecision(BaseModel):
+    mode: BudgetMode
+    image_scale: float = 1.0
+    estimate: BudgetEstimate
+    reason: str | None = None
+
+
+def estimate_document(
+    image_sizes: list[tuple[int, int]], config: InvoiceParserConfig, image_scale: float = 1.0
+) -> BudgetEstimate:
+    """
+    Upper bound of the tokens and cost of a document from its page images and the stage
+    prompts, assuming every page reaches the formatter model and pages are grouped.
+    """
+    page_count = len(image_sizes)
+    vision_prompt = (
+        IMAGE_TO_TEXT_JSON_SYSTEM_MESSAGE
+        if config.IMAGE_TO_TEXT_OUTPUT_FORMAT == "json"
+        else IMAGE_TO_TEXT_SYSTEM_MESSAGE
+    )
+    vision_input = sum(
+        text_tokens(vision_prompt + IMAGE_TO_TEXT_USER_MESSAGE)
+        + estimate_image_tokens((int(width * image_scale), int(height * image_scale)))
+        for width, height in image_sizes
+    )
+    formatter_schema = CompactInvoice if config.OUTPUT_FORMATOR_SCHEMA == "compact" else Invoice
+    formatter_prompt = text_tokens(SP_FORMATOR_SYSTEM_MESSAGE + json.dumps(formatter_schema.model_json_schema()))
+    stages = [
+        ("image_to_text", config.IMAGE_TO_TEXT_MODEL, vision_input, VISION_OUTPUT_TOKENS_PER_PAGE * page_count),
+        (
+            "page_groupper",
+            config.PAGE_GROUPPER_MODEL,
+            text_tokens(PAGE_GROUPPER_SYSTEM_MESSAGE) + GROUPER_INPUT_TOKENS_PER_PAGE * page_count,
+            GROUPER_OUTPUT_TOKENS_PER_PAGE * page_count,
+        ),
+        (
+            "page_formator",
+            config.OUTPUT_FORMATOR_MODEL,
+            (formatter_prompt + VISION_OUTPUT_TOKENS_PER_PAGE) * page_count,
+            FORMATTER_OUTPUT_TOKENS_PER_PAGE * page_count,
+        ),
+    ]
+    return BudgetEstimate(
+        stages=[
+            StageEstimate(
+                stage=stage,
+                model_name=model_name,
+                request_tokens=request_tokens,
+                response_tokens=response_tokens,
+                cost=token_cost(
+                    TokenCount(
+                        model_name=model_name,
+                        page_no="",
+                        request_tokens=request_tokens,
+                        response_tokens=response_tokens,
+                    ),
+                    config.MODEL_PRICES,
+                ),
+            )
+            for stage, model_name, request_tokens, response_tokens in stages
+        ]
+    )
+
+
+class TenantBudgetLedger:
+    """
+    Spend of each tenant for the current UTC day. The estimate of a document is reserved
+    when it starts and replaced by its actual spend when it finishes, so concurrent
+    uploads of a tenant cannot overshoot the budget together.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._day: date | None = None
+        self.spent: dict[str, UsageTotals] = {}
+        self.reserved: dict[str, tuple[int, float]] = {}
+
+    def _roll_over(self) -> None:
+        today = datetime.now(tz=UTC).date()
+        if self._day != today:
+            self._day = today
+            self.spent.clear()
+            self.reserved.clear()
+
+    def remaining(self, tenant: str, config: InvoiceParserConfig) -> tuple[float | None, float | None]:
+        """Tokens and cost the tenant may still spend today, None when unlimited."""
+        with self._lock:
+            self._roll_over()
+            spent = self.spent.get(tenant, UsageTotals())
+            reserved_tokens, reserved_cost = self.reserved.get(tenant, (0, 0.0))
+        tokens = (
+            config.TENANT_DAILY_TOKEN_BUDGET - spent.total_tokens - reserved_tokens
+            if config.TENANT_DAILY_TOKEN_BUDGET
+            else None
+        )
+        cost = config.TENANT_DAILY_COST_BUDGET - spent.cost - reserved_cost if config.TENANT_DAILY_COST_BUDGET else None
+        return tokens, cost
+
+    def reserve(self, tenant: str, estimate: BudgetEstimate) -> None:
+        with self._lock:
+            self._roll_over()
+            tokens, cost = self.reserved.get(tenant, (0, 0.0))
+            self.reserved[tenant] = (tokens + estimate.total_tokens, cost + estimate.cost)
+
+    def settle(self, tenant: str, estimate: BudgetEstimate | None, usage: UsageTotals) -> None:
+        with self._lock:
+            self._roll_over()
+            if estimate is not None and tenant in self.reserved:
+                tokens, cost = self.reserved[tenant]
+                self.reserved[tenant] = (max(tokens - estimate.total_tokens, 0), max(cost - estimate.cost, 0.0))
+            spent = self.spent.setdefault(tenant, UsageTotals())
+            spent.request_tokens += usage.request_tokens
+            spent.response_tokens += usage.response_tokens
+            spent.cached_tokens += usage.cached_tokens
+            spent.cost += usage.cost
+
+
+tenant_ledger = TenantBudgetLedger()
+
+
+def _over_budget(limits: Iterable[tuple[str, float | None, float]]) -> str | None:
+    for name, limit, value in limits:
+        if limit is not None and value > limit:
+            if isinstance(value, int):
+                return f"estimate of {value:,} tokens exceeds the {name} of {max(int(limit), 0):,} tokens"
+            return f"estimate of {value:.4f} USD exceeds the {name} of {max(limit, 0.0):.4f} USD"
+    return None
+
+
+def plan_budget(
+    tenant: str,
+    image_sizes: list[tuple[int, int]],
+    config: InvoiceParserConfig,
+    ledger: TenantBudgetLedger = tenant_ledger,
+) -> BudgetDecision:
+    """
+    Check the estimate of a document against the document and tenant budgets before any
+    model is called. Page images are downscaled for the vision stage until the estimate
+    fits, down to `BUDGET_MIN_IMAGE_SIDE`, otherwise the document is rejected.
+    """
+    tenant_tokens, tenant_cost = ledger.remaining(tenant, config)
+    longest_side = max((max(size) for size in image_sizes), default=0)
+    scales = [1.0] + [scale for scale in REDUCED_IMAGE_SCALES if longest_side * scale >= config.BUDGET_MIN_IMAGE_SIDE]
+    reason = None
+    for image_scale in scales:
+        estimate = estimate_document(image_sizes, config, image_scale)
+        reason = _over_budget(
+            [
+                ("document budget", config.DOCUMENT_TOKEN_BUDGET, estimate.total_tokens),
+                ("document budget", config.DOCUMENT_COST_BUDGET, estimate.cost),
+                (f"remaining daily budget of tenant {tenant}", tenant_tokens, estimate.total_tokens),
+                (f"remaining daily budget of tenant {tenant}", tenant_cost, estimate.cost),
+            ],
+        )
+        if reason is None:
+            ledger.reserve(tenant, estimate)
+            mode: BudgetMode = "full" if image_scale == 1.0 else "reduced_resolution"
+            return BudgetDecision(mode=mode, image_scale=image_scale, estimate=estimate)
+    return BudgetDecision(mode="rejected", estimate=estimate_document(image_sizes, config), reason=reason)
@@ -0,0 +1,166 @@
+from pydantic import BaseModel, Field
+
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice, Item, TaxComponents
+
+NOT_AVAILABLE = "NOT_AVAILABLE"
+
+# Positional rows of the compact schema, the column order is part of the wire format
+CompactTax = tuple[str, float, float]
+CompactItem = tuple[int, str, str, float, str, float, float, float, list[CompactTax]]
+
+
+def _text(value: str) -> str:
+    value = value.strip()
+    return value or NOT_AVAILABLE
+
+
+def _wire_text(value: str) -> str:
+    return "" if value.upper() == NOT_AVAILABLE else value
+
+
+def _taxes(rows: list[CompactTax]) -> list[TaxComponents]:
+    return [
+        TaxComponents.model_construct(Tax_Type=_text(tax_type), Tax_Rate=rate, Tax_Amount=amount)
+        for tax_type, rate, amount in rows
+    ]
+
+
+def _wire_taxes(taxes: list[TaxComponents]) -> list[CompactTax]:
+    return [(_wire_text(tax.Tax_Type), tax.Tax_Rate, tax.Tax_Amount) for tax in taxes]
+
+
+class CompactParty(BaseModel):
+    """
+    Seller or buyer, "" for an absent value.
+    """
+
+    n: str = Field(default="", description="name")
+    ids: list[tuple[str, str]] = Field(default_factory=list, description="[type, number] of GSTIN/PAN/TAN/IEC/CIN")
+    a: str = Field(default="", description="address")
+    st: str = Field(default="", description="state")
+    co: str = Field(default="", description="country")
+    pin: str = Field(default="", description="6 digit pin code")
+    ph: str = Field(default="", description="phone")
+    em: str = Field(default="", description="email")
+
+    def to_company(self) -> CompanyDetails:
+        return CompanyDetails.model_construct(
+            name=_text(self.n),
+            BIN_Details=[
+                BusinessIdNumber.model_construct(BIN_Type=_text(bin_type), BIN_Number=_text(number))
+                for bin_type, number in self.ids
+            ],
+            address=_text(self.a),
+            state=_text(self.st),
+            country=_text(self.co),
+            pin_code=_text(self.pin),
+            phone_number=_text(self.ph),
+            email=_text(self.em),
+        )
+
+    @classmethod
+    def from_company(cls, company: CompanyDetails) -> "CompactParty":
+        return cls(
+            n=_wire_text(company.name),
+            ids=[(_wire_text(bin_.BIN_Type), _wire_text(bin_.BIN_Number)) for bin_ in company.BIN_Details],
+            a=_wire_text(company.address),
+            st=_wire_text(company.state),
+            co=_wire_text(company.country),
+            pin=_wire_text(company.pin_code),
+            ph=_wire_text(company.phone_number),
+            em=_wire_text(company.email),
+        )
+
+
+class CompactInvoice(BaseModel):
+    """
+    Invoice in short keys, line items as rows of
+    [slno, description, hsn, quantity, uom, price, discount, amount, [[tax type, rate, amount]]].
+    Use "" for absent text and 0 for absent amounts.
+    """
+
+    no: str = Field(default="", description="invoice number")
+    dt: str = Field(default="", description="invoice date")
+    dd: str = Field(default="", description="due date")
+    s: CompactParty = Field(default_factory=CompactParty, description="seller")
+    b: CompactParty = Field(default_factory=CompactParty, description="buyer")
+    cur: str = Field(default="INR", description="currency of the amounts")
+    it: list[CompactItem] = Field(default_factory=list, description="line item rows")
+    inv: list[int] = Field(default_factory=list, description="slno of inventory items whose stock must be updated")
+    tx: list[CompactTax] = Field(default_factory=list, description="total tax [type, rate, amount]")
+    chg: float = Field(default=0.0, description="total charges")
+    dsc: float = Field(default=0.0, description="total discount")
+    tot: float = Field(default=0.0, description="total invoice amount")
+    pd: float = Field(default=0.0, description="amount paid")
+    bal: float = Field(default=0.0, description="amount due")
+
+    def to_invoice(self, page_no: str = "") -> Invoice:
+        """
+        Map the compact output back to an Invoice. The rows are already validated by
+        their tuple types, so the models are built without validating them again.
+        """
+        inventory = set(self.inv)
+        currency = self.cur.strip() or "INR"
+        items = [
+            Item.model_construct(
+                slno=max(slno, 1),
+                description=_text(description),
+                inventory_flag=slno in inventory,
+                quantity=quantity,
+                UOM=_text(uom),
+                HSN_CODE=_text(hsn_code),
+                price=price,
+                tax=_taxes(taxes),
+                discount=discount,
+                amount=amount,
+                currency=currency,
+            )
+            for slno, description, hsn_code, quantity, uom, price, discount, amount, taxes in self.it
+        ]
+        return Invoice.model_construct(
+            invoice_number=_text(self.no),
+            invoice_date=_text(self.dt),
+            invoice_due_date=_text(self.dd),
+            seller_details=self.s.to_company(),
+            buyer_details=self.b.to_company(),
+            items=items,
+            total_tax=_taxes(self.tx),
+            total_charge=self.chg,
+            total_discount=self.dsc,
+            total_amount=self.tot,
+            amount_paid=self.pd,
+            amount_due=self.bal,
+            page_no=page_no,
+        )
+
+    @classmethod
+    def from_invoice(cls, invoice: Invoice) -> "CompactInvoice":
+        return cls(
+            no=_wire_text(invoice.invoice_number),
+            dt=_wire_text(invoice.invoice_date),
+            dd=_wire_text(invoice.invoice_due_date),
+            s=CompactParty.from_company(invoice.seller_details),
+            b=CompactParty.from_company(invoice.buyer_details),
+            cur=invoice.items[0].currency if invoice.items else "INR",
+            it=[
+                (
+                    item.slno,
+                    _wire_text(item.description),
+                    _wire_text(item.HSN_CODE),
+                    item.quantity,
+                    _wire_text(item.UOM),
+                    item.price,
+                    item.discount,
+                    item.amount,
+                    _wire_taxes(item.tax),
+                )
+                for item in invoice.items
+            ],
+            inv=[item.slno for item in invoice.items if item.inventory_flag],
+            tx=_wire_taxes(invoice.total_tax),
+            chg=invoice.total_charge,
+            dsc=invoice.total_discount,
+            tot=invoice.total_amount,
+            pd=invoice.amount_paid,
+            bal=invoice.amount_due,
+        )
@@ -1,7 +1,8 @@
 from enum import Enum
 from pathlib import Path
+from typing import Literal
 
-from pydantic import DirectoryPath, Field, PositiveInt, field_validator
+from pydantic import DirectoryPath, Field, NonNegativeInt, PositiveFloat, PositiveInt, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -17,15 +18,209 @@ class FeatureConfig(BaseSettings):
         description="Allowed extensions for the uploaded files",
         default_factory=lambda: ["pdf", "PDF"],
     )
+    PDF_RENDERER: Literal["poppler", "pdfium"] = Field(
+        description="Library used to render the PDF pages", default="poppler"
+    )
     IMG_SAVE_FORMAT: str = Field(description="Image save format, default to png", default="png")
     MAX_IMG_WIDTH: PositiveInt = Field(description="Maximum image width", default=2500)
     MAX_IMG_HEIGHT: PositiveInt = Field(description="Maximum image height", default=2500)
+    PREPROCESS_TRIM_MARGINS: bool = Field(
+        description="Trim the white margins of rendered pages before they are resized", default=False
+    )
+    PREPROCESS_DESKEW: bool = Field(
+        description="Straighten skewed scanned pages before they are resized", default=False
+    )
+    PREPROCESS_MAX_SKEW_DEGREES: PositiveFloat = Field(
+        description="Largest page skew looked for when deskewing", default=5.0, le=45
+    )
+    PREPROCESS_COLOR_MODE: Literal["color", "grayscale", "binary"] = Field(
+        description="Colour of the page images sent to the vision model, grayscale and binary pages encode smaller",
+        default="color",
+    )
+    MEMORY_CEILING_MB: PositiveInt | None = Field(
+        description="Memory a document may use while its pages are rendered, render scale and pages in flight "
+        "are lowered to stay under it. Disabled when unset",
+        default=None,
+    )
+    MIN_RENDER_DPI: PositiveInt = Field(
+        description="Lowest render resolution used when degrading under the memory ceiling", default=150
+    )
+    MEMORY_PROFILING: bool = Field(
+        description="Record tracemalloc and peak RSS per workflow node and attach them to the result", default=False
+    )
     IMAGE_TO_TEXT_MODEL: str = Field(default="us.meta.llama4-maverick-17b-instruct-v1:0")
     PAGE_GROUPPER_MODEL: str = Field(default="o4-mini-2025-04-16")
     OUTPUT_FORMATOR_MODEL: str = Field(default="gpt-4o-mini")
-    MERGER_STRATEGY: str = Field(default="classic")
+    IMAGE_TO_TEXT_OUTPUT_FORMAT: Literal["text", "json"] = Field(
+        description="Vision stage output, structured text with a metadata block or a single compact JSON of the "
+        "page content and metadata, rendered into the structured text locally",
+        default="text",
+    )
+    IMAGE_TO_TEXT_PAGES_PER_REQUEST: PositiveInt = Field(
+        description="Maximum number of page images packed into one vision request", default=1
+    )
+    IMAGE_TO_TEXT_REQUEST_TOKEN_BUDGET: PositiveInt = Field(
+        description="Maximum estimated image tokens packed into one vision request", default=30000
+    )
+    IMAGE_TO_TEXT_SPLIT_DENSE_PAGES: bool = Field(
+        description="Extract pages with many text lines in concurrent calls, the header, parties and totals from "
+        "the whole page and the line items from row bands cropped from it",
+        default=False,
+    )
+    IMAGE_TO_TEXT_DENSE_PAGE_LINES: PositiveInt = Field(
+        description="Text lines detected on a page image from which it is split into row bands", default=100
+    )
+    IMAGE_TO_TEXT_BAND_LINES: PositiveInt = Field(description="Text lines of a row band", default=40)
+    IMAGE_TO_TEXT_BAND_OVERLAP_LINES: NonNegativeInt = Field(
+        description="Text lines shared by neighbouring row bands, rows cut at a band edge are read whole by "
+        "the next band",
+        default=2,
+    )
+    IMAGE_TO_TEXT_FIRST_PASS_SCALE: float = Field(
+        description="Scale of the page images of a first low resolution vision pass, pages whose result looks "
+        "unreliable are extracted again at full resolution. 1 sends every page at full resolution once",
+        default=1.0,
+        gt=0,
+        le=1,
+    )
+    IMAGE_TO_TEXT_MAX_MISSING_SHARE: float = Field(
+        description="Share of the fields flagged present in the page metadata that may read NOT_AVAILABLE before "
+        "a first pass page is extracted again",
+        default=0.5,
+        ge=0,
+        le=1,
+    )
+    TEMPLATE_STORE_PATH: str | None = Field(
+        description="JSON file of the learned vendor layout templates. Pages of digital PDFs matching the layout "
+        "of a repeat seller get their header fields read from the text layer and only the line items from the "
+        "vision model, disabled when unset",
+        default=None,
+    )
+    TEMPLATE_MIN_SAMPLES: PositiveInt = Field(
+        description="Agreeing extractions of a vendor layout before its template is used", default=3
+    )
+    TEMPLATE_MAX_HASH_DISTANCE: NonNegativeInt = Field(
+        description="Bits the header fingerprint of a page may differ from a template's and still match",
+        default=10,
+        le=64,
+    )
+    PARTY_INDEX_PATH: str | None = Field(
+        description="SQLite file of the sellers and buyers seen on past invoices, keyed by GSTIN and PAN. Parties "
+        "on file are extracted by name and identification numbers only, their other details are filled in from "
+        "the index, disabled when unset",
+        default=None,
+    )
+    PROMPT_CACHE_ENABLED: bool = Field(
+        description="Enable provider prompt caching of the static system prompts. OpenAI caches prompt prefixes "
+        "automatically, on Bedrock only the Claude and Nova models take cache points, the default llama 4 vision "
+        "model is not cached",
+        default=True,
+    )
+    HEDGE_REQUESTS: bool = Field(description="Hedge slow page calls with a duplicate request", default=False)
+    HEDGE_LATENCY_QUANTILE: float = Field(
+        description="Latency quantile of the model after which a page call is hedged", default=0.95, gt=0, lt=1
+    )
+    HEDGE_MIN_SAMPLES: PositiveInt = Field(
+        description="Calls observed for a model before its latency quantile is trusted", default=20
+    )
+    HEDGE_MAX_EXTRA_FRACTION: float = Field(
+        description="Maximum duplicate requests as a fraction of the page calls of a run", default=0.1, ge=0, le=1
+    )
+    IMAGE_TO_TEXT_HEDGE_MODEL: str | None = Field(description="Fallback model for hedged vision calls", default=None)
+    OUTPUT_FORMATOR_HEDGE_MODEL: str | None = Field(
+        description="Fallback model for hedged formatter calls", default=None
+    )
+    PAGE_GROUPPER_WINDOW_PAGES: PositiveInt = Field(
+        description="Invoice pages grouped per grouper call, longer documents are grouped in overlapping windows "
+        "concurrently and stitched",
+        default=40,
+    )
+    PAGE_GROUPPER_WINDOW_OVERLAP: PositiveInt = Field(
+        description="Pages shared by neighbouring grouping windows", default=4
+    )
+    SPECULATIVE_FORMATTING: bool = Field(
+        description="Format pages with an invoice number found on no other page while the pages are grouped, "
+        "kept when the grouper confirms them as single page invoices",
+        default=True,
+    )
+    OUTPUT_FORMATOR_SCHEMA: Literal["invoice", "compact"] = Field(
+        description="Output schema of the formatter models, the Invoice schema or a short key schema with "
+        "positional line item rows mapped back to the Invoice locally",
+        default="compact",
+    )
+    OUTPUT_FORMATOR_CASCADE: bool = Field(
+        description="Try the local structured text parser before calling the formatter model", default=True
+    )
+    OUTPUT_FORMATOR_PARSER_CONFIDENCE: float = Field(
+        description="Minimum confidence of the structured text parser before falling back to the model",
+        default=0.9,
+        ge=0,
+        le=1,
+    )
+    OUTPUT_FORMATOR_RETRIES: PositiveInt | None = Field(
+        description="Output validation retries of the formatter model, when unset 1 before escalating to "
+        "OUTPUT_FORMATOR_ESCALATION_MODEL and 5 without an escalation model, as a page failing them fails its document",
+        default=None,
+    )
+    OUTPUT_FORMATOR_CORRECTIONS: bool = Field(
+        description="Ask the formatter model again for just the fields failing the arithmetic and GSTIN checks, "
+        "before escalating. Off by default, each corrected page costs one more formatter call",
+        default=False,
+    )
+    OUTPUT_FORMATOR_ESCALATION_MODEL: str | None = Field(
+        description="Larger formatter model for pages failing validation or totals checks, e.g. gpt-4o. Pages are "
+        "not escalated when unset",
+        default=None,
+    )
+    MODEL_PRICES: dict[str, tuple[float, float, float]] = Field(
+        description="USD per million input, output and cached input tokens by model name",
+        default_factory=lambda: {
+            "us.meta.llama4-maverick-17b-instruct-v1:0": (0.24, 0.97, 0.24),
+            "o4-mini-2025-04-16": (1.10, 4.40, 0.275),
+            "gpt-4o-mini": (0.15, 0.60, 0.075),
+            "gpt-4o": (2.50, 10.00, 1.25),
+        },
+    )
+    DOCUMENT_TOKEN_BUDGET: PositiveInt | None = Field(
+        description="Maximum estimated tokens of a document, disabled when unset", default=None
+    )
+    DOCUMENT_COST_BUDGET: PositiveFloat | None = Field(
+        description="Maximum estimated cost of a document in USD, disabled when unset", default=None
+    )
+    TENANT_DAILY_TOKEN_BUDGET: PositiveInt | None = Field(
+        description="Tokens a tenant may spend per UTC day, disabled when unset", default=None
+    )
+    TENANT_DAILY_COST_BUDGET: PositiveFloat | None = Field(
+        description="Cost in USD a tenant may spend per UTC day, disabled when unset", default=None
+    )
+    BUDGET_MIN_IMAGE_SIDE: PositiveInt = Field(
+        description="Smallest longest side in pixels page images are downscaled to before a document is rejected",
+        default=1024,
+    )
+    MERGER_STRATEGY: str = Field(
+        description="Merge of multi page invoices: classic, smart or strategy, which takes each field from the page "
+        "hinted by the page grouper and skips formatting the pages no hint points to",
+        default="classic",
+    )
     MAX_CONCURRENT_REQUEST: PositiveInt = Field(description="Maximum number of calls to the Agents", default=10)
+    SCHEDULER_INTERACTIVE_BURST: PositiveInt = Field(
+        description="Interactive calls served in a row while bulk calls wait before a bulk call gets a slot",
+        default=4,
+    )
     OUTPUT_PATH: DirectoryPath = Field(description="Path to the OUTPUT directory")
+    METRICS_EXPORT_PATH: str | None = Field(
+        description="File the workflow metrics are written to after each document, disabled when unset", default=None
+    )
+    METRICS_EXPORT_FORMAT: Literal["prometheus", "otel"] = Field(
+        description="Metrics export format, Prometheus text or OTLP JSON", default="prometheus"
+    )
+    BATCH_PROVIDER: str | None = Field(
+        description="Batch inference provider override (openai, aws_bedrock or local), defaults to the stage provider",
+        default=None,
+    )
+    BATCH_POLL_INTERVAL: PositiveInt = Field(description="Seconds between batch job status polls", default=60)
+    BATCH_BEDROCK_S3_URI: str | None = Field(description="S3 prefix for Bedrock batch job input/output", default=None)
+    BATCH_BEDROCK_ROLE_ARN: str | None = Field(description="IAM role used by Bedrock batch jobs", default=None)
 
     @field_validator("POPPLER_PATH", mode="before")
     @classmethod
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from src.config import InvoiceParserConfig
+from src.metrics import LatencyHistogram, metrics
+
+logger = logging.getLogger("asyncio")
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """In process latency histograms of the LLM calls, one per model."""
+
+    def __init__(self) -> None:
+        self.histograms: dict[str, LatencyHistogram] = {}
+
+    def observe(self, model_name: str, seconds: float) -> None:
+        self.histograms.setdefault(model_name, LatencyHistogram()).observe(seconds)
+
+    def count(self, model_name: str) -> int:
+        histogram = self.histograms.get(model_name)
+        return histogram.count if histogram else 0
+
+    def quantile(self, model_name: str, q: float) -> float | None:
+        histogram = self.histograms.get(model_name)
+        return histogram.quantile(q) if histogram else None
+
+
+latency_tracker = LatencyTracker()
+
+
+class RequestHedger:
+    """
+    Fires a duplicate request when a call runs longer than the latency quantile observed
+    for its model, optionally against a fallback model, and returns the first result.
+    The number of duplicates is capped to a fraction of the calls made through the hedger.
+    """
+
+    def __init__(self, config: InvoiceParserConfig, tracker: LatencyTracker = latency_tracker) -> None:
+        self.enabled = config.HEDGE_REQUESTS
+        self.quantile = config.HEDGE_LATENCY_QUANTILE
+        self.min_samples = config.HEDGE_MIN_SAMPLES
+        self.max_extra_fraction = config.HEDGE_MAX_EXTRA_FRACTION
+        self.tracker = tracker
+        self.calls = 0
+        self.hedges = 0
+
+    def hedge_delay(self, model_name: str) -> float | None:
+        if not self.enabled or self.tracker.count(model_name) < self.min_samples:
+            return None
+        return self.tracker.quantile(model_name, self.quantile)
+
+    def _within_budget(self) -> bool:
+        return self.hedges + 1 <= self.max_extra_fraction * self.calls
+
+    def _observe(self, model_name: str, elapsed: float) -> None:
+        self.tracker.observe(model_name, elapsed)
+        metrics.observe("llm_request_seconds", elapsed, model=model_name)
+
+    async def _timed(self, model_name: str, request: Callable[[], Awaitable[T]]) -> tuple[T, str]:
+        start = time.perf_counter()
+        try:
+            result = await request()
+        except asyncio.CancelledError:
+            # A request losing the race took at least this long, leaving it out drags the quantile down
+            self._observe(model_name, time.perf_counter() - start)
+            raise
+        self._observe(model_name, time.perf_counter() - start)
+        return result, model_name
+
+    async def run(
+        self,
+        model_name: str,
+        request: Callable[[], Awaitable[T]],
+        hedge_request: Callable[[], Awaitable[T]] | None = None,
+        hedge_model_name: str | None = None,
+    ) -> tuple[T, str]:
+        """
+        Run `request`, hedging it with `hedge_request` (defaults to a duplicate of `request`)
+        once it exceeds the latency quantile of `model_name`.
+        Returns the first successful result and the name of the model which produced it.
+        """
+        self.calls += 1
+        primary = asyncio.ensure_future(self._timed(model_name, request))
+        delay = self.hedge_delay(model_name)
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._within_budget():
+            return await primary
+        self.hedges += 1
+        hedge_model_name = hedge_model_name or model_name
+        logger.info(f"Hedging request to {model_name} after {delay:.2f}s with {hedge_model_name}")
+        hedge = asyncio.ensure_future(self._timed(hedge_model_name, hedge_request or request))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
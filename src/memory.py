@@ -0,0 +1,216 @@
+import logging
+import os
+import threading
+import tracemalloc
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from pydantic import BaseModel, Field
+
+from src.config import InvoiceParserConfig
+
+logger = logging.getLogger("asyncio")
+
+MB = 1024 * 1024
+POINTS_PER_INCH = 72
+# Bytes held per rendered pixel: the RGB render buffer plus the PIL image made from it
+RENDER_BYTES_PER_PIXEL = 6
+A4_PAGE_SIZE = (595.0, 842.0)
+
+
+def current_rss() -> int | None:
+    """Resident set size of the process in bytes, None where it cannot be read cheaply."""
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class NodeMemoryProfile(BaseModel):
+    node: str
+    rss_start_mb: float | None = None
+    rss_end_mb: float | None = None
+    rss_peak_mb: float | None = None
+    traced_peak_mb: float = 0.0
+    top_allocations: list[str] = Field(default_factory=list)
+
+
+class MemoryProfiler:
+    """
+    Records the RSS and tracemalloc peak of every workflow node of a run. RSS is sampled
+    from a background thread since native allocations (pdfium, poppler, PIL buffers) are
+    invisible to tracemalloc. Both are process wide, so concurrent documents share peaks.
+    """
+
+    def __init__(self, name: str, top_allocations: int = 5, interval: float = 0.05) -> None:
+        self.name = name
+        self.top_allocations = top_allocations
+        self.interval = interval
+        self.nodes: list[NodeMemoryProfile] = []
+        self._active: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._owns_tracing = False
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is None:
+                return
+            with self._lock:
+                for span_id, peak in self._active.items():
+                    self._active[span_id] = max(peak, rss)
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracing = True
+        self._sampler = threading.Thread(target=self._sample, name="memory-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._owns_tracing:
+            tracemalloc.stop()
+
+    def _top_allocations(self) -> list[str]:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(inclusive=False, filename_pattern=tracemalloc.__file__)]
+        )
+        return [str(stat) for stat in snapshot.statistics("lineno")[: self.top_allocations]]
+
+    @contextmanager
+    def span(self, node: str) -> Iterator[None]:
+        rss_start = current_rss()
+        span_id = id(object())
+        with self._lock:
+            self._active[span_id] = rss_start or 0
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            rss_end = current_rss()
+            with self._lock:
+                rss_peak = max(self._active.pop(span_id), rss_end or 0)
+            _, traced_peak = tracemalloc.get_traced_memory()
+            self.nodes.append(
+                NodeMemoryProfile(
+                    node=node,
+                    rss_start_mb=rss_start / MB if rss_start is not None else None,
+                    rss_end_mb=rss_end / MB if rss_end is not None else None,
+                    rss_peak_mb=rss_peak / MB if rss_peak else None,
+                    traced_peak_mb=traced_peak / MB,
+                    top_allocations=self._top_allocations(),
+                )
+            )
+
+
+class DocumentMemoryGuard:
+    """Tracks the RSS growth of the process since a document started rendering against its ceiling."""
+
+    def __init__(self, ceiling_mb: int | None) -> None:
+        self.ceiling = ceiling_mb * MB if ceiling_mb is not None else None
+        self.baseline = current_rss() if self.ceiling is not None else None
+
+    def exceeded(self, extra_bytes: int = 0) -> bool:
+        if self.ceiling is None or self.baseline is None:
+            return False
+        rss = current_rss()
+        return rss is not None and rss - self.baseline + extra_bytes > self.ceiling
+
+
+current_memory_profiler: ContextVar[MemoryProfiler | None] = ContextVar("current_memory_profiler", default=None)
+
+
+@contextmanager
+def memory_span(node: str) -> Iterator[None]:
+    """Profile the memory of a node when the current run is profiled, a no-op otherwise."""
+    profiler = current_memory_profiler.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.span(node):
+        yield
+
+
+@contextmanager
+def profile_memory(name: str, enabled: bool) -> Iterator[MemoryProfiler | None]:
+    """Record the memory profile of the nodes of the enclosed run."""
+    if not enabled:
+        yield None
+        return
+    profiler = MemoryProfiler(name)
+    profiler.start()
+    token = current_memory_profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        current_memory_profiler.reset(token)
+        profiler.stop()
+
+
+@dataclass
+class RenderPlan:
+    """Render scale and pages held in memory at once, with the degradations applied to fit a ceiling."""
+
+    scale: float
+    pages_in_flight: int
+    degradations: list[str] = field(default_factory=list)
+
+    @property
+    def dpi(self) -> int:
+        return int(self.scale * POINTS_PER_INCH)
+
+
+def page_render_bytes(page_size: tuple[float, float], scale: float) -> int:
+    """Estimated memory of one page rendered at `scale`, `page_size` in PDF points."""
+    width, height = page_size
+    return int(width * scale * height * scale * RENDER_BYTES_PER_PIXEL)
+
+
+def plan_render(
+    page_sizes: list[tuple[float, float]], scale: float, pages_in_flight: int, config: InvoiceParserConfig
+) -> RenderPlan:
+    """
+    Fit the rendering of a document under `MEMORY_CEILING_MB`. The render scale is first
+    lowered to the one the saved images are resized to anyway, then fewer pages are kept
+    in flight, and only then the scale is lowered further down to `MIN_RENDER_DPI`.
+    """
+    ceiling_mb = config.MEMORY_CEILING_MB
+    min_scale = config.MIN_RENDER_DPI / POINTS_PER_INCH
+    plan = RenderPlan(scale, max(1, pages_in_flight))
+    if ceiling_mb is None or not page_sizes:
+        return plan
+    ceiling = ceiling_mb * MB
+    largest = max(page_sizes, key=lambda size: size[0] * size[1])
+
+    def fits() -> bool:
+        return page_render_bytes(largest, plan.scale) * plan.pages_in_flight <= ceiling
+
+    if fits():
+        return plan
+    max_width, max_height = config.MAX_IMG_WIDTH, config.MAX_IMG_HEIGHT
+    output_scale = max(max_height / height if width < height else max_width / width for width, height in page_sizes)
+    if output_scale < plan.scale:
+        plan.scale = max(output_scale, min_scale)
+        plan.degradations.append("output_scale")
+        if fits():
+            return plan
+    pages_fitting = ceiling // max(page_render_bytes(largest, plan.scale), 1)
+    if pages_fitting < plan.pages_in_flight:
+        plan.pages_in_flight = max(1, int(pages_fitting))
+        plan.degradations.append("pages_in_flight")
+        if fits():
+            return plan
+    scale_fitting = (ceiling / (largest[0] * largest[1] * RENDER_BYTES_PER_PIXEL)) ** 0.5
+    plan.scale = max(min(plan.scale, scale_fitting), min_scale)
+    plan.degradations.append("render_scale")
+    if not fits():
+        logger.warning(f"Memory ceiling of {ceiling_mb} MB is below a single page at the minimum render scale")
+    return plan
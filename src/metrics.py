@@ -0,0 +1,315 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from collections.abc import Awaitable, Callable, Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, TypeVar
+
+from src.memory import memory_span
+from src.output_format import TokenCount
+from src.tracing import trace_span
+
+T = TypeVar("T")
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _exponential_buckets(start: float, factor: float, count: int) -> list[float]:
+    return [start * factor**index for index in range(count)]
+
+
+LATENCY_BUCKETS = _exponential_buckets(0.1, 1.25, 40)
+BYTES_BUCKETS = _exponential_buckets(1024, 2, 16)
+RATIO_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+# Metrics recorded by the workflow, name -> (type, help)
+METRIC_DESCRIPTIONS = {
+    "node_duration_seconds": ("histogram", "Wall clock time of a graph node"),
+    "node_cpu_seconds": ("histogram", "Process CPU time spent while a graph node ran"),
+    "llm_queue_wait_seconds": ("histogram", "Time an LLM call waited for a concurrency slot, by lane"),
+    "llm_request_seconds": ("histogram", "In flight time of an LLM call"),
+    "llm_request_bytes": ("histogram", "Bytes of prompt and images sent in an LLM call"),
+    "semaphore_occupancy_ratio": ("histogram", "Share of the concurrency slots in use when a slot is acquired"),
+    "semaphore_in_use": ("gauge", "Concurrency slots in use"),
+    "scheduler_queue_depth": ("gauge", "LLM calls waiting for a concurrency slot, by lane"),
+    "scheduler_grants_total": ("counter", "Concurrency slots granted, by lane"),
+    "page_render_seconds": ("histogram", "Time to rasterise a PDF page"),
+    "page_save_seconds": ("histogram", "Time to resize, encode and write a page image"),
+    "page_deskewed_total": ("counter", "Scanned pages straightened before resizing"),
+    "page_trimmed_ratio": ("histogram", "Share of the page area cut away as white margin"),
+    "memory_degradations_total": (
+        "counter",
+        "Render scale or pages in flight lowered to stay under the memory ceiling",
+    ),
+    "llm_request_tokens_total": ("counter", "Prompt tokens sent"),
+    "llm_response_tokens_total": ("counter", "Completion tokens received"),
+    "llm_cached_tokens_total": ("counter", "Prompt tokens served from the provider prompt cache"),
+    "vision_split_pages_total": (
+        "counter",
+        "Dense pages extracted as a header call and row band calls, stitched or extracted again whole",
+    ),
+    "vision_first_pass_pages_total": (
+        "counter",
+        "Pages read from a low resolution image, kept or extracted again at full resolution",
+    ),
+    "formatter_pages_total": ("counter", "Pages formatted, by cascade step"),
+    "vision_template_pages_total": (
+        "counter",
+        "Pages of a known vendor layout read from the text layer and a line items call, or extracted again whole",
+    ),
+    "template_pages_learned_total": ("counter", "Single page invoices recorded into the vendor layout templates"),
+    "party_index_pages_total": ("counter", "Pages extracted with the parties on file asked by identification only"),
+    "party_index_fills_total": ("counter", "Seller and buyer details filled in from the party index"),
+    "formatter_corrections_total": (
+        "counter",
+        "Formatter outputs re-asked for the fields failing the arithmetic or GSTIN checks, by outcome",
+    ),
+    "merge_duplicate_items_total": ("counter", "Repeated line items dropped while merging the pages of an invoice"),
+    "speculative_pages_total": (
+        "counter",
+        "Pages formatted while grouping, committed when confirmed as single page invoices or discarded",
+    ),
+    "formatter_pages_skipped_total": ("counter", "Grouped pages not formatted as no merge hint points to them"),
+    "budget_decisions_total": ("counter", "Documents admitted, downscaled or rejected by the token budget"),
+    "prompt_cache_hit_ratio": ("gauge", "Share of the prompt tokens served from the provider prompt cache"),
+    "formatter_local_parser_ratio": ("gauge", "Share of the formatted pages served by the structured text parser"),
+}
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket latency histogram, cheap enough to be updated on every call.
+    Quantiles are interpolated linearly inside the bucket they fall in.
+    """
+
+    def __init__(self, bounds: list[float] | None = None) -> None:
+        self.bounds = bounds or LATENCY_BUCKETS
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float | None:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.bounds[-1]
+
+
+def _labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def _format_bound(bound: float) -> str:
+    return f"{bound:.6g}"
+
+
+class MetricsRegistry:
+    """
+    In process counters, gauges and histograms of the workflow, exported as
+    Prometheus text or as an OTLP shaped JSON document. Nothing leaves the process
+    unless an export is written. Updates are guarded by a lock as pages are rendered
+    in worker threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self.gauges: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, LatencyHistogram]] = {}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, bounds: list[float] | None = None, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = LatencyHistogram(bounds)
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _derived_gauges(self) -> dict[str, dict[Labels, float]]:
+        derived: dict[str, dict[Labels, float]] = {}
+        cached = self.counters.get("llm_cached_tokens_total", {})
+        for key, request_tokens in self.counters.get("llm_request_tokens_total", {}).items():
+            if request_tokens:
+                derived.setdefault("prompt_cache_hit_ratio", {})[key] = cached.get(key, 0.0) / request_tokens
+        formatted = self.counters.get("formatter_pages_total", {})
+        total_pages = sum(formatted.values())
+        if total_pages:
+            local_pages = formatted.get(_labels({"path": "local_parser"}), 0.0)
+            derived["formatter_local_parser_ratio"] = {(): local_pages / total_pages}
+        return derived
+
+    def to_prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        lines: list[str] = []
+
+        def header(name: str, metric_type: str) -> None:
+            lines.append(f"# HELP {name} {METRIC_DESCRIPTIONS.get(name, ('', name))[1]}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        for name, series in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.extend(f"{name}{_format_labels(key)} {value:g}" for key, value in sorted(series.items()))
+        for name, series in sorted({**self.gauges, **self._derived_gauges()}.items()):
+            header(name, "gauge")
+            lines.extend(f"{name}{_format_labels(key)} {value:g}" for key, value in sorted(series.items()))
+        for name, histograms in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for key, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts, strict=False):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, (('le', _format_bound(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.total:g}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_otel(self, service_name: str = "invoice-parser") -> dict[str, Any]:
+        """Render the metrics as an OTLP/JSON `ExportMetricsServiceRequest` document."""
+
+        def attributes(key: Labels) -> list[dict[str, Any]]:
+            return [{"key": label, "value": {"stringValue": value}} for label, value in key]
+
+        now = str(time.time_ns())
+        metrics: list[dict[str, Any]] = []
+        for name, series in sorted(self.counters.items()):
+            data_points = [
+                {"attributes": attributes(key), "asDouble": value, "timeUnixNano": now} for key, value in series.items()
+            ]
+            metrics.append(
+                {
+                    "name": name,
+                    "description": METRIC_DESCRIPTIONS.get(name, ("", ""))[1],
+                    "sum": {"dataPoints": data_points, "aggregationTemporality": 2, "isMonotonic": True},
+                }
+            )
+        for name, series in sorted({**self.gauges, **self._derived_gauges()}.items()):
+            data_points = [
+                {"attributes": attributes(key), "asDouble": value, "timeUnixNano": now} for key, value in series.items()
+            ]
+            metrics.append(
+                {
+                    "name": name,
+                    "description": METRIC_DESCRIPTIONS.get(name, ("", ""))[1],
+                    "gauge": {"dataPoints": data_points},
+                }
+            )
+        for name, histograms in sorted(self.histograms.items()):
+            data_points = [
+                {
+                    "attributes": attributes(key),
+                    "count": str(histogram.count),
+                    "sum": histogram.total,
+                    "bucketCounts": [str(count) for count in histogram.counts],
+                    "explicitBounds": histogram.bounds,
+                    "timeUnixNano": now,
+                }
+                for key, histogram in histograms.items()
+            ]
+            metrics.append(
+                {
+                    "name": name,
+                    "description": METRIC_DESCRIPTIONS.get(name, ("", ""))[1],
+                    "histogram": {"dataPoints": data_points, "aggregationTemporality": 2},
+                }
+            )
+        return {
+            "resourceMetrics": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+                    "scopeMetrics": [{"scope": {"name": "src.metrics"}, "metrics": metrics}],
+                }
+            ]
+        }
+
+    def export(self, path: str | Path, export_format: str = "prometheus") -> Path:
+        """Write the metrics to `path` as `prometheus` text or `otel` JSON."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if export_format == "otel":
+            path.write_text(json.dumps(self.to_otel(), indent=2), encoding="utf-8")
+        elif export_format == "prometheus":
+            path.write_text(self.to_prometheus(), encoding="utf-8")
+        else:
+            raise ValueError(f"Unsupported metrics export format {export_format}")
+        return path
+
+
+metrics = MetricsRegistry()
+
+
+def record_token_counts(token_counts: Iterable[TokenCount]) -> None:
+    """Add the token expense of a workflow run to the token counters."""
+    for t_count in token_counts:
+        if t_count.request_tokens is None:
+            continue
+        metrics.inc("llm_request_tokens_total", t_count.request_tokens, model=t_count.model_name)
+        metrics.inc("llm_response_tokens_total", t_count.response_tokens or 0, model=t_count.model_name)
+        metrics.inc("llm_cached_tokens_total", t_count.cached_tokens or 0, model=t_count.model_name)
+
+
+def timed_node(run: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """Record the wall clock and process CPU time, and the memory when profiled, of a graph node `run` method."""
+
+    @functools.wraps(run)
+    async def wrapper(self: Any, *args: Any, **kwargs: Any) -> T:
+        node_name = self.__class__.__name__
+        cpu_start = time.process_time()
+        try:
+            with (
+                metrics.timer("node_duration_seconds", node=node_name),
+                trace_span(node_name, "node"),
+                memory_span(node_name),
+            ):
+                return await run(self, *args, **kwargs)
+        finally:
+            metrics.observe("node_cpu_seconds", time.process_time() - cpu_start, node=node_name)
+
+    return wrapper
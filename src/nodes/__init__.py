@@ -2,6 +2,7 @@ from .image_to_text import ImageToTextConverter
 from .page_aggregator import PageAggregator
 from .page_formator import MultiPageFormator, SinglePageFormator
 from .page_groupper import PageGroupper
+from .pdf_converter import pdf_converter_factory
 from .poppler_pdf_2_img import Pdf2ImgConverter
 
 __all__ = [
@@ -11,4 +12,5 @@ __all__ = [
     "PageGroupper",
     "Pdf2ImgConverter",
     "SinglePageFormator",
+    "pdf_converter_factory",
 ]
@@ -1,22 +1,50 @@
 import asyncio
+import json
 import logging
+import re
+from collections.abc import Awaitable, Callable, Collection, Mapping
 from pathlib import Path
 
+from PIL import Image
 from pydantic_ai import Agent, BinaryContent
-from pydantic_ai.agent import AgentRunResult
+from pydantic_ai.usage import Usage
 
 from src.config import InvoiceParserConfig
-from src.output_format import TokenCount
+from src.hedging import RequestHedger
+from src.metrics import BYTES_BUCKETS, metrics
+from src.output_format import Invoice, Item, TokenCount
+from src.scheduler import stage_limiter
+from src.structured_text import (
+    parse_item_rows,
+    parse_numbered_item_rows,
+    parse_structured_text,
+    render_structured_text,
+)
+from src.templates import assemble_invoice, invoice_metadata
+from src.tracing import trace_span
 from src.utility import (
+    cached_token_count,
+    estimate_image_tokens,
     extract_invoice_metadata,
     extract_json_from_text,
     image_to_byte_string,
     model_factory,
     replace_json_from_text,
     sorted_images,
+    split_multi_page_output,
+    split_usage,
+    text_line_spans,
 )
+from src.validation import check_extraction
 
 from .messages import (
+    IMAGE_TO_TEXT_HEADER_USER_MESSAGE,
+    IMAGE_TO_TEXT_JSON_SYSTEM_MESSAGE,
+    IMAGE_TO_TEXT_KNOWN_PARTIES_MESSAGE,
+    IMAGE_TO_TEXT_MULTI_PAGE_INSTRUCTION,
+    IMAGE_TO_TEXT_MULTI_PAGE_USER_MESSAGE,
+    IMAGE_TO_TEXT_ROWS_SYSTEM_MESSAGE,
+    IMAGE_TO_TEXT_ROWS_USER_MESSAGE,
     IMAGE_TO_TEXT_SYSTEM_MESSAGE,
     IMAGE_TO_TEXT_USER_MESSAGE,
 )
@@ -27,53 +55,512 @@ logger = logging.getLogger("asyncio")
 class ImageToTextConverter:
     def __init__(self, config: InvoiceParserConfig):
         self.model_name = config.IMAGE_TO_TEXT_MODEL
-        self.semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUEST)
+        self.semaphore = stage_limiter(
+            "image_to_text", config.MAX_CONCURRENT_REQUEST, config.SCHEDULER_INTERACTIVE_BURST
+        )
         self.image_ext = config.IMG_SAVE_FORMAT
+        self.pages_per_request = config.IMAGE_TO_TEXT_PAGES_PER_REQUEST
+        self.request_token_budget = config.IMAGE_TO_TEXT_REQUEST_TOKEN_BUDGET
+        self.prompt_cache = config.PROMPT_CACHE_ENABLED
+        self.hedger = RequestHedger(config)
+        self.hedge_model_name = config.IMAGE_TO_TEXT_HEDGE_MODEL
+        self.output_format = config.IMAGE_TO_TEXT_OUTPUT_FORMAT
+        self.split_dense_pages = config.IMAGE_TO_TEXT_SPLIT_DENSE_PAGES
+        self.dense_page_lines = config.IMAGE_TO_TEXT_DENSE_PAGE_LINES
+        self.band_lines = config.IMAGE_TO_TEXT_BAND_LINES
+        self.band_overlap_lines = min(config.IMAGE_TO_TEXT_BAND_OVERLAP_LINES, config.IMAGE_TO_TEXT_BAND_LINES - 1)
+        self.first_pass_scale = config.IMAGE_TO_TEXT_FIRST_PASS_SCALE
+        self.max_missing_share = config.IMAGE_TO_TEXT_MAX_MISSING_SHARE
+        self.template_invoices: dict[int, Invoice] = {}
+
+    @property
+    def system_prompt(self) -> str:
+        return IMAGE_TO_TEXT_JSON_SYSTEM_MESSAGE if self.output_format == "json" else IMAGE_TO_TEXT_SYSTEM_MESSAGE
+
+    def _pack_pages(self, images: list[tuple[Path, int]], image_scale: float = 1.0) -> list[list[tuple[Path, int]]]:
+        """
+        Pack consecutive pages into requests of at most `pages_per_request` images,
+        without exceeding the estimated image token budget of a request.
+        """
+        packs: list[list[tuple[Path, int]]] = []
+        pack_tokens = 0
+        for img_path, page_no in images:
+            with Image.open(img_path) as image:
+                image_tokens = estimate_image_tokens((int(image.width * image_scale), int(image.height * image_scale)))
+            if (
+                not packs
+                or len(packs[-1]) >= self.pages_per_request
+                or pack_tokens + image_tokens > self.request_token_budget
+            ):
+                packs.append([])
+                pack_tokens = 0
+            packs[-1].append((img_path, page_no))
+            pack_tokens += image_tokens
+        return packs
+
+    def _row_bands(self, image_path: Path) -> list[tuple[int, int, int, int]]:
+        """
+        Crop boxes of the row bands of a dense page, each of `band_lines` text lines cut in
+        the gaps between lines. Empty when the page has fewer than `dense_page_lines` lines.
+        """
+        spans, (width, height) = text_line_spans(image_path)
+        if len(spans) < self.dense_page_lines:
+            return []
+        boxes = []
+        step = self.band_lines - self.band_overlap_lines
+        for start in range(0, len(spans), step):
+            end = min(start + self.band_lines, len(spans))
+            top = 0 if start == 0 else (spans[start - 1][1] + spans[start][0]) // 2
+            bottom = height if end == len(spans) else (spans[end - 1][1] + spans[end][0]) // 2
+            boxes.append((0, top, width, bottom))
+            if end == len(spans):
+                break
+        return boxes
+
+    async def _split_dense_pages(
+        self, images: list[tuple[Path, int]]
+    ) -> tuple[list[tuple[Path, int, list[tuple[int, int, int, int]]]], list[tuple[Path, int]]]:
+        """The dense pages with their row bands, and the other pages."""
+        if not self.split_dense_pages:
+            return [], images
+        page_bands = await asyncio.gather(*(asyncio.to_thread(self._row_bands, img_path) for img_path, _ in images))
+        dense_pages = [
+            (img_path, page_no, bands) for (img_path, page_no), bands in zip(images, page_bands, strict=True) if bands
+        ]
+        return dense_pages, [image for image, bands in zip(images, page_bands, strict=True) if not bands]
+
+    async def _read_rows(
+        self,
+        rows_agent: Agent[None, str],
+        page: tuple[Path, int],
+        image_scale: float,
+        band: int = 1,
+        bands: list[tuple[int, int, int, int]] | None = None,
+    ) -> tuple[str, Usage]:
+        """Line items output of a row band of a page, of the whole page without `bands`."""
+        image_path, page_no = page
+        async with self.semaphore:
+            with trace_span("encode", "encode", page=page_no, band=band):
+                img_byte, mimetype = image_to_byte_string(
+                    image_path, image_scale, box=bands[band - 1] if bands else None
+                )
+            message = IMAGE_TO_TEXT_ROWS_USER_MESSAGE.substitute(
+                BAND=band, BANDS=len(bands) if bands else 1, PAGE_NO=page_no
+            )
+            metrics.observe(
+                "llm_request_bytes",
+                len(message.encode()) + len(img_byte),
+                bounds=BYTES_BUCKETS,
+                stage="image_to_text",
+            )
+            with (
+                metrics.timer("llm_request_seconds", model=self.model_name),
+                trace_span("vision", "llm", page=page_no, band=band),
+            ):
+                result = await rows_agent.run(user_prompt=[message, BinaryContent(data=img_byte, media_type=mimetype)])
+        return result.output, result.usage()
+
+    async def _run_template_page(
+        self,
+        run_page: Callable[[Path, int, str], Awaitable[list[tuple[int, str, dict, TokenCount]]]],
+        rows_agent: Agent[None, str],
+        page: tuple[Path, int],
+        image_scale: float,
+        prefilled: Invoice,
+    ) -> list[tuple[int, str, dict, TokenCount]]:
+        """
+        Extract a page of a known vendor layout, the header fields prefilled from the text layer
+        and only the line items read by the model. The page is extracted whole through `run_page`
+        when the line items do not reconcile with the prefilled totals.
+        """
+        image_path, page_no = page
+        output, usage = await self._read_rows(rows_agent, page, image_scale)
+        t_count = _add_usage(TokenCount(model_name=self.model_name, page_no=str(page_no)), [usage])
+        invoice = assemble_invoice(prefilled, parse_item_rows(output), page_no)
+        if invoice is not None:
+            metrics.inc("vision_template_pages_total", outcome="template")
+            self.template_invoices[page_no] = invoice
+            return [(page_no, render_structured_text(invoice), invoice_metadata(invoice), t_count)]
+        logger.warning(f"Line items of page {page_no} do not match its template, extracting the whole page")
+        metrics.inc("vision_template_pages_total", outcome="fallback")
+        return [
+            (p_no, text, metadata, _merge_token_counts(count, t_count))
+            for p_no, text, metadata, count in await run_page(image_path, page_no, IMAGE_TO_TEXT_USER_MESSAGE)
+        ]
+
+    async def _run_split_page(
+        self,
+        run_page: Callable[[Path, int, str], Awaitable[list[tuple[int, str, dict, TokenCount]]]],
+        rows_agent: Agent[None, str],
+        page: tuple[Path, int, list[tuple[int, int, int, int]]],
+        image_scale: float,
+    ) -> list[tuple[int, str, dict, TokenCount]]:
+        """
+        Extract a dense page in concurrent calls, the header, parties and totals from the whole
+        page through `run_page` and the line items from each row band. The page is extracted
+        again whole when the outputs can not be stitched.
+        """
+        image_path, page_no, bands = page
+        logger.info(f"Splitting page {page_no} into a header call and {len(bands)} row band calls")
+        header, *band_results = await asyncio.gather(
+            run_page(image_path, page_no, IMAGE_TO_TEXT_HEADER_USER_MESSAGE),
+            *(
+                self._read_rows(rows_agent, (image_path, page_no), image_scale, band, bands)
+                for band in range(1, len(bands) + 1)
+            ),
+        )
+        _, text_content, page_metadata, t_count = header[0]
+        t_count = _add_usage(t_count, [usage for _, usage in band_results])
+        stitched = stitch_row_bands(text_content, page_metadata, [output for output, _ in band_results], page_no)
+        if stitched is not None:
+            metrics.inc("vision_split_pages_total", outcome="stitched")
+            return [(page_no, *stitched, t_count)]
+        logger.warning(f"Row bands of page {page_no} could not be stitched, extracting the whole page")
+        metrics.inc("vision_split_pages_total", outcome="fallback")
+        return [
+            (p_no, text, metadata, _merge_token_counts(count, t_count))
+            for p_no, text, metadata, count in await run_page(image_path, page_no, IMAGE_TO_TEXT_USER_MESSAGE)
+        ]
 
-    async def run(self, image_dir: Path | str) -> tuple[list[tuple[int, str, dict, TokenCount]], str | None]:
+    async def run(
+        self,
+        image_dir: Path | str,
+        pages: Collection[int] | None = None,
+        image_scale: float = 1.0,
+        templates: Mapping[int, Invoice] | None = None,
+        known_parties: Mapping[int, list[str]] | None = None,
+    ) -> tuple[list[tuple[int, str, dict, TokenCount]], str | None]:
         """
         Process the image and return a text description.
+        Only the given `pages` are processed when provided, images are downscaled by `image_scale`.
+        Pages with a vendor template invoice in `templates` only have their line items read, the
+        Invoice of each page extracted this way is left in `template_invoices`. The parties of
+        the GSTINs in `known_parties` of a page are extracted by name and identification only.
+
+        With a `IMAGE_TO_TEXT_FIRST_PASS_SCALE` below 1 the pages are first sent further
+        downscaled, and only the pages whose result fails `check_extraction` are extracted
+        again at `image_scale`. A failed second pass keeps the first pass results.
         """
+        if self.first_pass_scale >= 1.0:
+            return await self._extract(image_dir, pages, image_scale, templates, known_parties)
+        outputs, error = await self._extract(
+            image_dir, pages, image_scale * self.first_pass_scale, templates, known_parties
+        )
+        if error:
+            return outputs, error
+        retry_pages = []
+        for p_no, text_content, metadata, _ in outputs:
+            failures = check_extraction(text_content, metadata, self.max_missing_share)
+            if failures:
+                logger.info(f"Page {p_no} low resolution result is unreliable - {'; '.join(failures)}")
+                retry_pages.append(p_no)
+        metrics.inc("vision_first_pass_pages_total", len(outputs) - len(retry_pages), outcome="kept")
+        if not retry_pages:
+            return outputs, None
+        metrics.inc("vision_first_pass_pages_total", len(retry_pages), outcome="extracted_again")
+        for p_no in retry_pages:
+            self.template_invoices.pop(p_no, None)
+        retried, error = await self._extract(image_dir, retry_pages, image_scale, known_parties=known_parties)
+        if error:
+            logger.warning(f"Full resolution pass failed, keeping the low resolution results - {error}")
+            return outputs, None
+        # The tokens of the first pass of a page extracted again are spent all the same
+        by_page = {output[0]: output for output in outputs}
+        for p_no, text_content, metadata, t_count in retried:
+            by_page[p_no] = (p_no, text_content, metadata, _merge_token_counts(t_count, by_page[p_no][3]))
+        return sorted(by_page.values(), key=lambda x: x[0]), None
+
+    async def _extract(
+        self,
+        image_dir: Path | str,
+        pages: Collection[int] | None = None,
+        image_scale: float = 1.0,
+        templates: Mapping[int, Invoice] | None = None,
+        known_parties: Mapping[int, list[str]] | None = None,
+    ) -> tuple[list[tuple[int, str, dict, TokenCount]], str | None]:
+        """Extract the `pages` in one pass, images downscaled by `image_scale`."""
+        model = model_factory(model_name=self.model_name, provider="aws_bedrock", prompt_cache=self.prompt_cache)
         agent = Agent(
-            model=model_factory(model_name=self.model_name, provider="aws_bedrock"),
-            system_prompt=IMAGE_TO_TEXT_SYSTEM_MESSAGE,
+            model=model,
+            system_prompt=self.system_prompt,
+            output_type=str,
+            retries=1,
+            model_settings={"temperature": 0},
+        )
+        multi_page_agent = Agent(
+            model=model,
+            system_prompt=(self.system_prompt, IMAGE_TO_TEXT_MULTI_PAGE_INSTRUCTION),
             output_type=str,
             retries=1,
             model_settings={"temperature": 0},
         )
+        rows_agent = Agent(
+            model=model,
+            system_prompt=IMAGE_TO_TEXT_ROWS_SYSTEM_MESSAGE,
+            output_type=str,
+            retries=1,
+            model_settings={"temperature": 0},
+        )
+        hedge_model = (
+            model_factory(model_name=self.hedge_model_name, provider="aws_bedrock", prompt_cache=self.prompt_cache)
+            if self.hedge_model_name
+            else None
+        )
 
-        async def _run_agent(image_path: Path, page_no: int) -> tuple[AgentRunResult[str], Path, int]:
+        async def _run_agent(
+            image_path: Path, page_no: int, user_message: str = IMAGE_TO_TEXT_USER_MESSAGE
+        ) -> list[tuple[int, str, dict, TokenCount]]:
+            user_message = "\n".join([user_message, *known_parties_note(known_parties, page_no)])
             async with self.semaphore:
                 logger.info(f"Image To Text Converter Agent Processing Page : {page_no} : {image_path.name}")
-                img_byte, mimetype = image_to_byte_string(image_path.resolve())
+                with trace_span("encode", "encode", page=page_no):
+                    img_byte, mimetype = image_to_byte_string(image_path.resolve(), image_scale)
                 input_msg = [
-                    IMAGE_TO_TEXT_USER_MESSAGE,
+                    user_message,
                     BinaryContent(data=img_byte, media_type=mimetype),
                 ]
-                result = await agent.run(user_prompt=input_msg)
-                return result, image_path, page_no
+                metrics.observe(
+                    "llm_request_bytes",
+                    len(user_message.encode()) + len(img_byte),
+                    bounds=BYTES_BUCKETS,
+                    stage="image_to_text",
+                )
+                with trace_span("vision", "llm", page=page_no):
+                    result, model_name = await self.hedger.run(
+                        self.model_name,
+                        lambda: agent.run(user_prompt=input_msg),
+                        (lambda: agent.run(user_prompt=input_msg, model=hedge_model)) if hedge_model else None,
+                        self.hedge_model_name,
+                    )
+            return [self.parse_output(page_no, result.output, result.usage(), model_name=model_name)]
 
-        task_list = [
-            _run_agent(img_path, page_no)
+        async def _run_multi_page_agent(pack: list[tuple[Path, int]]) -> list[tuple[int, str, dict, TokenCount]]:
+            page_nos = [page_no for _, page_no in pack]
+            async with self.semaphore:
+                logger.info(f"Image To Text Converter Agent Processing Pages : {page_nos}")
+                input_msg: list[str | BinaryContent] = [
+                    IMAGE_TO_TEXT_MULTI_PAGE_USER_MESSAGE.substitute(PAGE_NOS=", ".join(map(str, page_nos)))
+                ]
+                for image_path, page_no in pack:
+                    with trace_span("encode", "encode", page=page_no):
+                        img_byte, mimetype = image_to_byte_string(image_path.resolve(), image_scale)
+                    input_msg += [
+                        f"Page No {page_no}",
+                        BinaryContent(data=img_byte, media_type=mimetype),
+                        *known_parties_note(known_parties, page_no),
+                    ]
+                metrics.observe(
+                    "llm_request_bytes",
+                    sum(
+                        len(part.data) if isinstance(part, BinaryContent) else len(part.encode()) for part in input_msg
+                    ),
+                    bounds=BYTES_BUCKETS,
+                    stage="image_to_text",
+                )
+                with (
+                    metrics.timer("llm_request_seconds", model=self.model_name),
+                    trace_span("vision", "llm", pages=page_nos),
+                ):
+                    result = await multi_page_agent.run(user_prompt=input_msg)
+            page_outputs = split_multi_page_output(result.output, page_nos)
+            outputs = [
+                self.parse_output(page_no, page_output, split_usage(result.usage(), len(page_outputs), index))
+                for index, (page_no, page_output) in enumerate(page_outputs.items())
+            ]
+            for image_path, page_no in pack:
+                if page_no not in page_outputs:
+                    logger.warning(f"Page {page_no} not attributed in multi page response, retrying as single page")
+                    outputs.extend(await _run_agent(image_path, page_no))
+            return outputs
+
+        images = [
+            (img_path, page_no)
             async for img_path, page_no in sorted_images(image_dir, image_ext=self.image_ext)
+            if pages is None or page_no in pages
+        ]
+        templates = templates or {}
+        task_list = [
+            self._run_template_page(_run_agent, rows_agent, image, image_scale, templates[image[1]])
+            for image in images
+            if image[1] in templates
         ]
+        images = [image for image in images if image[1] not in templates]
+        dense_pages, images = await self._split_dense_pages(images)
+        task_list += [self._run_split_page(_run_agent, rows_agent, page, image_scale) for page in dense_pages]
+        if self.pages_per_request > 1:
+            task_list += [
+                _run_agent(*pack[0]) if len(pack) == 1 else _run_multi_page_agent(pack)
+                for pack in self._pack_pages(images, image_scale)
+            ]
+        else:
+            task_list += [_run_agent(img_path, page_no) for img_path, page_no in images]
         try:
             agent_response = await asyncio.gather(*task_list)
         except Exception as err:
             logger.error(f"Error in Image To Text Converter Agent Response - {err!s}")
             return [], str(err)
-        outputs = []
-        for agent_res, _, page_no in agent_response:
-            json_string = extract_json_from_text(agent_res.output)
-            page_metadata = extract_invoice_metadata(json_string) if json_string is not None else {}
-            text_content = replace_json_from_text(agent_res.output)
-            logger.info(f"Extracted Metadata for Page {page_no}: {page_metadata}")
-            logger.info(f"Extracted Text for Page {page_no}: {text_content[:100]} ...")
-            token_expense = TokenCount(
-                model_name=self.model_name,
-                page_no=str(page_no),
-                request_tokens=agent_res.usage().request_tokens or None,
-                response_tokens=agent_res.usage().response_tokens or None,
-            )
-            outputs.append((page_no, text_content, page_metadata, token_expense))
+        outputs = [page_output for response in agent_response for page_output in response]
+        outputs.sort(key=lambda x: x[0])
         return outputs, None
+
+    def parse_output(
+        self,
+        page_no: int,
+        output: str,
+        usage: Usage | None = None,
+        model_name: str | None = None,
+    ) -> tuple[int, str, dict, TokenCount]:
+        """
+        Split the raw model output of a page into structured text and metadata. JSON outputs
+        are rendered into the structured text layout, outputs which are not valid JSON are
+        read as structured text.
+        """
+        usage = usage or Usage()
+        with trace_span("parse", "parse", page=page_no):
+            parsed = parse_json_output(output, page_no) if self.output_format == "json" else None
+            if parsed is not None:
+                text_content, page_metadata = parsed
+            else:
+                json_string = extract_json_from_text(output)
+                page_metadata = extract_invoice_metadata(json_string) if json_string is not None else {}
+                text_content = replace_json_from_text(output)
+        logger.info(f"Extracted Metadata for Page {page_no}: {page_metadata}")
+        logger.info(f"Extracted Text for Page {page_no}: {text_content[:100]} ...")
+        token_expense = TokenCount(
+            model_name=model_name or self.model_name,
+            page_no=str(page_no),
+            request_tokens=usage.request_tokens or None,
+            response_tokens=usage.response_tokens or None,
+            cached_tokens=cached_token_count(usage),
+        )
+        return page_no, text_content, dict(page_metadata), token_expense
+
+
+def parse_json_output(output: str, page_no: int) -> tuple[str, Mapping[str, str | bool]] | None:
+    """
+    Structured text and metadata of a page extracted in the JSON output mode, None when
+    the output is not a valid page JSON.
+    """
+    if re.search(r"\bNO_INVOICE_FOUND", output, re.IGNORECASE):
+        return "NO_INVOICE_FOUND", {}
+    json_string = extract_json_from_text(output) or output[output.find("{") : output.rfind("}") + 1]
+    try:
+        page = json.loads(json_string)
+        invoice = Invoice.model_validate({**page["invoice"], "page_no": str(page_no)})
+        metadata = extract_invoice_metadata(json.dumps(page["metadata"]))
+    except (ValueError, KeyError, TypeError) as err:
+        logger.warning(f"Page {page_no} JSON output could not be read, parsing it as text - {err!s}")
+        return None
+    return render_structured_text(invoice), metadata
+
+
+def known_parties_note(known_parties: Mapping[int, list[str]] | None, page_no: int) -> list[str]:
+    """The instruction to extract the parties on file of a page by identification only, empty without any."""
+    if not known_parties or page_no not in known_parties:
+        return []
+    return [IMAGE_TO_TEXT_KNOWN_PARTIES_MESSAGE.substitute(GSTINS=", ".join(known_parties[page_no]))]
+
+
+def _add_usage(t_count: TokenCount, usages: list[Usage]) -> TokenCount:
+    usage = Usage(
+        request_tokens=t_count.request_tokens or 0,
+        response_tokens=t_count.response_tokens or 0,
+        details={"cached_tokens": t_count.cached_tokens or 0},
+    )
+    for band_usage in usages:
+        usage = usage + band_usage
+    return t_count.model_copy(
+        update={
+            "request_tokens": usage.request_tokens or None,
+            "response_tokens": usage.response_tokens or None,
+            "cached_tokens": cached_token_count(usage),
+        }
+    )
+
+
+def _merge_token_counts(t_count: TokenCount, other: TokenCount) -> TokenCount:
+    def total(first: int | None, second: int | None) -> int | None:
+        return (first or 0) + (second or 0) or None
+
+    return t_count.model_copy(
+        update={
+            "request_tokens": total(t_count.request_tokens, other.request_tokens),
+            "response_tokens": total(t_count.response_tokens, other.response_tokens),
+            "cached_tokens": total(t_count.cached_tokens, other.cached_tokens),
+        }
+    )
+
+
+def _row_detail(item: Item) -> tuple[int, int]:
+    """How much of a row a band read, a row cut by a band edge reads fewer details."""
+    defaults = Item(slno=item.slno)
+    details = sum(getattr(item, name) != getattr(defaults, name) for name in Item.model_fields)
+    return details, len(item.description)
+
+
+def _same_row(first: Item, second: Item) -> bool:
+    """Whether two rows without serial number are one row read by two bands, a band edge may cut its amount."""
+    _, first_description, first_amount = first.dedupe_key
+    _, second_description, second_amount = second.dedupe_key
+    return first_description == second_description and (
+        first_amount == second_amount or not first_amount or not second_amount
+    )
+
+
+def _add_band_rows(
+    rows: list[Item], numbered: dict[int, int], previous_band: list[int], band_rows: list[tuple[Item, bool]]
+) -> list[int]:
+    """
+    Add the rows of a band to `rows`, `numbered` indexes them by printed serial number. Returns
+    the indices of the band rows without serial number, `previous_band` those of the band before.
+    """
+    overlap, band = previous_band, []
+    for item, is_numbered in band_rows:
+        if is_numbered:
+            index = numbered.setdefault(item.slno, len(rows))
+        else:
+            index = next((index for index in overlap if _same_row(item, rows[index])), len(rows))
+            # The overlap ends at the first row the previous band did not read
+            overlap = overlap[overlap.index(index) + 1 :] if index in overlap else []
+            band.append(index)
+        if index == len(rows):
+            rows.append(item)
+        elif _row_detail(item) > _row_detail(rows[index]):
+            rows[index] = item
+    return band
+
+
+def stitch_row_bands(
+    text_content: str, metadata: Mapping[str, str | bool], band_outputs: list[str], page_no: int
+) -> tuple[str, dict] | None:
+    """
+    Structured text and metadata of a split page, the header call output with the line
+    items of the row bands in band order. A row read by two overlapping bands is kept as
+    read by the band seeing more of it: rows are matched on their printed serial number, rows
+    without one only against the rows of the previous band the overlap repeats, and numbered
+    by position. Returns None when an output does not parse.
+    """
+    header = parse_structured_text(text_content, str(page_no)).invoice
+    if header is None:
+        return None
+    rows: list[Item] = []
+    numbered: dict[int, int] = {}
+    unnumbered: set[int] = set()
+    previous_band: list[int] = []
+    for output in band_outputs:
+        band_rows = parse_numbered_item_rows(output)
+        if band_rows is None:
+            return None
+        previous_band = _add_band_rows(rows, numbered, previous_band, band_rows)
+        unnumbered.update(previous_band)
+    metadata = dict(metadata)
+    if not rows:
+        return None if metadata.get("line_items_present") is True else (text_content, metadata)
+    items = [
+        item.model_copy(update={"slno": index + 1}) if index in unnumbered else item for index, item in enumerate(rows)
+    ]
+    metadata["line_items_present"] = True
+    for key, item in (("line_item_start_number", items[0]), ("line_item_end_number", items[-1])):
+        if not str(metadata.get(key, "")).isdigit():
+            metadata[key] = str(item.slno)
+    return render_structured_text(header.model_copy(update={"items": items})), metadata
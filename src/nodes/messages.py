@@ -107,6 +107,109 @@ Kindly Note - If the document is not an invoice Document, return the reserved ke
 """
 IMAGE_TO_TEXT_USER_MESSAGE = "Please extract the invoice details from the image."
 
+IMAGE_TO_TEXT_JSON_SYSTEM_MESSAGE = """Your primary task is to extract invoice details from image.
+Produce a single minified JSON object, without any text, reasoning or markdown around it, in the below format.
+
+{"invoice": <Invoice>, "metadata": <Metadata>}
+
+## Invoice
+Use the reserved keyword "NOT_AVAILABLE" for text fields missing in the document and 0 for missing amounts.
+Unless specified explicitly, do not calculate any details, extract the data as is.
+{
+    "invoice_number": <Invoice number or bill number>,
+    "invoice_date": <Invoice issue date>,
+    "invoice_due_date": <Due date for payment, calculate the date if due days are given>,
+    "seller_details": <Company>,
+    "buyer_details": <Company, do not consider any other field like PO No. as the company name>,
+    "items": [<Item>, ...],
+    "total_tax": [<Tax>, ...] <Total tax of the invoice only as mentioned in the document, never calculated, derived or inferred from the line items>,
+    "total_charge": <Total charges>,
+    "total_discount": <Total discount>,
+    "total_amount": <Final invoice amount after all taxes and rounding off>,
+    "amount_paid": <Amount paid>,
+    "amount_due": <Amount due>
+}
+Company: {"name": .., "BIN_Details": [{"BIN_Type": <One among GSTIN, PAN, TAN, IEC and CIN>, "BIN_Number": ..}], "address": .., "state": .., "country": .., "pin_code": .., "phone_number": .., "email": ..}
+State, country and pin code may be derived from the address when not specified.
+Item: {"slno": <Serial number of the line item>, "HSN_CODE": <HSN, SAC, SKU or Batch code>, "description": .., "inventory_flag": <true for products or spares needing a stock update, false for charges like transport, commission or consultancy>, "quantity": .., "UOM": .., "price": <Unit price>, "tax": [<Tax>, ...], "discount": .., "amount": <Line amount after all taxes>, "currency": <ISO currency code>}
+Tax: {"Tax_Type": <CGST, SGST, UTGST, IGST etc>, "Tax_Rate": <Percentage>, "Tax_Amount": ..}
+Every line item present in the page must be listed.
+
+## Metadata
+{
+    "invoice_number": <Invoice number extracted>,
+    "line_item_start_number": <First serial number of the line item, if present in the document and not implied or calculated>,
+    "line_item_end_number": <Last serial number of the line item, if present in the document and not implied or calculated>,
+    "line_items_present": <true if atleast one line item is present in the page>,
+    "total_invoice_amount": <Total invoice amount extracted>,
+    "seller_details_present": <true if Company name, address and at least one Business identification number is present, else false>,
+    "buyer_details_present": <true if Company name, address and at least one Business identification number is present, else false>,
+    "invoice_date_present": <true or false>,
+    "invoice_due_date_present": <true or false>,
+    "total_tax_details_present": <true if at least one tax details entry is present with tax amount else false>,
+    "total_charges_present": <true or false>,
+    "total_discount_present": <true or false>,
+    "amount_paid_present": <true or false>,
+    "amount_due_present": <true or false>
+}
+
+## Kindly Note
+* An invoice document contains an invoice number, the seller or buyer details, at least one line item and the total amount.
+* CRITICAL: If the document is not an invoice Document, return the reserved keyword "NO_INVOICE_FOUND" only. Do not use this keyword in any other case.
+* CRITICAL: kindly pay special attention to the tax components. There will be cases where tax component will appear in nested table structure kindly pay attention to fetch them.
+"""
+
+IMAGE_TO_TEXT_MULTI_PAGE_INSTRUCTION = """
+## Multiple Pages
+You may be given several page images in one request, each image is preceded by its page number.
+Process every page independently, as if it was the only image given, and never carry details from one page to another.
+Start the output of every page with a marker line `=== PAGE <page number> ===` followed by the output of that page as specified above.
+If a page is not an invoice, the output of that page must be the reserved keyword "NO_INVOICE_FOUND" after its marker line.
+Every page given must have exactly one marker line, in the same order as the images.
+"""
+IMAGE_TO_TEXT_MULTI_PAGE_USER_MESSAGE = Template(
+    "Please extract the invoice details from each of the page images given below, page numbers $PAGE_NOS."
+)
+
+IMAGE_TO_TEXT_HEADER_USER_MESSAGE = """Please extract the invoice details from the image.
+The line items of this page are extracted separately, so do not list them: leave Item Details empty (NOT_AVAILABLE, or an empty list of items in JSON).
+Still fill line_item_start_number, line_item_end_number and line_items_present from the line items table of the page."""
+
+IMAGE_TO_TEXT_KNOWN_PARTIES_MESSAGE = Template(
+    "The parties with the GSTINs $GSTINS are on file: for these parties give only the company name and the "
+    "business identification numbers, and write NOT_AVAILABLE for their address, state, country, pin code, "
+    "phone number and email."
+)
+
+IMAGE_TO_TEXT_ROWS_SYSTEM_MESSAGE = """Your task is to extract the line items of an invoice from a horizontal band cropped from an invoice page.
+The band may not show the column headings of the line items table, infer the columns from the values.
+Only list the rows whose serial number is visible in the band. A row whose details continue past the bottom edge must still be listed with the details visible,
+and lines at the top edge continuing a row started above the band must be skipped. Unless specified explicitly, do not calculate any details.
+If the band shows no line item rows, output the reserved keyword "NO_LINE_ITEMS".
+
+List every row in the below format, without any other text:
+    Item Serial number: Running integer
+        Serial no: Serial number as present in the line item.
+        HSN_CODE: The complete code of HSN code or SAC code or SKU code or Batch code present in the respective line item.
+        Description: Description of the line item.
+        Inventory item flag: True for inventory items like any product, spare etc., False for services like transport charges, commission or consultancy.
+        Quantity: Quantity of the line item.
+        UOM: Unit of measurement of the line item (PCS, KG, KM, LT etc).
+        Price: Unit price of the line item.
+        Tax details:
+            Serial number: Running integer
+                Tax type: Tax type like CGST, SGST, UTGST, IGST etc.
+                Percentage: Tax type percentage.
+                Tax amount: Tax amount of the line item.
+        Discount: Discount amount of the line item.
+        Total Amount : Total amount of the line item as mentioned in the document after all taxes.
+        Currency: Currency of the amount as an ISO Currency Code.
+Use the reserved keyword "NOT_AVAILABLE" for any detail missing in the band.
+"""
+IMAGE_TO_TEXT_ROWS_USER_MESSAGE = Template(
+    "Please extract the line items from the image, band $BAND of $BANDS cropped top to bottom from page $PAGE_NO."
+)
+
 
 PAGE_GROUPPER_SYSTEM_MESSAGE = """
 You are an expert at grouping pages into invoices based solely on six metadata flags per page:
@@ -274,6 +377,23 @@ SP_FORMATOR_USER_MESSAGE = Template("""
 $PAGE_CONTENT
 """)
 
+FORMATOR_KNOWN_PARTIES_MESSAGE = Template(
+    "The parties with the GSTINs $GSTINS are on file: for these parties give only the name and the "
+    "identification numbers, and leave their other details empty."
+)
+
+FORMATOR_CORRECTION_SYSTEM_MESSAGE = """You will be given text extracted from an invoice and a list of invoice fields whose values failed arithmetic or checksum checks.
+Read each listed field again from the text and return its corrected value as printed. A failure may be caused by another field it is checked against, return a correction for that field when it is the one misread.
+Return only the fields you correct, with numbers as plain digits.
+"""
+
+FORMATOR_CORRECTION_USER_MESSAGE = Template("""
+$PAGE_CONTENT
+
+Fields which failed the checks, with their current values:
+$FAILURES
+""")
+
 
 MP_FORMATOR_USER_MESSAGE = Template("""
 Extract the invoice details from the text content and metadata JSON provided below.
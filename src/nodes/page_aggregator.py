@@ -1,18 +1,31 @@
 from asyncio.log import logger
-from collections.abc import Mapping
+from collections.abc import Mapping, Sequence
 from typing import Any
 
 from src.config import InvoiceParserConfig
-from src.output_format import Invoice
+from src.metrics import metrics
+from src.output_format import Invoice, MergeStrategy
+from src.tracing import trace_span
 
 
 class PageAggregator:
     def __init__(self, config: InvoiceParserConfig):
         self.merger_strategy = config.MERGER_STRATEGY
 
-    async def run(self, invoices: list[Invoice], merger_stratagy: Mapping[str, Any]) -> Invoice:
+    async def run(
+        self,
+        invoices: list[Invoice],
+        merger_stratagy: Mapping[str, Any],
+        pages: Sequence[tuple[int, Mapping[str, Any]]] | None = None,
+    ) -> Invoice:
         """
-        Process the image and return a text description.
+        Merge the invoices of the pages of one invoice group.
+
+        Args:
+            invoices: Invoice of each page of the group, in page order
+            merger_stratagy: Page hints of the page grouper for the group
+            pages: Page number and metadata of each invoice, the page number is read
+                from `Invoice.page_no` when not given
         """
         logger.info(f"merging {len(invoices)} invoices from Pages {[inv.page_no for inv in invoices]}")
         if not invoices:
@@ -20,23 +33,27 @@ class PageAggregator:
 
         if len(invoices) == 1:
             return invoices[0]
-        if self.merger_strategy == "classic":
-            merged_invoice = self._classic_merge(invoices)
-        elif self.merger_strategy == "smart":
-            merged_invoice = self._smart_merge(invoices)
-        elif self.merger_strategy == "strategy":
-            merged_invoice = self._merge_with_stratagy(invoices, merger_stratagy)
-        else:
-            raise ValueError(f"Unknown merger strategy: {self.merger_strategy}")
+        if pages is None:
+            pages = [(_page_number(invoice, index), {}) for index, invoice in enumerate(invoices, start=1)]
+        with trace_span("merge", "merge", pages=[inv.page_no for inv in invoices], strategy=self.merger_strategy):
+            if self.merger_strategy == "classic":
+                merged_invoice = self._classic_merge(invoices, line_item_order(invoices, pages))
+            elif self.merger_strategy == "smart":
+                merged_invoice = self._smart_merge(invoices, line_item_order(invoices, pages))
+            elif self.merger_strategy == "strategy":
+                merged_invoice = self._merge_with_stratagy(invoices, merger_stratagy, pages)
+            else:
+                raise ValueError(f"Unknown merger strategy: {self.merger_strategy}")
         return merged_invoice
 
-    def _classic_merge(self, invoices: list[Invoice]) -> Invoice:
+    def _classic_merge(self, invoices: list[Invoice], item_sources: list[Invoice] | None = None) -> Invoice:
         """
         Merge multiple invoice objects that belong to the same invoice number
         into a single consolidated invoice.
 
         Args:
             invoices: List of Invoice objects with the same invoice number
+            item_sources: The invoices in line item order, defaults to `invoices`
         Returns:
             A single merged Invoice object
         """
@@ -46,13 +63,9 @@ class PageAggregator:
         if len(invoices) == 1:
             return invoices[0]
 
-        merged_invoice = invoices[0]
-        for invoice in invoices[1:]:
-            merged_invoice = merged_invoice.merge_with(invoice)
+        return _count_duplicates(invoices, Invoice.merge_all(invoices, item_sources))
 
-        return merged_invoice
-
-    def _smart_merge(self, invoices: list["Invoice"]) -> "Invoice":
+    def _smart_merge(self, invoices: list["Invoice"], item_sources: list[Invoice] | None = None) -> "Invoice":
         """
         Smart merge that prioritizes invoices with more complete information.
         Invoices with more details get higher priority in merging.
@@ -63,22 +76,22 @@ class PageAggregator:
         if len(invoices) == 1:
             return invoices[0]
 
-        # Sort invoices by completeness (most complete first)
-        sorted_invoices = sorted(invoices, key=lambda x: x.count_available_details(), reverse=True)
-
-        # Start with the most complete invoice
-        result = sorted_invoices[0]
-
-        # Merge with others, preserving the priority of the more complete base
-        for invoice in sorted_invoices[1:]:
-            result = result.merge_with(invoice)
-
-        return result
-
-    def _merge_with_stratagy(self, invoices: list["Invoice"], merger_stratagy: Mapping[str, Any]) -> "Invoice":
+        # Sort invoices by completeness (most complete first), the most complete takes precedence.
+        # The invoices are scored once here, on their current fields, as they are copied and corrected upstream
+        sorted_invoices = sorted(invoices, key=Invoice.count_available_details, reverse=True)
+        return _count_duplicates(invoices, Invoice.merge_all(sorted_invoices, item_sources or invoices))
+
+    def _merge_with_stratagy(
+        self,
+        invoices: list["Invoice"],
+        merger_stratagy: Mapping[str, Any],
+        pages: Sequence[tuple[int, Mapping[str, Any]]] | None = None,
+    ) -> "Invoice":
         """
-        Smart merge that prioritizes invoices with more complete information.
-        Invoices with more details get higher priority in merging.
+        Field level merge following the page hints of the page grouper, each field is taken
+        from the page it is hinted on and the line items are concatenated from the line
+        item pages in `line_item_start_number` order. Fields without a usable hint fall back
+        to the first page having them, and groups without hints to the classic merge.
         """
         if not invoices:
             return Invoice()
@@ -86,4 +99,56 @@ class PageAggregator:
         if len(invoices) == 1:
             return invoices[0]
 
-        raise NotImplementedError(f"Smart merge with strategy {merger_stratagy} is not implemented yet.")
+        if pages is None:
+            pages = [(_page_number(invoice, index), {}) for index, invoice in enumerate(invoices, start=1)]
+        field_pages = MergeStrategy(details=merger_stratagy).field_pages()
+        if not field_pages:
+            logger.info("No page hints for the group, falling back to the classic merge")
+            return self._classic_merge(invoices, line_item_order(invoices, pages))
+
+        by_page = {page_no: invoice for (page_no, _), invoice in zip(pages, invoices, strict=True)}
+        if "items" in field_pages:
+            by_page_items = {page_no: by_page[page_no] for page_no in field_pages["items"] if page_no in by_page}
+        else:
+            by_page_items = by_page
+        field_sources = {
+            field: [by_page[page_no] for page_no in hinted if page_no in by_page]
+            for field, hinted in field_pages.items()
+        }
+        item_pages = [(page_no, metadata) for page_no, metadata in pages if page_no in by_page_items]
+        item_sources = line_item_order([by_page_items[page_no] for page_no, _ in item_pages], item_pages)
+        return _count_duplicates(item_sources, Invoice.merge_by_field(invoices, field_sources, item_sources))
+
+
+def _page_number(invoice: Invoice, default: int) -> int:
+    first = invoice.page_no.split("-", maxsplit=1)[0].strip()
+    return int(first) if first.isdigit() else default
+
+
+def _serial_number(metadata: Mapping[str, Any], key: str) -> int | None:
+    value = str(metadata.get(key, "")).strip()
+    return int(value) if value.isdigit() else None
+
+
+def line_item_order(invoices: Sequence[Invoice], pages: Sequence[tuple[int, Mapping[str, Any]]]) -> list[Invoice]:
+    """
+    Order the invoices of the pages of a group by the serial numbers of their line items,
+    `line_item_start_number` then `line_item_end_number` from the page metadata. The
+    invoices keep their page order when any page has no `line_item_start_number`.
+    """
+    keys = [
+        (_serial_number(metadata, "line_item_start_number"), _serial_number(metadata, "line_item_end_number") or 0)
+        for _, metadata in pages
+    ]
+    if any(start is None for start, _ in keys):
+        return list(invoices)
+    order = sorted(range(len(invoices)), key=lambda index: (*keys[index], pages[index][0]))
+    return [invoices[index] for index in order]
+
+
+def _count_duplicates(item_sources: Sequence[Invoice], merged: Invoice) -> Invoice:
+    dropped = sum(len(invoice.items) for invoice in item_sources) - len(merged.items)
+    if dropped > 0:
+        logger.info(f"Dropped {dropped} repeated line items while merging pages {merged.page_no}")
+        metrics.inc("merge_duplicate_items_total", dropped)
+    return merged
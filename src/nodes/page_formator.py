@@ -1,98 +1,383 @@
 import asyncio
 from asyncio.log import logger
+from dataclasses import dataclass, field
 from typing import Any
 
-from pydantic_ai import Agent, ModelRetry
+from pydantic_ai import Agent, ModelRetry, UnexpectedModelBehavior
 from pydantic_ai.agent import AgentRunResult
+from pydantic_ai.models import Model
+from pydantic_ai.usage import Usage
 
+from src.compact_format import CompactInvoice
 from src.config import InvoiceParserConfig
-from src.output_format import Invoice, TokenCount
-from src.utility import model_factory
+from src.hedging import RequestHedger
+from src.metrics import BYTES_BUCKETS, metrics
+from src.output_format import Invoice, InvoiceCorrections, TokenCount
+from src.parties import find_gstins, party_index
+from src.scheduler import stage_limiter
+from src.structured_text import parse_structured_text
+from src.tracing import trace_span
+from src.utility import cached_token_count, model_factory
+from src.validation import apply_corrections, check_invoice, field_value
 
 from .messages import (
+    FORMATOR_CORRECTION_SYSTEM_MESSAGE,
+    FORMATOR_CORRECTION_USER_MESSAGE,
+    FORMATOR_KNOWN_PARTIES_MESSAGE,
     MP_FORMATOR_SYSTEM_MESSAGE,
     MP_FORMATOR_USER_MESSAGE,
     SP_FORMATOR_SYSTEM_MESSAGE,
     SP_FORMATOR_USER_MESSAGE,
 )
 
+LOCAL_PARSER_NAME = "structured_text_parser"
+# Output validation retries of the formatter without an escalation model, a page failing them fails its document
+FORMATTER_RETRIES = 5
+
+
+def output_invoice(output: Invoice | CompactInvoice, page_no: str) -> Invoice:
+    """The Invoice of a formatter output, compact outputs are mapped back locally."""
+    return output.to_invoice(page_no) if isinstance(output, CompactInvoice) else output
+
+
+def _without_gstin(failures: dict[str, str]) -> dict[str, str]:
+    """Failures a model can correct, a GSTIN failing its checksum as read from the text is printed so."""
+    return {path: reason for path, reason in failures.items() if not path.endswith("BIN_Number")}
+
+
+@dataclass
+class FormatterAgents:
+    """Agents of a formatter run, the optional ones are None when disabled."""
+
+    formatter: Agent[None, Invoice | CompactInvoice]
+    escalation: Agent[None, Invoice | CompactInvoice] | None
+    correction: Agent[None, InvoiceCorrections] | None
+    hedge_model: Model | None
+
+
+@dataclass
+class FormatterPage:
+    """A page to format and the token expense of every call made for it, failed ones included."""
+
+    page_no: int
+    text_content: str
+    metadata: dict
+    t_counts: list[TokenCount] = field(default_factory=list)
+
 
 class SinglePageFormator:
+    """
+    Formats each page through a cascade, cheapest first: the local structured text parser,
+    then the formatter model, escalating to a larger model only when the output fails
+    `Invoice` validation or the arithmetic checks. Fields failing the arithmetic or GSTIN
+    checks are first asked for again with a short correction prompt. With
+    `OUTPUT_FORMATOR_SCHEMA=compact` the models answer in the short key `CompactInvoice` schema.
+    Parties on file in the party index are asked for by name and identification numbers only.
+    """
+
     def __init__(self, config: InvoiceParserConfig):
         self.model_name = config.OUTPUT_FORMATOR_MODEL
-        self.semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUEST)
+        self.semaphore = stage_limiter(
+            "output_formator", config.MAX_CONCURRENT_REQUEST, config.SCHEDULER_INTERACTIVE_BURST
+        )
+        self.prompt_cache = config.PROMPT_CACHE_ENABLED
+        self.hedger = RequestHedger(config)
+        self.hedge_model_name = config.OUTPUT_FORMATOR_HEDGE_MODEL
+        self.cascade = config.OUTPUT_FORMATOR_CASCADE
+        self.parser_confidence = config.OUTPUT_FORMATOR_PARSER_CONFIDENCE
+        self.escalation_model_name = config.OUTPUT_FORMATOR_ESCALATION_MODEL
+        self.retries = config.OUTPUT_FORMATOR_RETRIES or (1 if self.escalation_model_name else FORMATTER_RETRIES)
+        self.corrections = config.OUTPUT_FORMATOR_CORRECTIONS
+        self.output_type = CompactInvoice if config.OUTPUT_FORMATOR_SCHEMA == "compact" else Invoice
+        self.party_index = party_index(config)
+        # Token expense of a failed run, which returns no pages to carry it
+        self.error_token_counts: list[TokenCount] = []
 
-    async def run(
-        self, page_details: list[tuple[int, str, dict]]
-    ) -> tuple[list[tuple[int, Invoice, TokenCount]], str | None]:
-        """
-        Process the image and return a text description.
-        """
-        agent = Agent[None, Invoice](
-            model=model_factory(model_name=self.model_name, provider="openai"),
+    def _build_agent(self, model_name: str, retries: int) -> Agent[None, Invoice | CompactInvoice]:
+        agent = Agent[None, Invoice | CompactInvoice](
+            model=model_factory(model_name=model_name, provider="openai", prompt_cache=self.prompt_cache),
             system_prompt=SP_FORMATOR_SYSTEM_MESSAGE,
-            output_type=Invoice,
-            retries=5,
+            output_type=self.output_type,
+            retries=retries,
             model_settings={"temperature": 0},
         )
 
         @agent.output_validator
-        async def validate_output(result: Any) -> Invoice:
-            if isinstance(result, Invoice):
+        async def validate_output(result: Any) -> Invoice | CompactInvoice:
+            if isinstance(result, self.output_type):
                 return result
             raise ModelRetry("Final Result is not valid")
 
-        async def _run_agent(text_content: str, page_no: int) -> tuple[AgentRunResult[Invoice], int]:
-            async with self.semaphore:
-                input_msg = SP_FORMATOR_USER_MESSAGE.substitute(
-                    PAGE_CONTENT=text_content,
+        return agent
+
+    def _local_parse(self, text_content: str, page_no: int, metadata: dict, reconcile_totals: bool) -> Invoice | None:
+        parsed = parse_structured_text(text_content, page_no=str(page_no))
+        if parsed.invoice is None or parsed.confidence < self.parser_confidence:
+            logger.info(f"Page {page_no} parser confidence {parsed.confidence:.2f} - {'; '.join(parsed.issues)}")
+            return None
+        if metadata.get("line_items_present") and not parsed.invoice.items:
+            return None
+        if _without_gstin(check_invoice(parsed.invoice, complete=reconcile_totals)):
+            return None
+        return parsed.invoice
+
+    async def _correct(
+        self,
+        agent: Agent[None, InvoiceCorrections],
+        page: FormatterPage,
+        invoice: Invoice,
+        failures: dict[str, str],
+        usage: Usage,
+    ) -> Invoice:
+        """Ask the formatter model for the failing fields only and patch its answers into the invoice."""
+        page_no = page.page_no
+        input_msg = FORMATOR_CORRECTION_USER_MESSAGE.substitute(
+            PAGE_CONTENT=page.text_content,
+            FAILURES="\n".join(
+                f"- {path}: {field_value(invoice, path)} ({reason})" for path, reason in failures.items()
+            ),
+        )
+        request_bytes = len(FORMATOR_CORRECTION_SYSTEM_MESSAGE.encode()) + len(input_msg.encode())
+        async with self.semaphore:
+            metrics.observe("llm_request_bytes", request_bytes, bounds=BYTES_BUCKETS, stage="output_formator")
+            with (
+                metrics.timer("llm_request_seconds", model=self.model_name),
+                trace_span("correct", "llm", page=page_no, model=self.model_name),
+            ):
+                result = await agent.run(user_prompt=input_msg, usage=usage)
+        corrections = [(correction.field, correction.value) for correction in result.output.corrections]
+        corrected, applied = apply_corrections(invoice, corrections)
+        logger.info(f"Page {page_no} corrected {applied} of the failing fields {list(failures)}")
+        return corrected
+
+    def _build_correction_agent(self) -> Agent[None, InvoiceCorrections]:
+        return Agent[None, InvoiceCorrections](
+            model=model_factory(model_name=self.model_name, provider="openai", prompt_cache=self.prompt_cache),
+            system_prompt=FORMATOR_CORRECTION_SYSTEM_MESSAGE,
+            output_type=InvoiceCorrections,
+            retries=self.retries,
+            model_settings={"temperature": 0},
+        )
+
+    async def _format(
+        self,
+        agent: Agent[None, Invoice | CompactInvoice],
+        hedge_model: Model | None,
+        input_msg: str,
+        page_no: int,
+        usage: Usage,
+    ) -> tuple[AgentRunResult[Invoice | CompactInvoice], str]:
+        """Format a page with the formatter model, hedged with `hedge_model` when set, both calls adding to `usage`."""
+        request_bytes = len(SP_FORMATOR_SYSTEM_MESSAGE.encode()) + len(input_msg.encode())
+        async with self.semaphore:
+            metrics.observe("llm_request_bytes", request_bytes, bounds=BYTES_BUCKETS, stage="output_formator")
+            with trace_span("format", "llm", page=page_no, model=self.model_name):
+                return await self.hedger.run(
+                    self.model_name,
+                    lambda: agent.run(user_prompt=input_msg, usage=usage),
+                    (lambda: agent.run(user_prompt=input_msg, model=hedge_model, usage=usage)) if hedge_model else None,
+                    self.hedge_model_name,
                 )
-                result = await agent.run(user_prompt=input_msg)
-                return result, page_no
 
-        task_list = [_run_agent(text_content, page_no) for (page_no, text_content, _) in page_details]
+    async def _escalate(
+        self,
+        agent: Agent[None, Invoice | CompactInvoice],
+        input_msg: str,
+        page_no: int,
+        invoice: Invoice | None,
+        usage: Usage,
+    ) -> Invoice:
+        """
+        Format a page again with the escalation model. When the escalation call fails the
+        formatter model invoice is kept, pages without one fail.
+        """
+        request_bytes = len(SP_FORMATOR_SYSTEM_MESSAGE.encode()) + len(input_msg.encode())
         try:
-            agent_response = await asyncio.gather(*task_list)
+            async with self.semaphore:
+                metrics.observe("llm_request_bytes", request_bytes, bounds=BYTES_BUCKETS, stage="output_formator")
+                with (
+                    metrics.timer("llm_request_seconds", model=self.escalation_model_name),
+                    trace_span("format", "llm", page=page_no, model=self.escalation_model_name),
+                ):
+                    escalated = await agent.run(user_prompt=input_msg, usage=usage)
         except Exception as err:
-            logger.error(f"Error in SinglePageFormator Response - {err!s}")
-            return [], str(err)
-        outputs = []
-        for agent_res, page_no in agent_response:
-            token_expense = TokenCount(
-                model_name=self.model_name,
-                page_no=f"P{page_no}",
-                request_tokens=agent_res.usage().request_tokens or None,
-                response_tokens=agent_res.usage().response_tokens or None,
+            if invoice is None:
+                raise
+            logger.warning(f"Escalation of page {page_no} failed, keeping the {self.model_name} invoice - {err!s}")
+            metrics.inc("formatter_pages_total", path="model")
+            return invoice
+        metrics.inc("formatter_pages_total", path="escalated")
+        return output_invoice(escalated.output, str(page_no))
+
+    async def _known_parties_note(self, text_content: str) -> str:
+        """The instruction to give the parties on file by identification only, empty without any."""
+        if self.party_index is None:
+            return ""
+        known = await asyncio.to_thread(self.party_index.known_gstins, find_gstins(text_content))
+        return FORMATOR_KNOWN_PARTIES_MESSAGE.substitute(GSTINS=", ".join(known)) if known else ""
+
+    async def user_prompt(self, text_content: str) -> str:
+        """The formatter prompt of a page, asking for the parties on file by identification only."""
+        known_parties = await self._known_parties_note(text_content)
+        return SP_FORMATOR_USER_MESSAGE.substitute(PAGE_CONTENT=text_content) + known_parties
+
+    def accepts(self, invoice: Invoice, reconcile_totals: bool) -> bool:
+        """Whether a formatted `invoice` is kept as is, without a correction or escalation call."""
+        failures = check_invoice(invoice, complete=reconcile_totals)
+        if failures and self.corrections:
+            return False
+        escalates = bool(self.escalation_model_name) and self.escalation_model_name != self.model_name
+        return not (escalates and _without_gstin(failures))
+
+    @staticmethod
+    def _record_usage(page: FormatterPage, model_name: str, usage: Usage) -> None:
+        """Add the token expense of the calls behind `usage`, failed ones included, if any reached the model."""
+        if not usage.requests:
+            return
+        page.t_counts.append(
+            TokenCount(
+                model_name=model_name,
+                page_no=f"P{page.page_no}",
+                request_tokens=usage.request_tokens or None,
+                response_tokens=usage.response_tokens or None,
+                cached_tokens=cached_token_count(usage),
             )
-            outputs.append((page_no, agent_res.output, token_expense))
-        return outputs, None
+        )
+
+    def local_format(self, text_content: str, page_no: int, metadata: dict, reconcile_totals: bool) -> Invoice | None:
+        """The invoice of the structured text parser when the cascade is on and the page parses reliably."""
+        if not self.cascade:
+            return None
+        with trace_span("parse", "parse", page=page_no):
+            invoice = self._local_parse(text_content, page_no, metadata, reconcile_totals)
+        if invoice is not None:
+            logger.info(f"Page {page_no} formatted by the structured text parser")
+            metrics.inc("formatter_pages_total", path="local_parser")
+        return invoice
+
+    async def _format_page(
+        self, agents: FormatterAgents, page: FormatterPage, reconcile_totals: bool
+    ) -> tuple[int, Invoice, list[TokenCount]]:
+        page_no, text_content = page.page_no, page.text_content
+        invoice = self.local_format(text_content, page_no, page.metadata, reconcile_totals)
+        if invoice is not None:
+            page.t_counts.append(TokenCount(model_name=LOCAL_PARSER_NAME, page_no=f"P{page_no}"))
+            return page_no, invoice, page.t_counts
+        input_msg = await self.user_prompt(text_content)
+        usage, model_name = Usage(), self.model_name
+        try:
+            result, model_name = await self._format(agents.formatter, agents.hedge_model, input_msg, page_no, usage)
+        except UnexpectedModelBehavior as err:
+            if agents.escalation is None:
+                raise
+            logger.warning(f"Page {page_no} failed validation on {self.model_name} - {err!s}")
+            failures = {"output": str(err)}
+        else:
+            invoice = output_invoice(result.output, str(page_no))
+            failures = check_invoice(invoice, complete=reconcile_totals)
+        finally:
+            self._record_usage(page, model_name, usage)
+        if agents.correction is not None and invoice is not None and failures:
+            usage = Usage()
+            try:
+                invoice = await self._correct(agents.correction, page, invoice, failures, usage)
+            except Exception as err:
+                logger.warning(f"Correction of page {page_no} failed, keeping the uncorrected invoice - {err!s}")
+                metrics.inc("formatter_corrections_total", outcome="error")
+            else:
+                failures = check_invoice(invoice, complete=reconcile_totals)
+                metrics.inc("formatter_corrections_total", outcome="failed" if failures else "corrected")
+            finally:
+                self._record_usage(page, self.model_name, usage)
+        failures = _without_gstin(failures)
+        if invoice is not None and (not failures or agents.escalation is None):
+            metrics.inc("formatter_pages_total", path="model")
+            return page_no, invoice, page.t_counts
+        logger.info(f"Escalating page {page_no} to {self.escalation_model_name} - {'; '.join(failures)}")
+        usage = Usage()
+        try:
+            invoice = await self._escalate(agents.escalation, input_msg, page_no, invoice, usage)
+        finally:
+            self._record_usage(page, self.escalation_model_name or self.model_name, usage)
+        return page_no, invoice, page.t_counts
+
+    async def run(
+        self, page_details: list[tuple[int, str, dict]], reconcile_totals: bool = True
+    ) -> tuple[list[tuple[int, Invoice, list[TokenCount]]], str | None]:
+        """
+        Format the structured text of each page into an Invoice.
+
+        Args:
+            page_details: page number, structured text and metadata of the pages
+            reconcile_totals: Check the totals of the parsed invoice, only meaningful when
+                each page holds a complete invoice
+        Returns:
+            The Invoice of each page with the token expense of every call made for it, and an error if any
+        """
+        agents = FormatterAgents(
+            formatter=self._build_agent(self.model_name, self.retries),
+            escalation=(
+                self._build_agent(self.escalation_model_name, self.retries)
+                if self.escalation_model_name and self.escalation_model_name != self.model_name
+                else None
+            ),
+            correction=self._build_correction_agent() if self.corrections else None,
+            hedge_model=(
+                model_factory(model_name=self.hedge_model_name, provider="openai", prompt_cache=self.prompt_cache)
+                if self.hedge_model_name
+                else None
+            ),
+        )
+        pages = [FormatterPage(page_no, text_content, metadata) for (page_no, text_content, metadata) in page_details]
+        outputs = await asyncio.gather(
+            *(self._format_page(agents, page, reconcile_totals) for page in pages), return_exceptions=True
+        )
+        errors = [output for output in outputs if isinstance(output, BaseException)]
+        if errors:
+            logger.error(f"Error in SinglePageFormator Response - {errors[0]!s}")
+            self.error_token_counts = [t_count for page in pages for t_count in page.t_counts]
+            return [], str(errors[0])
+        return [output for output in outputs if not isinstance(output, BaseException)], None
 
 
 class MultiPageFormator:
     def __init__(self, config: InvoiceParserConfig):
         self.model_name = config.PAGE_GROUPPER_MODEL
-        self.semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUEST)
+        self.semaphore = stage_limiter(
+            "multi_page_formator", config.MAX_CONCURRENT_REQUEST, config.SCHEDULER_INTERACTIVE_BURST
+        )
+        self.prompt_cache = config.PROMPT_CACHE_ENABLED
+        self.output_type = CompactInvoice if config.OUTPUT_FORMATOR_SCHEMA == "compact" else Invoice
 
     async def run(self, page_details: list[tuple[str, dict, str]]) -> list[tuple[Invoice, TokenCount]]:
         """
         Process the image and return a text description.
         """
-        agent = Agent[None, Invoice](
-            model=model_factory(model_name=self.model_name, provider="openai"),
+        agent = Agent[None, Invoice | CompactInvoice](
+            model=model_factory(model_name=self.model_name, provider="openai", prompt_cache=self.prompt_cache),
             system_prompt=MP_FORMATOR_SYSTEM_MESSAGE,
-            output_type=Invoice,
+            output_type=self.output_type,
             retries=0,
             model_settings={"temperature": 0},
         )
 
-        async def run_agent(text_content: str, metadata: dict, page_no: str) -> tuple[AgentRunResult[Invoice], str]:
+        async def run_agent(
+            text_content: str, metadata: dict, page_no: str
+        ) -> tuple[AgentRunResult[Invoice | CompactInvoice], str]:
             async with self.semaphore:
                 logger.info(f"Image To Text Converter Agent Processing Page : {page_no} : {text_content}")
                 input_msg = MP_FORMATOR_USER_MESSAGE.substitute(
                     PAGE_CONTENT=text_content,
                     PAGE_METADATA=metadata,
                 )
-                result = await agent.run(user_prompt=input_msg)
+                metrics.observe(
+                    "llm_request_bytes", len(input_msg.encode()), bounds=BYTES_BUCKETS, stage="multi_page_formator"
+                )
+                with (
+                    metrics.timer("llm_request_seconds", model=self.model_name),
+                    trace_span("format", "llm", pages=page_no, model=self.model_name),
+                ):
+                    result = await agent.run(user_prompt=input_msg)
                 return result, page_no
 
         task_list = [run_agent(text_content, metadata, page_no) for (text_content, metadata, page_no) in page_details]
@@ -108,7 +393,8 @@ class MultiPageFormator:
                 page_no=page_no,
                 request_tokens=agent_res.usage().request_tokens or None,
                 response_tokens=agent_res.usage().response_tokens or None,
+                cached_tokens=cached_token_count(agent_res.usage()),
             )
 
-            outputs.append((agent_res.output, token_expense))
+            outputs.append((output_invoice(agent_res.output, page_no), token_expense))
         return outputs
@@ -6,37 +6,90 @@ from typing import Any, Mapping
 from pydantic_ai import Agent
 
 from src.config import InvoiceParserConfig
-from src.output_format import TokenCount
+from src.metrics import BYTES_BUCKETS, metrics
+from src.output_format import MERGE_HINT_FIELDS, MergeStrategy, TokenCount
+from src.scheduler import stage_limiter
+from src.tracing import trace_span
 from src.utility import (
+    cached_token_count,
     extract_json_from_text,
     model_factory,
 )
 
 from .messages import PAGE_GROUPPER_SYSTEM_MESSAGE, PAGE_GROUPPER_USER_MESSAGE
 
+NOT_AVAILABLE = "NOT_AVAILABLE"
+
 
 class PageGroupper:
+    """
+    Groups the invoice pages of a document into invoices. Documents longer than
+    `PAGE_GROUPPER_WINDOW_PAGES` are split into overlapping windows grouped concurrently,
+    each page is kept in the window it is furthest from the edge of, and the groups of
+    neighbouring windows are stitched by invoice number and line item continuity.
+    """
+
     def __init__(self, config: InvoiceParserConfig):
         self.model_name = config.PAGE_GROUPPER_MODEL
-        self.semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUEST)
+        self.semaphore = stage_limiter(
+            "page_groupper", config.MAX_CONCURRENT_REQUEST, config.SCHEDULER_INTERACTIVE_BURST
+        )
+        self.prompt_cache = config.PROMPT_CACHE_ENABLED
+        self.window_pages = config.PAGE_GROUPPER_WINDOW_PAGES
+        self.window_overlap = min(config.PAGE_GROUPPER_WINDOW_OVERLAP, config.PAGE_GROUPPER_WINDOW_PAGES - 1)
 
     async def run(
         self, page_metadata: Mapping[str, Any], page_no: str
     ) -> tuple[Mapping[str, Any], TokenCount, str | None]:
         """
-        Process the image and return a text description.
+        Group the pages by their metadata.
+
+        Returns:
+            The pages and page hints of each invoice, the token expense of all grouping calls
+            and an error if any
         """
         agent = Agent[None, str](
-            model=model_factory(model_name=self.model_name, provider="openai"),
+            model=model_factory(model_name=self.model_name, provider="openai", prompt_cache=self.prompt_cache),
             system_prompt=PAGE_GROUPPER_SYSTEM_MESSAGE,
             output_type=str,
             retries=0,
             model_settings={"temperature": 1},
         )
+        windows = self._windows(list(page_metadata))
+        if len(windows) == 1:
+            return await self._group(agent, page_metadata, page_no)
+
+        logger.info(f"Grouping {len(page_metadata)} pages in {len(windows)} windows of {self.window_pages} pages")
+        results = await asyncio.gather(
+            *(
+                self._group(agent, {page: page_metadata[page] for page in window}, "-".join(window))
+                for window in windows
+            )
+        )
+        t_count = _sum_token_counts(self.model_name, page_no, [t_count for _, t_count, _ in results])
+        errors = [error for _, _, error in results if error]
+        if errors:
+            return {}, t_count, "; ".join(errors)
+        return stitch_windows(windows, [groups for groups, _, _ in results], page_metadata), t_count, None
 
+    def _windows(self, pages: list[str]) -> list[list[str]]:
+        if len(pages) <= self.window_pages:
+            return [pages]
+        step = self.window_pages - self.window_overlap
+        return [pages[start : start + self.window_pages] for start in range(0, len(pages) - self.window_overlap, step)]
+
+    async def _group(
+        self, agent: Agent[None, str], page_metadata: Mapping[str, Any], page_no: str
+    ) -> tuple[Mapping[str, Any], TokenCount, str | None]:
         message = PAGE_GROUPPER_USER_MESSAGE.substitute(PAGE_METADATA=str(page_metadata))
+        metrics.observe("llm_request_bytes", len(message.encode()), bounds=BYTES_BUCKETS, stage="page_groupper")
         try:
-            agent_response = await agent.run(user_prompt=message)
+            async with self.semaphore:
+                with (
+                    metrics.timer("llm_request_seconds", model=self.model_name),
+                    trace_span("group", "llm", pages=page_no),
+                ):
+                    agent_response = await agent.run(user_prompt=message)
             if agent_response.output in [None, ""]:
                 logger.error(f"Page Groupper response is None for page {page_no}")
                 return {}, TokenCount(model_name=self.model_name, page_no=page_no), "PAge Groupper response is None"
@@ -51,5 +104,118 @@ class PageGroupper:
             page_no=page_no,
             request_tokens=agent_response.usage().request_tokens or None,
             response_tokens=agent_response.usage().response_tokens or None,
+            cached_tokens=cached_token_count(agent_response.usage()),
         )
         return page_group_info, token_expenditure, None
+
+
+def _sum_token_counts(model_name: str, page_no: str, t_counts: list[TokenCount]) -> TokenCount:
+    def total(values: list[int | None]) -> int | None:
+        return sum(value or 0 for value in values) or None
+
+    return TokenCount(
+        model_name=model_name,
+        page_no=page_no,
+        request_tokens=total([t_count.request_tokens for t_count in t_counts]),
+        response_tokens=total([t_count.response_tokens for t_count in t_counts]),
+        cached_tokens=total([t_count.cached_tokens for t_count in t_counts]),
+    )
+
+
+def _owned_pages(windows: list[list[str]]) -> list[set[int]]:
+    """Pages each window keeps, an overlapping page goes to the window it is furthest from the edge of."""
+    depth: dict[int, tuple[int, int]] = {}
+    for index, window in enumerate(windows):
+        for position, page in enumerate(window):
+            for page_index in MergeStrategy.page_numbers(page):
+                distance = min(position, len(window) - 1 - position)
+                if page_index not in depth or distance > depth[page_index][0]:
+                    depth[page_index] = (distance, index)
+    owned: list[set[int]] = [set() for _ in windows]
+    for page_index, (_, index) in depth.items():
+        owned[index].add(page_index)
+    return owned
+
+
+def _invoice_number(pages: list[int], page_metadata: Mapping[str, Any]) -> str | None:
+    for page_index in pages:
+        number = str(page_metadata.get(f"P{page_index}", {}).get("invoice_number", NOT_AVAILABLE)).strip()
+        if number and number.upper() != NOT_AVAILABLE:
+            return number.casefold()
+    return None
+
+
+def _serial_number(page_index: int, key: str, page_metadata: Mapping[str, Any]) -> int | None:
+    value = str(page_metadata.get(f"P{page_index}", {}).get(key, "")).strip()
+    return int(value) if value.isdigit() else None
+
+
+def _continues(previous: list[int], group: list[int], page_metadata: Mapping[str, Any]) -> bool:
+    """The group carries on the invoice of the previous group across a window boundary."""
+    number, previous_number = _invoice_number(group, page_metadata), _invoice_number(previous, page_metadata)
+    if number is not None and previous_number is not None:
+        return number == previous_number
+    if number is not None and _invoice_number(group[:1], page_metadata) is not None:
+        return False
+    end = _serial_number(previous[-1], "line_item_end_number", page_metadata)
+    start = _serial_number(group[0], "line_item_start_number", page_metadata)
+    return end is not None and start == end + 1
+
+
+def _merge_details(details: list[Mapping[str, Any]], pages: list[int]) -> dict[str, Any]:
+    """
+    Page hints of stitched groups, each field from the first hint pointing into the group.
+    A field is NOT_AVAILABLE only when the details of every window of the group say so, else
+    it is left out and the hints of the group stay incomplete.
+    """
+    merged: dict[str, Any] = {}
+    for key in MERGE_HINT_FIELDS:
+        hinted = [
+            page_index
+            for detail in details
+            for page_index in MergeStrategy.page_numbers(detail.get(key))
+            if page_index in pages
+        ]
+        if not hinted and not all(key in detail for detail in details):
+            continue
+        if key == "line_item_details":
+            merged[key] = [f"P{page_index}" for page_index in sorted(set(hinted))]
+        else:
+            merged[key] = f"P{hinted[0]}" if hinted else NOT_AVAILABLE
+    return merged
+
+
+def stitch_windows(
+    windows: list[list[str]], window_groups: list[Mapping[str, Any]], page_metadata: Mapping[str, Any]
+) -> dict[str, Any]:
+    """
+    Stitch the groups of overlapping windows into the groups of the whole document. Each
+    window keeps only the pages it owns, then the first group of a window is joined to
+    the last group of the previous window when it continues the same invoice.
+    """
+    stitched: list[tuple[str, list[int], list[Mapping[str, Any]]]] = []
+    for owned, groups in zip(_owned_pages(windows), window_groups, strict=True):
+        window_start = len(stitched)
+        for name, group in sorted(
+            groups.items(), key=lambda item: min(MergeStrategy.page_numbers(item[1].get("pages", [])), default=0)
+        ):
+            pages = sorted({page for page in MergeStrategy.page_numbers(group.get("pages", [])) if page in owned})
+            if not pages:
+                continue
+            details = group.get("details", {})
+            if len(stitched) == window_start and stitched and _continues(stitched[-1][1], pages, page_metadata):
+                previous_name, previous_pages, previous_details = stitched[-1]
+                stitched[-1] = (previous_name, sorted({*previous_pages, *pages}), [*previous_details, details])
+            else:
+                stitched.append((name, pages, [details]))
+
+    result: dict[str, Any] = {}
+    for name, pages, details in stitched:
+        key, count = name, 1
+        while key in result:
+            count += 1
+            key = f"{name}_{count}"
+        result[key] = {"pages": [f"P{page_index}" for page_index in pages]}
+        if any(details):
+            result[key]["details"] = _merge_details(details, pages)
+    return result
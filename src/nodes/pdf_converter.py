@@ -0,0 +1,14 @@
+from src.config import InvoiceParserConfig
+
+from .pdfium_pdf_2_img import Pdf2ImgConverter as PdfiumPdf2ImgConverter
+from .poppler_pdf_2_img import Pdf2ImgConverter as PopplerPdf2ImgConverter
+
+
+def pdf_converter_factory(config: InvoiceParserConfig) -> PdfiumPdf2ImgConverter | PopplerPdf2ImgConverter:
+    """
+    Create the PDF to image converter selected by `PDF_RENDERER`, pdfium needs no
+    poppler binaries on the host.
+    """
+    if config.PDF_RENDERER == "pdfium":
+        return PdfiumPdf2ImgConverter(config)
+    return PopplerPdf2ImgConverter(config)
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 from pathlib import Path
 from typing import TYPE_CHECKING
 
@@ -7,13 +8,21 @@ import pypdfium2 as pdfium
 from pypdfium2._helpers import PdfBitmap
 
 from src.config import InvoiceParserConfig
-from src.utility import async_range
+from src.memory import POINTS_PER_INCH, DocumentMemoryGuard, RenderPlan, page_render_bytes, plan_render
+from src.metrics import metrics
+from src.preprocess import PagePreprocessor
+from src.tracing import trace_span
+from src.utility import async_range, pdfium_lock
 
 if TYPE_CHECKING:
     from PIL.Image import Image
 
 logger = logging.getLogger("asyncio")
 
+RENDER_SCALE = 8.4
+# Render scale factor applied when the memory ceiling is hit while rendering
+RENDER_SCALE_STEP = 0.75
+
 
 class Pdf2ImgConverter:
     def __init__(self, cfg: InvoiceParserConfig) -> None:
@@ -24,6 +33,10 @@ class Pdf2ImgConverter:
         self.max_height: int = cfg.MAX_IMG_HEIGHT
         self.batch_size: int = cfg.MAX_CONCURRENT_REQUEST
         self.save_format: str = cfg.IMG_SAVE_FORMAT
+        self.config = cfg
+        self.memory_ceiling: int | None = cfg.MEMORY_CEILING_MB
+        self.min_scale: float = cfg.MIN_RENDER_DPI / POINTS_PER_INCH
+        self.preprocessor = PagePreprocessor(cfg)
 
     @property
     def resize_ops_enabled(self) -> bool:
@@ -33,7 +46,15 @@ class Pdf2ImgConverter:
         self, page_bitmap: PdfBitmap, page_index: int, output_folder: Path
     ) -> tuple[int, Path, tuple[int, int]]:
         def process_and_save() -> tuple[int, Path, tuple[int, int]]:
-            pil_image: Image = page_bitmap.to_pil()
+            with metrics.timer("page_save_seconds"), trace_span("encode", "render", page=page_index):
+                return _process_and_save()
+
+        def _process_and_save() -> tuple[int, Path, tuple[int, int]]:
+            pil_image: Image = (
+                self.preprocessor.run(page_bitmap.to_numpy(), page_bitmap.mode, page_index)
+                if self.preprocessor.enabled
+                else page_bitmap.to_pil()
+            )
             save_format_ = "PNG" if self.save_format == "png" else self.save_format
             save_path = output_folder / f"Page_{page_index:04}.png"
             if not self.resize_ops_enabled:
@@ -60,7 +81,11 @@ class Pdf2ImgConverter:
                     pil_image.save(save_path, save_format_)
             return page_index, save_path, new_image.size
 
-        return await asyncio.to_thread(process_and_save)
+        try:
+            return await asyncio.to_thread(process_and_save)
+        finally:
+            with pdfium_lock:
+                page_bitmap.close()
 
     def _resolve_conflict(self, subfolder: str) -> str:
         if not (self.output_path / Path(subfolder)).exists():
@@ -71,6 +96,18 @@ class Pdf2ImgConverter:
             if not (self.output_path / Path(f"{subfolder}_{count}")).exists():
                 return f"{subfolder}_{count}"
 
+    def _plan_render(self, filename: str, page_sizes: list[tuple[float, float]]) -> RenderPlan:
+        """Render scale and pages in flight keeping the document under the memory ceiling."""
+        plan = plan_render(page_sizes, RENDER_SCALE, self.batch_size, self.config)
+        for action in plan.degradations:
+            metrics.inc("memory_degradations_total", renderer="pdfium", action=action)
+        if plan.degradations:
+            logger.warning(
+                f"Rendering {filename} at scale {plan.scale:.2f} with {plan.pages_in_flight} pages in flight "
+                f"to stay under {self.memory_ceiling} MB"
+            )
+        return plan
+
     async def run(self, pdf_path: str | Path) -> tuple[Path, list[tuple[int, Path, tuple[int, int]]]]:
         if not Path(pdf_path).exists():  # type: ignore[reportOptionalMemberAccess]
             logger.info(f"PDF file {pdf_path} does not exist.")
@@ -80,23 +117,46 @@ class Pdf2ImgConverter:
         output_folder = self.output_path / Path(filename)
         output_folder.mkdir(parents=True, exist_ok=True)
         logger.info(f"Output Folder {output_folder} ")
-        pdf_doc = pdfium.PdfDocument(pdf_path)
-        page_count = len(pdf_doc)
+        # Text layers of other documents are read in worker threads, pdfium calls hold the pdfium lock
+        with pdfium_lock:
+            pdf_doc = pdfium.PdfDocument(pdf_path)
+            page_count = len(pdf_doc)
+            page_sizes = [pdf_doc.get_page_size(page_index) for page_index in range(page_count)]
         logger.info(f"Pdf Document Page count {page_count} ")
 
+        plan = self._plan_render(filename, page_sizes)
+        guard = DocumentMemoryGuard(self.memory_ceiling)
+
         results = []
         try:
             tasks = []
             async for page_index in async_range(page_count):
+                page_bytes = page_render_bytes(page_sizes[page_index], plan.scale)
+                if guard.exceeded(page_bytes):
+                    # Release the pages in flight before rendering more, then lower the scale if still over
+                    if tasks:
+                        results.extend(await asyncio.gather(*tasks))
+                        tasks = []
+                        metrics.inc("memory_degradations_total", renderer="pdfium", action="flush")
+                    if guard.exceeded(page_bytes) and plan.scale > self.min_scale:
+                        plan.scale = max(plan.scale * RENDER_SCALE_STEP, self.min_scale)
+                        metrics.inc("memory_degradations_total", renderer="pdfium", action="render_scale")
+                        logger.warning(f"Memory ceiling reached, rendering {filename} at scale {plan.scale:.2f}")
+                start = time.perf_counter()
+                with trace_span("render", "render", page=page_index + 1), pdfium_lock:
+                    page = pdf_doc[page_index]
+                    page_bitmap = page.render(scale=plan.scale, rotation=0)  # type: ignore
+                    page.close()
+                metrics.observe("page_render_seconds", time.perf_counter() - start, renderer="pdfium")
                 tasks.append(
                     self._convert_to_image_and_save(
-                        pdf_doc[page_index].render(scale=8.4, rotation=0),  # type: ignore
+                        page_bitmap,
                         page_index + 1,
                         output_folder,
                     )
                 )
                 # Process in smaller batches to avoid memory issues
-                if len(tasks) >= self.batch_size:  # Adjust batch size as needed
+                if len(tasks) >= plan.pages_in_flight:
                     output_t = await asyncio.gather(*tasks)
                     results.extend(output_t)
                     tasks = []
@@ -107,4 +167,7 @@ class Pdf2ImgConverter:
                 tasks = []
         except Exception as e:
             logger.error(f"Error While Processing Pdf str{e}")
+        finally:
+            with pdfium_lock:
+                pdf_doc.close()
         return output_folder, results
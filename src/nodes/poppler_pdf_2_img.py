@@ -1,5 +1,8 @@
+import contextvars
 import logging
 import os
+import re
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
@@ -7,6 +10,10 @@ from pdf2image import convert_from_path
 from PIL.Image import Image
 
 from src.config import InvoiceParserConfig
+from src.memory import A4_PAGE_SIZE, POINTS_PER_INCH, plan_render
+from src.metrics import metrics
+from src.preprocess import PagePreprocessor
+from src.tracing import trace_span
 
 logger = logging.getLogger("asyncio")
 
@@ -22,28 +29,45 @@ class Pdf2ImgConverter:
         self.batch_size: int = cfg.MAX_CONCURRENT_REQUEST
         self.save_format: str = cfg.IMG_SAVE_FORMAT
         self.dpi: int = 600  # Lower DPI for faster processing
+        self.config = cfg
+        self.memory_ceiling: int | None = cfg.MEMORY_CEILING_MB
+        self.preprocessor = PagePreprocessor(cfg)
 
     @property
     def resize_ops_enabled(self) -> bool:
         return self.max_width > 0 and self.max_height > 0
 
-    def _convert_pdf_pages(self, pdf_path: str | Path, first_page: int, last_page: int) -> list[Image]:
+    def _convert_pdf_pages(self, pdf_path: str | Path, first_page: int, last_page: int, dpi: int) -> list[Image]:
         """Convert a range of PDF pages to images"""
         format_ = "png" if self.save_format == "png" else self.save_format
-        return convert_from_path(
-            pdf_path,
-            dpi=self.dpi,
-            poppler_path=self.poppler_path,
-            fmt=format_,
-            first_page=first_page,
-            last_page=last_page,
-            thread_count=last_page - first_page + 1,  # Enable multithreading in poppler
-        )
+        start = time.perf_counter()
+        with trace_span("render", "render", pages=list(range(first_page, last_page + 1))):
+            images = convert_from_path(
+                pdf_path,
+                dpi=dpi,
+                poppler_path=self.poppler_path,
+                fmt=format_,
+                first_page=first_page,
+                last_page=last_page,
+                thread_count=last_page - first_page + 1,  # Enable multithreading in poppler
+            )
+        elapsed = time.perf_counter() - start
+        for _ in images:
+            metrics.observe("page_render_seconds", elapsed / len(images), renderer="poppler")
+        return images
 
     def _process_and_save_image(
         self, image: Image, page_index: int, output_path: Path
     ) -> tuple[int, Path, tuple[int, int]]:
         """Process and save an image, with optional resizing"""
+        with metrics.timer("page_save_seconds"), trace_span("encode", "render", page=page_index):
+            if self.preprocessor.enabled:
+                image = self.preprocessor.run_image(image, page_index)
+            return self._resize_and_save_image(image, page_index, output_path)
+
+    def _resize_and_save_image(
+        self, image: Image, page_index: int, output_path: Path
+    ) -> tuple[int, Path, tuple[int, int]]:
         width, height = image.size
         save_format_ = "PNG" if self.save_format == "png" else self.save_format
 
@@ -87,12 +111,14 @@ class Pdf2ImgConverter:
             if not (self.output_path / Path(f"{subfolder}_{count}")).exists():
                 return f"{subfolder}_{count}"
 
-    def _get_pdf_page_count(self, pdf_path: str | Path) -> int:
-        """Get the number of pages in a PDF file"""
+    def _get_pdf_info(self, pdf_path: str | Path) -> tuple[int, tuple[float, float]]:
+        """Get the number of pages and the page size in points of a PDF file"""
         from pdf2image.pdf2image import pdfinfo_from_path
 
         info = pdfinfo_from_path(str(pdf_path), poppler_path=str(self.poppler_path))
-        return info["Pages"]
+        match = re.search(r"([\d.]+) x ([\d.]+)", str(info.get("Page size", "")))
+        page_size = (float(match.group(1)), float(match.group(2))) if match else A4_PAGE_SIZE
+        return info["Pages"], page_size
 
     async def run(self, pdf_path: str | Path) -> tuple[Path, list[tuple[int, Path, tuple[int, int]]]]:
         """Convert PDF to images using ThreadPoolExecutor for parallel processing"""
@@ -103,21 +129,43 @@ class Pdf2ImgConverter:
         output_folder = self.output_path / Path(filename)
         output_folder.mkdir(parents=True, exist_ok=True)
         logger.info(f"Output Folder {output_folder}")
-        page_count = self._get_pdf_page_count(pdf_path)
+        page_count, page_size = self._get_pdf_info(pdf_path)
         logger.info(f"PDF has {page_count} pages")
         format_ = "png" if self.save_format == "png" else self.save_format
         results = []
         max_workers_ = os.cpu_count() or 4
-        batch_size = self._calculate_batch_size(page_count, max_workers_)
-        with ThreadPoolExecutor(max_workers=max_workers_) as executor:
-            batch_futures = {}
-            for start_page in range(1, page_count + 1, batch_size):
-                end_page = min(start_page + batch_size - 1, page_count)
-                future = executor.submit(self._convert_pdf_pages, pdf_path, start_page, end_page)
-                batch_futures[future] = (start_page, end_page)
-            image_futures = []
-            self._process_batch_conversions(executor, batch_futures, image_futures, output_folder, format_)
-            self._collect_image_results(image_futures, results)
+        plan = plan_render([page_size], self.dpi / POINTS_PER_INCH, page_count, self.config)
+        for action in plan.degradations:
+            metrics.inc("memory_degradations_total", renderer="poppler", action=action)
+        if plan.degradations:
+            logger.warning(
+                f"Rendering {filename} at {plan.dpi} DPI with {plan.pages_in_flight} pages in flight "
+                f"to stay under {self.memory_ceiling} MB"
+            )
+        # Pages are converted in windows of `pages_in_flight` so the rendered images of a window are saved
+        # and released before the next one is rendered
+        window = plan.pages_in_flight
+        batch_size = min(self._calculate_batch_size(page_count, max_workers_), window)
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers_, window) if plan.degradations else max_workers_
+        ) as executor:
+            for window_start in range(1, page_count + 1, window):
+                window_end = min(window_start + window - 1, page_count)
+                batch_futures = {}
+                for start_page in range(window_start, window_end + 1, batch_size):
+                    end_page = min(start_page + batch_size - 1, window_end)
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        self._convert_pdf_pages,
+                        pdf_path,
+                        start_page,
+                        end_page,
+                        plan.dpi,
+                    )
+                    batch_futures[future] = (start_page, end_page)
+                image_futures = []
+                self._process_batch_conversions(executor, batch_futures, image_futures, output_folder, format_)
+                self._collect_image_results(image_futures, results)
         results.sort(key=lambda x: x[0])
         return output_folder, results
 
@@ -154,7 +202,9 @@ class Pdf2ImgConverter:
                 for page_index, image in enumerate(images, start=start_page):
                     # page_index = start_page + i
                     img_path = output_folder / f"Page_{page_index:04}.{format_}"
-                    page_future = executor.submit(self._process_and_save_image, image, page_index, img_path)
+                    page_future = executor.submit(
+                        contextvars.copy_context().run, self._process_and_save_image, image, page_index, img_path
+                    )
                     image_futures.append(page_future)
             except Exception as e:  # noqa: PERF203
                 logger.error(f"Error processing batch: {e!s}")
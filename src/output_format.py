@@ -1,8 +1,64 @@
-from collections.abc import Mapping
-from typing import Any
+import re
+from collections.abc import Iterable, Mapping, Sequence
+from typing import Any, Protocol, TypeVar
 
 from pydantic import BaseModel, Field, PositiveInt
 
+NOT_AVAILABLE = "NOT_AVAILABLE"
+_COMPANY_TEXT_FIELDS = ("name", "address", "state", "country", "pin_code", "phone_number", "email")
+_INVOICE_TEXT_FIELDS = ("invoice_number", "invoice_date", "invoice_due_date")
+_INVOICE_AMOUNT_FIELDS = ("total_charge", "total_discount", "total_amount", "amount_paid", "amount_due")
+# Keys of the page grouper details and the Invoice field each of them points to
+MERGE_HINT_FIELDS = {
+    "invoice_number": "invoice_number",
+    "invoice_date": "invoice_date",
+    "invoice_due_date": "invoice_due_date",
+    "seller_details": "seller_details",
+    "buyer_details": "buyer_details",
+    "line_item_details": "items",
+    "total_tax_details": "total_tax",
+    "total_charges": "total_charge",
+    "total_discount": "total_discount",
+    "total_invoice_amount": "total_amount",
+    "amount_paid": "amount_paid",
+    "amount_due": "amount_due",
+}
+
+
+class _HasDedupeKey(Protocol):
+    @property
+    def dedupe_key(self) -> tuple: ...
+
+
+_Keyed = TypeVar("_Keyed", bound=_HasDedupeKey)
+
+
+def _first_available(values: Iterable[str]) -> str:
+    return next((value for value in values if value.upper() != NOT_AVAILABLE), NOT_AVAILABLE)
+
+
+def _first_non_zero(values: Iterable[float]) -> float:
+    return next((value for value in values if value != 0.0), 0.0)
+
+
+def _normalized_text(value: str) -> str:
+    return " ".join(re.findall(r"\w+", value.casefold()))
+
+
+def _unique(entries: Iterable[_Keyed]) -> list[_Keyed]:
+    """Drop repeated entries in one pass over a hashed index of their keys, first one wins."""
+    index: dict[tuple, _Keyed] = {}
+    for entry in entries:
+        index.setdefault(entry.dedupe_key, entry)
+    return list(index.values())
+
+
+def _merge_page_nos(invoices: Sequence["Invoice"]) -> str:
+    page_nos = [invoice.page_no for invoice in invoices if invoice.page_no]
+    if len(page_nos) == 1:
+        return page_nos[0]
+    return "-".join(sorted({p.strip() for page_no in page_nos for p in page_no.split("-")}))
+
 
 class TaxComponents(BaseModel):
     """
@@ -20,6 +76,11 @@ class TaxComponents(BaseModel):
     def is_empty(self) -> bool:
         return self.Tax_Type == "NOT_AVAILABLE" and self.Tax_Rate == 0.0 and self.Tax_Amount == 0.0
 
+    @property
+    def dedupe_key(self) -> tuple[str, float, float]:
+        """Normalized key of the tax, equal for a tax repeated on several pages."""
+        return _normalized_text(self.Tax_Type), round(self.Tax_Rate, 2), round(self.Tax_Amount, 2)
+
 
 class Item(BaseModel):
     """
@@ -48,6 +109,11 @@ class Item(BaseModel):
     def is_empty(self) -> bool:
         return self.description == "NOT_AVAILABLE" and self.quantity == "NOT_AVAILABLE" and self.price == 0.0
 
+    @property
+    def dedupe_key(self) -> tuple[int, str, float]:
+        """Normalized key of the item, equal for an item read twice from overlapping pages."""
+        return self.slno, _normalized_text(self.description), round(self.amount, 2)
+
 
 class BusinessIdNumber(BaseModel):
     """
@@ -135,39 +201,22 @@ class CompanyDetails(BaseModel):
         """
         if not isinstance(other, CompanyDetails):
             raise TypeError("Can only merge with another CompanyDetails object")
+        return CompanyDetails.merge_all([self, other])
 
-        # Helper function to choose the best value
-        def choose_best_value(self_val: str, other_val: str) -> str:
-            if self_val.upper() != "NOT_AVAILABLE":
-                return self_val
-            if other_val.upper() != "NOT_AVAILABLE":
-                return other_val
-            return "NOT_AVAILABLE"
-
-        # Merge BIN details - combine unique entries
-        merged_bins = []
-        all_bins = list(self.BIN_Details) + list(other.BIN_Details)
-
-        # Use a dict to track unique BIN types and keep the best version
-        bin_dict = {}
-        for bin_item in all_bins:
-            if not bin_item.is_empty:
-                bin_type = bin_item.BIN_Type
-                if bin_type not in bin_dict or bin_item in self.BIN_Details:
-                    bin_dict[bin_type] = bin_item
-
-        merged_bins = list(bin_dict.values())
-
-        # Create merged company
-        return CompanyDetails(
-            name=choose_best_value(self.name, other.name),
-            address=choose_best_value(self.address, other.address),
-            state=choose_best_value(self.state, other.state),
-            country=choose_best_value(self.country, other.country),
-            pin_code=choose_best_value(self.pin_code, other.pin_code),
-            phone_number=choose_best_value(self.phone_number, other.phone_number),
-            email=choose_best_value(self.email, other.email),
-            BIN_Details=merged_bins,
+    @classmethod
+    def merge_all(cls, companies: Sequence["CompanyDetails"]) -> "CompanyDetails":
+        """
+        Merge any number of CompanyDetails in one pass, earlier entries take precedence.
+        BIN details are unique by BIN type, the first entry carrying a type wins.
+        """
+        bin_dict: dict[str, BusinessIdNumber] = {}
+        for company in companies:
+            for bin_item in company.BIN_Details:
+                if not bin_item.is_empty:
+                    bin_dict.setdefault(bin_item.BIN_Type, bin_item)
+        return cls.model_construct(
+            **{field: _first_available(getattr(c, field) for c in companies) for field in _COMPANY_TEXT_FIELDS},
+            BIN_Details=list(bin_dict.values()),
         )
 
 
@@ -258,59 +307,63 @@ class Invoice(BaseModel):
         """
         if not isinstance(other, Invoice):
             raise TypeError("Can only merge with another Invoice object")
+        return Invoice.merge_all([self, other])
 
-        def choose_best_value(self_val: str, other_val: str, default: str = "NOT_AVAILABLE") -> str:
-            if self_val.upper() != default.upper():
-                return self_val
-            if other_val.upper() != default.upper():
-                return other_val
-            return default
-
-        def choose_best_amount(self_val: float, other_val: float) -> float:
-            """For amount fields, prefer non-zero values with self having priority."""
-            if self_val != 0.0:
-                return self_val
-            if other_val != 0.0:
-                return other_val
-            return 0.0
-
-        # Merge items - collect all unique items by slno
-        merged_items = list(self.items) + list(other.items)
-
-        # Merge total tax components
-        merged_total_tax = list(self.total_tax) + list(other.total_tax)
-
-        # Merge page numbers
-        def merge_page_numbers(page1: str, page2: str) -> str:
-            if not page1 and not page2:
-                return ""
-            if not page1:
-                return page2
-            if not page2:
-                return page1
-            # Combine page ranges
-            pages1 = page1.split("-") if page1 else []
-            pages2 = page2.split("-") if page2 else []
-
-            # Convert to integers for proper handling, then back to strings
-            all_pages = sorted({p.strip() for p in pages1 + pages2})
-            return "-".join(all_pages)
-
-        # Create merged invoice
-        return Invoice(
-            invoice_number=choose_best_value(self.invoice_number, other.invoice_number, "NOT_AVAILABLE"),
-            invoice_date=choose_best_value(self.invoice_date, other.invoice_date, "NOT_AVAILABLE"),
-            invoice_due_date=choose_best_value(self.invoice_due_date, other.invoice_due_date, "NOT_AVAILABLE"),
-            seller_details=self.seller_details.merge_with(other.seller_details),
-            buyer_details=self.buyer_details.merge_with(other.buyer_details),
-            items=merged_items,
-            total_tax=merged_total_tax,
-            total_charge=choose_best_amount(self.total_charge, other.total_charge),
-            total_discount=choose_best_amount(self.total_discount, other.total_discount),
-            total_amount=choose_best_amount(self.total_amount, other.total_amount),
-            amount_paid=choose_best_amount(self.amount_paid, other.amount_paid),
-            amount_due=choose_best_amount(self.amount_due, other.amount_due),
-            page_no=merge_page_numbers(self.page_no, other.page_no),
+    @classmethod
+    def merge_all(cls, invoices: Sequence["Invoice"], item_sources: Sequence["Invoice"] | None = None) -> "Invoice":
+        """
+        K-way merge of the invoices of a page group, building the result once instead of
+        an intermediate Invoice per pairwise merge. Earlier invoices take precedence for
+        header and amount fields. Items are concatenated in `item_sources` order, defaulting
+        to `invoices`, and taxes in `invoices` order, both without repeated entries. The
+        parts were validated when each page was formatted, so the result skips validation.
+        """
+        return cls.model_construct(
+            **{field: _first_available(getattr(inv, field) for inv in invoices) for field in _INVOICE_TEXT_FIELDS},
+            **{field: _first_non_zero(getattr(inv, field) for inv in invoices) for field in _INVOICE_AMOUNT_FIELDS},
+            seller_details=CompanyDetails.merge_all([invoice.seller_details for invoice in invoices]),
+            buyer_details=CompanyDetails.merge_all([invoice.buyer_details for invoice in invoices]),
+            items=_unique(item for invoice in item_sources or invoices for item in invoice.items),
+            total_tax=_unique(tax for invoice in invoices for tax in invoice.total_tax),
+            page_no=_merge_page_nos(invoices),
+        )
+
+    @classmethod
+    def merge_by_field(
+        cls,
+        invoices: Sequence["Invoice"],
+        field_sources: Mapping[str, Sequence["Invoice"]],
+        item_sources: Sequence["Invoice"],
+    ) -> "Invoice":
+        """
+        Build the invoice of a page group field by field instead of merging whole pages.
+        Each field is taken from the first of its `field_sources` having it, falling back to
+        `invoices` in order. Items are concatenated from `item_sources` in the order given,
+        without repeated items.
+        """
+
+        def candidates(field: str) -> Iterable[Invoice]:
+            yield from field_sources.get(field, ())
+            yield from invoices
+
+        def first_company(field: str) -> CompanyDetails:
+            companies = (getattr(invoice, field) for invoice in candidates(field))
+            return next((company for company in companies if not company.is_empty), CompanyDetails())
+
+        return cls.model_construct(
+            **{
+                field: _first_available(getattr(inv, field) for inv in candidates(field))
+                for field in _INVOICE_TEXT_FIELDS
+            },
+            **{
+                field: _first_non_zero(getattr(inv, field) for inv in candidates(field))
+                for field in _INVOICE_AMOUNT_FIELDS
+            },
+            seller_details=first_company("seller_details"),
+            buyer_details=first_company("buyer_details"),
+            items=_unique(item for invoice in item_sources for item in invoice.items),
+            total_tax=next((list(inv.total_tax) for inv in candidates("total_tax") if inv.total_tax), []),
+            page_no=_merge_page_nos(invoices),
         )
 
     def __gt__(self, other: "Invoice") -> bool:
@@ -320,11 +373,29 @@ class Invoice(BaseModel):
         return self.count_available_details() > other.count_available_details()
 
 
+class FieldCorrection(BaseModel):
+    """
+    Corrected value of one field of an invoice.
+    """
+
+    field: str = Field(description="Path of the field as listed, e.g. items[2].amount")
+    value: str = Field(description="Corrected value as printed in the text")
+
+
+class InvoiceCorrections(BaseModel):
+    """
+    Corrected values of the invoice fields which failed the checks.
+    """
+
+    corrections: list[FieldCorrection] = Field(default_factory=list)
+
+
 class TokenCount(BaseModel):
     model_name: str
     page_no: str
     request_tokens: int | None = Field(default=None)
     response_tokens: int | None = Field(default=None)
+    cached_tokens: int | None = Field(default=None)
 
 
 class InvoiceData(BaseModel):
@@ -362,3 +433,32 @@ class MergeStrategy(BaseModel):
         default_factory=dict,
         description="Details of which page to get each field from",
     )
+
+    @staticmethod
+    def page_numbers(hint: Any) -> list[int]:
+        if isinstance(hint, int):
+            return [hint]
+        if isinstance(hint, str):
+            return [int(number) for number in re.findall(r"\d+", hint)]
+        if isinstance(hint, Iterable):
+            return [number for value in hint for number in MergeStrategy.page_numbers(value)]
+        return []
+
+    @property
+    def is_complete(self) -> bool:
+        """Every field has a page hint, a field on no page is hinted as NOT_AVAILABLE."""
+        return all(key in self.details for key in MERGE_HINT_FIELDS)
+
+    def field_pages(self) -> dict[str, list[int]]:
+        """Pages each Invoice field is to be taken from, for the fields with a page hint."""
+        return {
+            field: pages
+            for key, field in MERGE_HINT_FIELDS.items()
+            if (pages := self.page_numbers(self.details.get(key)))
+        }
+
+    def required_pages(self) -> set[int] | None:
+        """Pages holding at least one hinted field, None when the hints are incomplete."""
+        if not self.is_complete:
+            return None
+        return {page for pages in self.field_pages().values() for page in pages}
@@ -0,0 +1,204 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+from src.config import InvoiceParserConfig
+from src.metrics import metrics
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice
+from src.templates import text_layer_document, text_layer_lines
+from src.validation import GSTIN_PATTERN, is_valid_gstin
+
+logger = logging.getLogger("asyncio")
+
+NOT_AVAILABLE = "NOT_AVAILABLE"
+# Details of a party filled from the index, the name and the identification numbers are always extracted
+DETAIL_FIELDS = ("address", "state", "country", "pin_code", "phone_number", "email")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parties (
+    gstin TEXT PRIMARY KEY,
+    pan TEXT NOT NULL,
+    details TEXT NOT NULL,
+    present INTEGER NOT NULL,
+    seen INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS parties_pan ON parties (pan);
+"""
+
+
+def pan_of(gstin: str) -> str:
+    """PAN of the business holding a GSTIN, its characters 3 to 12."""
+    return gstin[2:12]
+
+
+def _is_missing(value: str) -> bool:
+    return not value.strip() or value.strip().upper() == NOT_AVAILABLE
+
+
+def _numbers(company: CompanyDetails, bin_type: str) -> list[str]:
+    return [
+        bin_details.BIN_Number.strip().upper()
+        for bin_details in company.BIN_Details
+        if bin_details.BIN_Type.strip().upper() == bin_type and not _is_missing(bin_details.BIN_Number)
+    ]
+
+
+def party_gstin(company: CompanyDetails) -> str | None:
+    return next((gstin for gstin in _numbers(company, "GSTIN") if is_valid_gstin(gstin)), None)
+
+
+def _present(company: CompanyDetails) -> int:
+    return sum(not _is_missing(getattr(company, name)) for name in DETAIL_FIELDS)
+
+
+def find_gstins(text: str) -> list[str]:
+    """The GSTINs with a valid check character in a text, in order of appearance."""
+    found = GSTIN_PATTERN.findall(text.upper())
+    return list(dict.fromkeys(gstin for gstin in found if is_valid_gstin(gstin)))
+
+
+class PartyIndex:
+    """
+    Master data of the sellers and buyers seen on past invoices, in a SQLite table keyed by
+    GSTIN and indexed by PAN. A party on file needs only its name and identification numbers
+    extracted, its other details are filled in from the index.
+    """
+
+    def __init__(self, config: InvoiceParserConfig) -> None:
+        self.path = Path(config.PARTY_INDEX_PATH or "")
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def clear(self) -> None:
+        """Forget every party."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM parties")
+            connection.commit()
+
+    def lookup(self, number: str) -> CompanyDetails | None:
+        """Details of the party with a GSTIN or PAN, the most recently seen one for a PAN."""
+        number = number.strip().upper()
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT details FROM parties WHERE gstin = ? OR pan = ? ORDER BY gstin = ? DESC, updated DESC",
+                    (number, number, number),
+                )
+                .fetchone()
+            )
+        return None if row is None else CompanyDetails.model_validate_json(row[0])
+
+    def known_gstins(self, gstins: Iterable[str]) -> list[str]:
+        """The `gstins` of parties on file."""
+        gstins = list(gstins)
+        if not gstins:
+            return []
+        with self._lock:
+            rows = (
+                self._connect()
+                .execute(f"SELECT gstin FROM parties WHERE gstin IN ({', '.join('?' * len(gstins))})", gstins)  # noqa: S608
+                .fetchall()
+            )
+        known = {gstin for (gstin,) in rows}
+        return [gstin for gstin in gstins if gstin in known]
+
+    def known_pages(self, pdf_path: str | Path, pages: list[int]) -> dict[int, list[str]]:
+        """GSTINs of the parties on file printed on the text layer of each of the `pages`."""
+        known = {}
+        with text_layer_document(pdf_path) as pdf:
+            for page_index in pages:
+                gstins = self.known_gstins(find_gstins("\n".join(text_layer_lines(pdf, page_index))))
+                if gstins:
+                    known[page_index] = gstins
+        return known
+
+    def fill(self, company: CompanyDetails) -> CompanyDetails:
+        """
+        The details of a party missing from its extraction, filled in from the party on file with
+        the extracted GSTIN, or with the extracted PAN when no GSTIN was read. Stored GSTINs are
+        never added, a PAN match may be another registration of the business.
+        """
+        numbers = _numbers(company, "GSTIN") or _numbers(company, "PAN")
+        stored = next((party for number in numbers if (party := self.lookup(number)) is not None), None)
+        if stored is None:
+            return company
+        metrics.inc("party_index_fills_total")
+        filled = company.model_copy(deep=True)
+        for name in ("name", *DETAIL_FIELDS):
+            if _is_missing(getattr(filled, name)):
+                setattr(filled, name, getattr(stored, name))
+        read = {
+            (bin_details.BIN_Type.strip().upper(), bin_details.BIN_Number.strip().upper())
+            for bin_details in filled.BIN_Details
+        }
+        filled.BIN_Details = [
+            *filled.BIN_Details,
+            *(
+                BusinessIdNumber(BIN_Type=bin_details.BIN_Type, BIN_Number=bin_details.BIN_Number)
+                for bin_details in stored.BIN_Details
+                if bin_details.BIN_Type.strip().upper() != "GSTIN"
+                and (bin_details.BIN_Type.strip().upper(), bin_details.BIN_Number.strip().upper()) not in read
+            ),
+        ]
+        return filled
+
+    def fill_invoice(self, invoice: Invoice) -> Invoice:
+        return invoice.model_copy(
+            update={
+                "seller_details": self.fill(invoice.seller_details),
+                "buyer_details": self.fill(invoice.buyer_details),
+            }
+        )
+
+    def record(self, invoices: Iterable[Invoice]) -> int:
+        """
+        Record the sellers and buyers of extracted invoices which carry a valid GSTIN, a name and an
+        address. Stored details are replaced by an extraction with at least as many details.
+        Returns the number of parties recorded.
+        """
+        recorded = 0
+        with self._lock:
+            connection = self._connect()
+            for invoice in invoices:
+                for company in (invoice.seller_details, invoice.buyer_details):
+                    gstin = party_gstin(company)
+                    if gstin is None or _is_missing(company.name) or _is_missing(company.address):
+                        continue
+                    connection.execute(
+                        """
+                        INSERT INTO parties (gstin, pan, details, present, seen, updated) VALUES (?, ?, ?, ?, 1, ?)
+                        ON CONFLICT (gstin) DO UPDATE SET
+                            details = CASE WHEN excluded.present >= present THEN excluded.details ELSE details END,
+                            present = MAX(excluded.present, present),
+                            seen = seen + 1,
+                            updated = excluded.updated
+                        """,
+                        (gstin, pan_of(gstin), company.model_dump_json(), _present(company), time.time()),
+                    )
+                    recorded += 1
+            connection.commit()
+        return recorded
+
+
+_indexes: dict[str, PartyIndex] = {}
+
+
+def party_index(config: InvoiceParserConfig) -> PartyIndex | None:
+    """The process wide party index of `PARTY_INDEX_PATH`, None when the index is disabled."""
+    if not config.PARTY_INDEX_PATH:
+        return None
+    if config.PARTY_INDEX_PATH not in _indexes:
+        _indexes[config.PARTY_INDEX_PATH] = PartyIndex(config)
+    return _indexes[config.PARTY_INDEX_PATH]
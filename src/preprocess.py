@@ -0,0 +1,164 @@
+import logging
+
+import numpy as np
+from PIL import Image
+
+from src.config import InvoiceParserConfig
+from src.metrics import RATIO_BUCKETS, metrics
+
+logger = logging.getLogger("asyncio")
+
+# Pixels darker than this are ink when looking for margins and text lines
+INK_THRESHOLD = 200
+# Longest side of the subsampled view the margins and the skew are measured on
+ANALYSIS_SIDE = 1000
+# Margin kept around the trimmed content, as a share of the page side
+TRIM_PADDING = 0.01
+SKEW_STEP_DEGREES = 0.1
+SKEW_SAMPLE_PIXELS = 20000
+SKEW_MIN_PIXELS = 100
+MIN_SKEW_DEGREES = 0.2
+# Channel indices of red, green and blue in the pixel formats of the renderers
+CHANNELS = {
+    "BGR": (2, 1, 0),
+    "BGRA": (2, 1, 0),
+    "BGRX": (2, 1, 0),
+    "RGB": (0, 1, 2),
+    "RGBA": (0, 1, 2),
+    "RGBX": (0, 1, 2),
+}
+
+
+def luma(pixels: np.ndarray, mode: str) -> np.ndarray:
+    """8 bit luma of an (height, width, channels) pixel array in `mode`, integer BT.601 weights."""
+    if mode == "L":
+        return pixels if pixels.ndim == 2 else pixels[..., 0]  # noqa: PLR2004
+    red, green, blue = (pixels[..., index].astype(np.uint16) for index in CHANNELS[mode])
+    return ((red * 77 + green * 150 + blue * 29) >> 8).astype(np.uint8)
+
+
+def skew_angle(ink: np.ndarray, max_degrees: float) -> float:
+    """
+    Counter clockwise skew in degrees of the text lines of an ink mask, the shear angle whose
+    row profile has the sharpest peaks. Sharp peaks mean each text line falls in few rows.
+    """
+    ys, xs = np.nonzero(ink)
+    if len(ys) < SKEW_MIN_PIXELS:
+        return 0.0
+    # The profile keeps its shape on a sample of the ink, which bounds the work on dense pages
+    if len(ys) > SKEW_SAMPLE_PIXELS:
+        sample = np.random.default_rng(0).choice(len(ys), SKEW_SAMPLE_PIXELS, replace=False)
+        ys, xs = ys[sample], xs[sample]
+    angles = np.arange(-max_degrees, max_degrees + SKEW_STEP_DEGREES / 2, SKEW_STEP_DEGREES)
+    offsets = np.outer(np.tan(np.radians(angles)), xs.astype(np.float32))
+    rows = np.rint(ys[np.newaxis, :] + offsets).astype(np.int32)
+    rows -= rows.min()
+    scores = [np.square(np.diff(np.bincount(row))).sum(dtype=np.int64) for row in rows]
+    return round(float(angles[int(np.argmax(scores))]), 2)
+
+
+def trim_box(ink: np.ndarray, padding: int) -> tuple[int, int, int, int] | None:
+    """(top, bottom, left, right) of the inked area of a mask with `padding`, None on a blank page."""
+    rows, columns = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+    if not len(rows):
+        return None
+    height, width = ink.shape
+    return (
+        max(int(rows[0]) - padding, 0),
+        min(int(rows[-1]) + 1 + padding, height),
+        max(int(columns[0]) - padding, 0),
+        min(int(columns[-1]) + 1 + padding, width),
+    )
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Threshold between ink and paper maximising the between class variance of the histogram."""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(histogram)
+    mean = np.cumsum(histogram * np.arange(256))
+    total_weight, total_mean = weight[-1], mean[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (total_mean * weight - mean * total_weight) ** 2 / (weight * (total_weight - weight))
+    return int(np.nanargmax(variance[:-1]))
+
+
+def _to_image(pixels: np.ndarray, mode: str) -> Image.Image:
+    if mode == "L":
+        return Image.fromarray(np.ascontiguousarray(luma(pixels, mode)))
+    # The raw decoder reorders the channels, as `PdfBitmap.to_pil()` does
+    pixels = np.ascontiguousarray(pixels)
+    height, width = pixels.shape[:2]
+    image_mode = "RGBA" if mode in ("BGRA", "RGBA") else "RGB"
+    return Image.frombuffer(image_mode, (width, height), pixels, "raw", mode, pixels.strides[0], 1)
+
+
+class PagePreprocessor:
+    """
+    Cleans a rendered page before it is resized and encoded: straightens scanned pages,
+    trims the white margins and optionally drops the colour or binarises the page, so the
+    resize budget and the image tokens go to the content. The margins and the skew are
+    measured on a subsampled view of the renderer buffer, only the result is copied.
+    """
+
+    def __init__(self, config: InvoiceParserConfig) -> None:
+        self.trim_margins = config.PREPROCESS_TRIM_MARGINS
+        self.deskew = config.PREPROCESS_DESKEW
+        self.max_skew = config.PREPROCESS_MAX_SKEW_DEGREES
+        self.color_mode = config.PREPROCESS_COLOR_MODE
+
+    @property
+    def enabled(self) -> bool:
+        return self.trim_margins or self.deskew or self.color_mode != "color"
+
+    def run(self, pixels: np.ndarray, mode: str, page_index: int = 0) -> Image.Image:
+        """
+        Preprocess a page from its pixel array, e.g. the zero copy `PdfBitmap.to_numpy()` view.
+
+        Args:
+            pixels: (height, width, channels) pixels of the page
+            mode: Pixel format of `pixels`, L, RGB(A/X) or BGR(A/X)
+            page_index: Page number, for logging
+        """
+        image = None
+        if self.deskew:
+            angle = skew_angle(self._ink(pixels, mode)[0], self.max_skew)
+            if abs(angle) >= MIN_SKEW_DEGREES:
+                logger.info(f"Deskewing page {page_index} by {angle:.1f} degrees")
+                metrics.inc("page_deskewed_total")
+                image = _to_image(pixels, mode).rotate(
+                    -angle, resample=Image.Resampling.BILINEAR, expand=True, fillcolor="white"
+                )
+                pixels = np.asarray(image)
+                mode = image.mode
+        if self.trim_margins:
+            ink, step = self._ink(pixels, mode)
+            padding = int(TRIM_PADDING * max(ink.shape))
+            box = trim_box(ink, padding)
+            if box is not None:
+                top, bottom, left, right = (bound * step for bound in box)
+                height, width = pixels.shape[:2]
+                metrics.observe(
+                    "page_trimmed_ratio",
+                    1 - (min(bottom, height) - top) * (min(right, width) - left) / (height * width),
+                    bounds=RATIO_BUCKETS,
+                )
+                pixels = pixels[top:bottom, left:right]
+                image = None
+        if self.color_mode == "grayscale":
+            return Image.fromarray(np.ascontiguousarray(luma(pixels, mode)))
+        if self.color_mode == "binary":
+            gray = luma(pixels, mode)
+            return Image.fromarray(gray > otsu_threshold(gray))
+        return image if image is not None else _to_image(pixels, mode)
+
+    def run_image(self, image: Image.Image, page_index: int = 0) -> Image.Image:
+        """Preprocess a page rendered as a PIL image."""
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        return self.run(np.asarray(image), image.mode, page_index)
+
+    @staticmethod
+    def _ink(pixels: np.ndarray, mode: str) -> tuple[np.ndarray, int]:
+        """Ink mask of a strided view of the page and the stride."""
+        step = max(1, max(pixels.shape[:2]) // ANALYSIS_SIDE)
+        return luma(pixels[::step, ::step], mode) < INK_THRESHOLD, step
@@ -0,0 +1,78 @@
+import threading
+from typing import Any
+
+from pydantic_ai.messages import ModelMessage, ModelResponse
+from pydantic_ai.models import ModelRequestParameters
+from pydantic_ai.models.bedrock import BedrockConverseModel
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.providers.bedrock import BedrockProvider
+from pydantic_ai.settings import ModelSettings
+
+# Bedrock model families which accept `cachePoint` blocks in the Converse API. Other models,
+# the default llama 4 vision model among them, are called without cache points
+BEDROCK_PROMPT_CACHE_MODELS = (
+    "anthropic.claude-3-5-haiku",
+    "anthropic.claude-3-7-sonnet",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+    "amazon.nova",
+)
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def bedrock_supports_prompt_cache(model_name: str) -> bool:
+    return any(family in model_name for family in BEDROCK_PROMPT_CACHE_MODELS)
+
+
+def add_cache_points(params: dict[str, Any], **_: Any) -> None:
+    """
+    boto3 `before-parameter-build` handler of Converse. Cache points are placed after the first
+    system prompt block, which is shared by the agents of a stage, and after the whole system prompt.
+    """
+    system_prompt = params.get("system")
+    if not system_prompt:
+        return
+    cached_system_prompt = [system_prompt[0], CACHE_POINT]
+    if len(system_prompt) > 1:
+        cached_system_prompt.extend([*system_prompt[1:], CACHE_POINT])
+    params["system"] = cached_system_prompt
+
+
+class CachedBedrockConverseModel(WrapperModel):
+    """
+    Bedrock Converse model with prompt caching, for the `BEDROCK_PROMPT_CACHE_MODELS` only.
+    The cache points and the cache token counts go through the event hooks of the boto3 client,
+    the cache reads are merged into the usage details as `cached_tokens`.
+    """
+
+    def __init__(self, model_name: str, provider: BedrockProvider) -> None:
+        super().__init__(BedrockConverseModel(model_name, provider=provider))
+        self._lock = threading.Lock()
+        self._cache_usage: dict[str, dict[str, int]] = {}
+        events = provider.client.meta.events
+        events.register("before-parameter-build.bedrock-runtime.Converse", add_cache_points)
+        events.register("after-call.bedrock-runtime.Converse", self._record_cache_usage)
+
+    def _record_cache_usage(self, parsed: dict[str, Any], **_: Any) -> None:
+        request_id = parsed.get("ResponseMetadata", {}).get("RequestId")
+        if request_id is None:
+            return
+        response_usage = parsed.get("usage", {})
+        with self._lock:
+            self._cache_usage[request_id] = {
+                "cached_tokens": response_usage.get("cacheReadInputTokens", 0),
+                "cache_write_tokens": response_usage.get("cacheWriteInputTokens", 0),
+            }
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+    ) -> ModelResponse:
+        response = await self.wrapped.request(messages, model_settings, model_request_parameters)
+        with self._lock:
+            cache_usage = self._cache_usage.pop(response.vendor_id or "", None)
+        if cache_usage is not None:
+            response.usage.details = {**(response.usage.details or {}), **cache_usage}
+        return response
@@ -0,0 +1,254 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Literal
+
+from pydantic_ai import UnexpectedModelBehavior
+from pydantic_ai.messages import (
+    BinaryContent,
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    RetryPromptPart,
+    SystemPromptPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models import Model, ModelRequestParameters
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.settings import ModelSettings
+
+ReplayMode = Literal["record", "replay"]
+
+
+def request_key(model_name: str, messages: list[ModelMessage], model_request_parameters: ModelRequestParameters) -> str:
+    """
+    Stable key of a model request, built from the model name, the prompts, the retry and
+    tool return parts and the output tools. Images are keyed by a digest of their bytes.
+    The model name keeps apart the escalation and hedge calls, which repeat the request.
+    """
+    digest = hashlib.sha256(f"model:{model_name}".encode())
+    for message in messages:
+        if not isinstance(message, ModelRequest):
+            continue
+        for part in message.parts:
+            if isinstance(part, ToolReturnPart):
+                digest.update(f"{part.part_kind}:{part.model_response_str()}".encode())
+            elif isinstance(part, SystemPromptPart | RetryPromptPart):
+                digest.update(f"{part.part_kind}:{part.content}".encode())
+            elif isinstance(part, UserPromptPart):
+                contents = [part.content] if isinstance(part.content, str) else part.content
+                for content in contents:
+                    if isinstance(content, BinaryContent):
+                        digest.update(b"binary:" + hashlib.sha256(content.data).digest())
+                    else:
+                        digest.update(f"user:{content}".encode())
+    digest.update(",".join(tool.name for tool in model_request_parameters.output_tools).encode())
+    return digest.hexdigest()
+
+
+@dataclass
+class LatencyDistribution:
+    """
+    Latency injected by the replay model: `recorded`, `fixed:<seconds>`,
+    `uniform:<low>,<high>`, `lognormal:<median>,<sigma>` or `tokens:<seconds>,<seconds per
+    response token>`, which grows with the size of the recorded response.
+    """
+
+    kind: str = "recorded"
+    params: tuple[float, ...] = ()
+    seed: int | None = None
+
+    def __post_init__(self) -> None:
+        self._random = random.Random(self.seed)  # noqa: S311
+
+    @classmethod
+    def parse(cls, spec: str, seed: int | None = None) -> "LatencyDistribution":
+        kind, _, params = spec.partition(":")
+        distribution = cls(kind, tuple(float(param) for param in params.split(",") if param), seed)
+        expected = {"recorded": 0, "fixed": 1, "uniform": 2, "lognormal": 2, "tokens": 2}
+        if kind not in expected or len(distribution.params) != expected[kind]:
+            raise ValueError(f"Invalid latency distribution {spec}")
+        return distribution
+
+    def sample(self, recorded: float, response_tokens: int = 0) -> float:
+        if self.kind == "tokens":
+            base, per_token = self.params
+            return base + per_token * response_tokens
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self._random.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return self._random.lognormvariate(0.0, sigma) * median
+        return recorded
+
+
+class ReplayStore:
+    """Recorded model responses, one JSON file per request key under `directory`."""
+
+    def __init__(self, directory: str | Path) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def save(self, key: str, model_name: str, response: ModelResponse, latency: float) -> None:
+        record = {
+            "model_name": model_name,
+            "latency": latency,
+            "response": json.loads(ModelMessagesTypeAdapter.dump_json([response])),
+        }
+        with self._lock:
+            self._path(key).write_text(json.dumps(record), encoding="utf-8")
+
+    def load(self, key: str) -> tuple[ModelResponse, float] | None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        record = json.loads(path.read_text(encoding="utf-8"))
+        response = ModelMessagesTypeAdapter.validate_python(record["response"])[0]
+        if not isinstance(response, ModelResponse):
+            return None
+        return response, record["latency"]
+
+
+class RecordingModel(WrapperModel):
+    """Passes requests to the wrapped model and records each response with its latency."""
+
+    def __init__(self, model_name: str, wrapped: Model, store: ReplayStore) -> None:
+        super().__init__(wrapped)
+        self._model_name = model_name
+        self.store = store
+
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+    ) -> ModelResponse:
+        start = time.perf_counter()
+        response = await self.wrapped.request(messages, model_settings, model_request_parameters)
+        latency = time.perf_counter() - start
+        key = request_key(self.model_name, messages, model_request_parameters)
+        self.store.save(key, self.model_name, response, latency)
+        return response
+
+
+class ReplayModel(Model):
+    """
+    Serves recorded responses without calling a provider, after sleeping for a latency
+    drawn from `latency`. Requests which were never recorded fail.
+    """
+
+    def __init__(self, model_name: str, store: ReplayStore, latency: LatencyDistribution | None = None) -> None:
+        self._model_name = model_name
+        self.store = store
+        self.latency = latency or LatencyDistribution()
+
+    @property
+    def model_name(self) -> str:
+        return self._model_name
+
+    @property
+    def system(self) -> str:
+        return "replay"
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,  # noqa: ARG002
+        model_request_parameters: ModelRequestParameters,
+    ) -> ModelResponse:
+        key = request_key(self.model_name, messages, model_request_parameters)
+        recorded = self.store.load(key)
+        if recorded is None:
+            raise UnexpectedModelBehavior(f"No recorded response for {self.model_name} request {key}")
+        response, latency = recorded
+        await asyncio.sleep(self.latency.sample(latency, response.usage.response_tokens or 0))
+        response.model_name = self.model_name
+        return response
+
+
+@dataclass
+class ReplaySession:
+    """
+    Routes the models built by `model_factory` through a replay store. Latencies are
+    looked up by model name, `*` applies to the other models.
+    """
+
+    mode: ReplayMode
+    store: ReplayStore
+    latencies: dict[str, LatencyDistribution] = field(default_factory=dict)
+    # Model recorded in place of the provider models, e.g. a synthetic model
+    record_target: Model | None = None
+
+    def model(self, model_name: str, build: Callable[[], Model]) -> Model:
+        if self.mode == "replay":
+            return ReplayModel(model_name, self.store, self.latencies.get(model_name, self.latencies.get("*")))
+        return RecordingModel(model_name, self.record_target or build(), self.store)
+
+
+current_replay_session: ContextVar[ReplaySession | None] = ContextVar("current_replay_session", default=None)
+_env_sessions: dict[tuple[str, str, str], ReplaySession] = {}
+
+
+def get_replay_settings() -> dict[str, Any]:
+    return {
+        "mode": os.getenv("LLM_REPLAY_MODE", ""),
+        "directory": os.getenv("LLM_REPLAY_DIR", ""),
+        "latency": os.getenv("LLM_REPLAY_LATENCY", "recorded"),
+    }
+
+
+def active_replay_session() -> ReplaySession | None:
+    """The replay session of the current context, else the one configured through the environment."""
+    session = current_replay_session.get()
+    if session is not None:
+        return session
+    settings = get_replay_settings()
+    if settings["mode"] not in ["record", "replay"] or not settings["directory"]:
+        return None
+    key = (settings["mode"], settings["directory"], settings["latency"])
+    if key not in _env_sessions:
+        _env_sessions[key] = ReplaySession(
+            mode=settings["mode"],
+            store=ReplayStore(settings["directory"]),
+            latencies={"*": LatencyDistribution.parse(settings["latency"])},
+        )
+    return _env_sessions[key]
+
+
+@contextmanager
+def replay_session(
+    mode: ReplayMode,
+    directory: str | Path,
+    latencies: dict[str, LatencyDistribution] | None = None,
+    record_target: Model | None = None,
+) -> Iterator[ReplaySession]:
+    """Record or replay every model built by `model_factory` inside the block."""
+    session = ReplaySession(
+        mode=mode, store=ReplayStore(directory), latencies=latencies or {}, record_target=record_target
+    )
+    token = current_replay_session.set(session)
+    try:
+        yield session
+    finally:
+        current_replay_session.reset(token)
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Literal, Self
+
+from src.metrics import RATIO_BUCKETS, metrics
+from src.tracing import trace_span
+
+Lane = Literal["interactive", "bulk"]
+LANES: tuple[Lane, ...] = ("interactive", "bulk")
+
+current_lane: ContextVar[Lane] = ContextVar("current_lane", default="interactive")
+
+
+@contextmanager
+def scheduling_lane(lane: Lane) -> Iterator[None]:
+    """Run the model calls of the enclosed block in `lane`."""
+    token = current_lane.set(lane)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class PriorityLimiter:
+    """
+    Concurrency limiter of a stage, shared by every document of the process. Calls wait
+    in the lane of their document and a free slot goes to a queued interactive call
+    before a queued bulk one. After `interactive_burst` interactive grants in a row
+    while bulk calls wait, the next slot goes to bulk so a backlog keeps draining.
+    """
+
+    def __init__(self, stage: str, value: int, interactive_burst: int) -> None:
+        self.stage = stage
+        self.limit = value
+        self.interactive_burst = interactive_burst
+        self.in_use = 0
+        self._waiters: dict[Lane, deque[asyncio.Future[None]]] = {lane: deque() for lane in LANES}
+        self._interactive_streak = 0
+
+    def queued(self, lane: Lane) -> int:
+        return sum(1 for waiter in self._waiters[lane] if not waiter.done())
+
+    def _next_lane(self) -> Lane | None:
+        for waiters in self._waiters.values():
+            while waiters and waiters[0].done():
+                waiters.popleft()
+        interactive, bulk = self._waiters["interactive"], self._waiters["bulk"]
+        if interactive and (not bulk or self._interactive_streak < self.interactive_burst):
+            return "interactive"
+        return "bulk" if bulk else None
+
+    def _grant(self) -> None:
+        while self.in_use < self.limit:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            waiter = self._waiters[lane].popleft()
+            self._interactive_streak = (
+                self._interactive_streak + 1 if lane == "interactive" and self._waiters["bulk"] else 0
+            )
+            self.in_use += 1
+            waiter.set_result(None)
+
+    async def acquire(self) -> None:
+        lane = current_lane.get()
+        if self.in_use < self.limit and not any(self.queued(lane_) for lane_ in LANES):
+            self.in_use += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        metrics.set_gauge("scheduler_queue_depth", self.queued(lane), stage=self.stage, lane=lane)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted while the call was cancelled, pass it on
+                self.release()
+            raise
+        finally:
+            metrics.set_gauge("scheduler_queue_depth", self.queued(lane), stage=self.stage, lane=lane)
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._grant()
+
+    async def __aenter__(self) -> Self:
+        lane = current_lane.get()
+        start = time.perf_counter()
+        with trace_span("queue_wait", "wait", stage=self.stage, lane=lane):
+            await self.acquire()
+        metrics.observe("llm_queue_wait_seconds", time.perf_counter() - start, stage=self.stage, lane=lane)
+        metrics.inc("scheduler_grants_total", stage=self.stage, lane=lane)
+        metrics.observe("semaphore_occupancy_ratio", self.in_use / self.limit, bounds=RATIO_BUCKETS, stage=self.stage)
+        metrics.set_gauge("semaphore_in_use", self.in_use, stage=self.stage)
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        self.release()
+        metrics.set_gauge("semaphore_in_use", self.in_use, stage=self.stage)
+
+
+_limiters: dict[str, PriorityLimiter] = {}
+
+
+def stage_limiter(stage: str, value: int, interactive_burst: int) -> PriorityLimiter:
+    """The process wide limiter of a stage, created on first use."""
+    if stage not in _limiters:
+        _limiters[stage] = PriorityLimiter(stage, value, interactive_burst)
+    limiter = _limiters[stage]
+    limiter.limit, limiter.interactive_burst = value, interactive_burst
+    return limiter
@@ -1,12 +1,17 @@
 import logging
 import re
-from collections.abc import Mapping
+from collections import Counter
+from collections.abc import Iterable, Mapping
+from pathlib import Path
 from string import Template
 from typing import Any
 
 from pydantic import BaseModel, Field
 
-from src.output_format import Invoice, InvoiceData, TokenCount
+from src.budget import BudgetDecision, UsageTotals
+from src.config import app_config
+from src.memory import NodeMemoryProfile
+from src.output_format import Invoice, InvoiceData, MergeStrategy, TokenCount
 
 logger = logging.getLogger(__name__)
 
@@ -86,17 +91,84 @@ class PageGroupInfo(BaseModel):
 
 class WorkflowState(BaseModel):
     pdf_name: str
+    pdf_path: str = ""
+    tenant: str = "default"
     image_dir: str = ""
     page_details: list[PageDetails] = Field(default_factory=list)
     page_group_info: list[PageGroup] = Field(default_factory=list)
     token_count: list[TokenCount] = Field(default_factory=list)
+    usage: UsageTotals = Field(default_factory=UsageTotals)
+    budget: BudgetDecision | None = None
     final_output: list[Invoice] = Field(default_factory=list)
+    memory_profile: list[NodeMemoryProfile] = Field(default_factory=list)
     error: str | None = None
 
     @property
     def page_count(self) -> int:
         return len(self.page_details)
 
+    def add_rendered_pages(self, image_dir: str | Path, pages: list[tuple[int, Path, tuple[int, int]]]) -> None:
+        """Register the rendered page images of the PDF."""
+        self.image_dir = str(image_dir)
+        for page_no, page_path, img_size in pages:
+            self.page_details.append(
+                PageDetails(
+                    page_index=page_no,
+                    image_path=page_path.name,
+                    image_size=img_size,
+                )
+            )
+
+    def add_token_counts(self, token_counts: Iterable[TokenCount]) -> None:
+        """Record the token expense of model calls and update the running token and cost totals."""
+        for t_count in token_counts:
+            self.token_count.append(t_count)
+            self.usage.add(t_count, app_config.MODEL_PRICES)
+
+    def pages_pending_extraction(self) -> list[int]:
+        """Get the page indices which have no extracted text yet."""
+        return [p_data.page_index for p_data in self.page_details if not p_data.text_content]
+
+    def pages_pending_formatting(self) -> list[int]:
+        """Get the invoice page indices which have not been formatted into an Invoice yet."""
+        return [p_data.page_index for p_data in self.page_details if p_data.is_invoice_page and p_data.invoice is None]
+
+    def speculative_single_pages(self) -> list[int]:
+        """
+        Invoice pages likely to hold a whole invoice before the pages are grouped: their
+        invoice number appears on no other page and the next invoice page is not a
+        continuation page without an invoice number.
+        """
+        invoice_pages = [p_data for p_data in self.page_details if p_data.is_invoice_page]
+        numbers = Counter(p_data.invoice_number for p_data in invoice_pages if p_data.invoice_number is not None)
+        return [
+            p_data.page_index
+            for p_data, next_page in zip(invoice_pages, [*invoice_pages[1:], None], strict=True)
+            if p_data.invoice is None
+            and p_data.invoice_number is not None
+            and numbers[p_data.invoice_number] == 1
+            and (next_page is None or next_page.invoice_number is not None)
+        ]
+
+    def add_formatted_pages(self, formatted: Iterable[tuple[int, Invoice, list[TokenCount]]]) -> None:
+        """Attach the formatted Invoice of each page to its page details."""
+        for page_no, invoice, _ in formatted:
+            for page_detail in self.page_details:
+                if page_detail.page_index == page_no:
+                    page_detail.invoice = invoice
+                    break
+
+    def pages_required_for_merge(self) -> set[int]:
+        """
+        Pages the strategy merger reads, the hinted pages of groups with complete page
+        hints and every page of the other groups.
+        """
+        pages: set[int] = set()
+        for group in self.page_group_info:
+            required = MergeStrategy(pages=group.page_nos, details=group.details).required_pages()
+            pages.update(group.pages if required is None or group.is_single_page else required & set(group.pages))
+        return pages
+
     def get_text_content_for_group(self, group_index: int) -> str:
         """Get the concatenated text content for a specific group."""
         group = self.page_group_info[group_index]
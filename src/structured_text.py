@@ -0,0 +1,407 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any
+
+from pydantic import ValidationError
+
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice, Item, TaxComponents
+
+NOT_AVAILABLE = "NOT_AVAILABLE"
+
+# Grammar of the structured text layout fixed by IMAGE_TO_TEXT_SYSTEM_MESSAGE.
+# Top level entries open a section, the entries of a section map to the fields of its model.
+SECTION_KEYS = {
+    "invoice number": "invoice_number",
+    "invoice date": "invoice_date",
+    "invoice due date": "invoice_due_date",
+    "seller details": "seller_details",
+    "buyer details": "buyer_details",
+    "item details": "items",
+    "total tax": "total_tax",
+    "total charges": "total_charge",
+    "total discount": "total_discount",
+    "total invoice amount": "total_amount",
+    "amount paid": "amount_paid",
+    "amount due": "amount_due",
+}
+COMPANY_KEYS = {
+    "company name": "name",
+    "name": "name",
+    "address": "address",
+    "state": "state",
+    "country": "country",
+    "pin code": "pin_code",
+    "phone number": "phone_number",
+    "email": "email",
+}
+ITEM_KEYS = {
+    "serial no": "slno",
+    "hsn_code": "HSN_CODE",
+    "hsn code": "HSN_CODE",
+    "description": "description",
+    "inventory item flag": "inventory_flag",
+    "quantity": "quantity",
+    "uom": "UOM",
+    "price": "price",
+    "unit price": "price",
+    "discount": "discount",
+    "total amount": "amount",
+    "currency": "currency",
+}
+TAX_KEYS = {"tax type": "Tax_Type", "percentage": "Tax_Rate", "tax amount": "Tax_Amount"}
+ITEM_START_KEYS = ("item serial number", "serial no")
+# Entries of the layout which only carry structure
+STRUCTURAL_KEYS = {"business identification numbers", "serial number", "item serial number", "tax details"}
+NUMERIC_HEADER_FIELDS = ("total_charge", "total_discount", "total_amount", "amount_paid", "amount_due")
+NUMERIC_ITEM_FIELDS = ("quantity", "price", "discount", "amount")
+
+KEY_VALUE_PATTERN = re.compile(
+    r"^(?:\d+\.\s*)?(?P<key>[A-Za-z_][A-Za-z_ /.]*?)\s*(?:\[if present\])?\s*:\s*(?P<value>.*)$"
+)
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+# Page number line put before the structured text of a page by the workflow
+PAGE_NO_PATTERN = re.compile(r"^Page No \d+$", re.IGNORECASE)
+# Free text fields whose value may wrap onto the following lines, e.g. a multi-line address
+CONTINUED_FIELDS = ("name", "address", "description")
+
+
+def _normalize_line(line: str) -> str:
+    return line.replace("*", "").replace("#", "").strip().lstrip("-•").strip()
+
+
+def _is_missing(value: str) -> bool:
+    return not value or value.upper().startswith(NOT_AVAILABLE)
+
+
+def parse_number(value: str) -> float | None:
+    """Parse an amount like `₹ 1,18,000.00 (after rounding)`, None if the value is missing."""
+    if _is_missing(value):
+        return None
+    match = NUMBER_PATTERN.search(re.sub(r"\(.*?\)", "", value).replace(",", ""))
+    return float(match.group(0)) if match else None
+
+
+def _printed_slno(item: dict[str, Any]) -> int | None:
+    slno = parse_number(item.get("slno", ""))
+    return int(slno) if slno and slno > 0 else None
+
+
+def _text(value: str) -> str:
+    return NOT_AVAILABLE if _is_missing(value) else value.strip()
+
+
+@dataclass
+class ParsedPage:
+    """Invoice built from the structured text of a page and the confidence of the parse."""
+
+    invoice: Invoice | None
+    confidence: float = 0.0
+    issues: list[str] = field(default_factory=list)
+    # Whether each line item carries a printed serial number, the others are numbered by position
+    numbered_items: list[bool] = field(default_factory=list)
+
+
+class _StructuredTextParser:
+    """Single pass, line based parser of the vision stage structured text."""
+
+    def __init__(self) -> None:
+        self.header: dict[str, str] = {}
+        self.companies: dict[str, dict[str, Any]] = {
+            "seller_details": {"BIN_Details": []},
+            "buyer_details": {"BIN_Details": []},
+        }
+        self.items: list[dict[str, Any]] = []
+        self.total_tax: list[dict[str, Any]] = []
+        self.section: str | None = None
+        self.sections_seen: set[str] = set()
+        self.entries = 0
+        self.unknown_entries: list[str] = []
+        self.unparsed_lines = 0
+        # Entry a line without a key continues, the last free text field fed
+        self._continued: tuple[dict[str, Any], str] | None = None
+
+    def feed(self, key: str, value: str) -> None:
+        self.entries += 1
+        self._continued = None
+        if key in SECTION_KEYS:
+            self.section = SECTION_KEYS[key]
+            self.sections_seen.add(self.section)
+            if value and self.section not in ["seller_details", "buyer_details", "items", "total_tax"]:
+                self.header[self.section] = value
+            return
+        if key in STRUCTURAL_KEYS:
+            if key in ITEM_START_KEYS and self.section == "items":
+                self._feed_item(key, value)
+            return
+        if self.section in self.companies:
+            known = self._feed_company(self.companies[self.section], key, value)
+        elif self.section == "items":
+            known = self._feed_item(key, value)
+        elif self.section == "total_tax" and key in TAX_KEYS:
+            known = self._feed_tax(self.total_tax, key, value)
+        else:
+            known = False
+        if not known:
+            self.unknown_entries.append(key)
+
+    def feed_continuation(self, line: str) -> None:
+        """A line outside the key: value layout, appended to a wrapped free text value or counted as unparsed."""
+        if self._continued is None or _is_missing(self._continued[0].get(self._continued[1], "")):
+            self.unparsed_lines += 1
+            return
+        entry, name = self._continued
+        entry[name] = f"{entry[name]} {line}"
+
+    def _feed_company(self, company: dict[str, Any], key: str, value: str) -> bool:
+        if key == "bin type":
+            company["BIN_Details"].append({"BIN_Type": _text(value)})
+        elif key == "bin number" and company["BIN_Details"]:
+            company["BIN_Details"][-1]["BIN_Number"] = _text(value)
+        elif key in COMPANY_KEYS:
+            company[COMPANY_KEYS[key]] = _text(value)
+            if COMPANY_KEYS[key] in CONTINUED_FIELDS:
+                self._continued = (company, COMPANY_KEYS[key])
+        else:
+            return False
+        return True
+
+    def _feed_item(self, key: str, value: str) -> bool:
+        if not self.items or (key in ITEM_START_KEYS and set(self.items[-1]) - {"slno"}):
+            self.items.append({})
+        item = self.items[-1]
+        if key in TAX_KEYS:
+            return self._feed_tax(item.setdefault("tax", []), key, value)
+        if key in ITEM_KEYS:
+            item[ITEM_KEYS[key]] = value
+            if ITEM_KEYS[key] in CONTINUED_FIELDS:
+                self._continued = (item, ITEM_KEYS[key])
+            return True
+        return key in ITEM_START_KEYS
+
+    def _feed_tax(self, taxes: list[dict[str, Any]], key: str, value: str) -> bool:
+        if key == "tax type" or not taxes:
+            taxes.append({})
+        taxes[-1][TAX_KEYS[key]] = value
+        return True
+
+    @staticmethod
+    def _build_tax(tax: dict[str, Any]) -> TaxComponents:
+        return TaxComponents(
+            Tax_Type=_text(tax.get("Tax_Type", "")),
+            Tax_Rate=parse_number(tax.get("Tax_Rate", "")) or 0.0,
+            Tax_Amount=parse_number(tax.get("Tax_Amount", "")) or 0.0,
+        )
+
+    def _build_item(self, index: int, item: dict[str, Any]) -> Item:
+        return Item(
+            slno=_printed_slno(item) or index,
+            description=_text(item.get("description", "")),
+            inventory_flag=item.get("inventory_flag", "").strip().lower().startswith("true"),
+            quantity=parse_number(item.get("quantity", "")) or 0.0,
+            UOM=_text(item.get("UOM", "")),
+            HSN_CODE=_text(item.get("HSN_CODE", "")),
+            price=parse_number(item.get("price", "")) or 0.0,
+            tax=[self._build_tax(tax) for tax in item.get("tax", [])],
+            discount=parse_number(item.get("discount", "")) or 0.0,
+            amount=parse_number(item.get("amount", "")) or 0.0,
+            currency="INR" if _is_missing(item.get("currency", "")) else item["currency"].strip().upper(),
+        )
+
+    @property
+    def line_items(self) -> list[dict[str, Any]]:
+        return [item for item in self.items if set(item) - {"slno"}]
+
+    def unparsed_numbers(self) -> list[str]:
+        """Numeric entries which hold a value that is not a number."""
+        entries = [(name, self.header.get(name, "")) for name in NUMERIC_HEADER_FIELDS]
+        for index, item in enumerate(self.line_items, start=1):
+            entries.extend((f"items[{index}].{name}", item.get(name, "")) for name in NUMERIC_ITEM_FIELDS)
+            entries.extend((f"items[{index}].tax", tax.get("Tax_Amount", "")) for tax in item.get("tax", []))
+        entries.extend(("total_tax", tax.get("Tax_Amount", "")) for tax in self.total_tax)
+        return [name for name, value in entries if not _is_missing(value) and parse_number(value) is None]
+
+    def score(self) -> tuple[float, list[str]]:
+        """
+        Confidence of the parse as the product of the section coverage, the share of
+        entries and lines known to the grammar, the share of numeric entries which parsed
+        and the share of line items carrying a description and an amount.
+        """
+        issues = []
+        missing_sections = sorted(set(SECTION_KEYS.values()) - self.sections_seen)
+        if missing_sections:
+            issues.append(f"missing sections {missing_sections}")
+        if self.unknown_entries:
+            issues.append(f"unknown entries {sorted(set(self.unknown_entries))}")
+        if self.unparsed_lines:
+            issues.append(f"{self.unparsed_lines} lines outside the layout")
+        unparsed = self.unparsed_numbers()
+        if unparsed:
+            issues.append(f"non numeric values in {unparsed}")
+        items = self.line_items
+        incomplete = [
+            index
+            for index, item in enumerate(items, start=1)
+            if _is_missing(item.get("description", "")) or parse_number(item.get("amount", "")) is None
+        ]
+        if incomplete:
+            issues.append(f"incomplete line items {incomplete}")
+        numeric_count = len(NUMERIC_HEADER_FIELDS) + len(NUMERIC_ITEM_FIELDS) * len(items)
+        confidence = (
+            len(self.sections_seen)
+            / len(SECTION_KEYS)
+            * (1 - (len(self.unknown_entries) + self.unparsed_lines) / max(self.entries + self.unparsed_lines, 1))
+            * (1 - min(len(unparsed) / numeric_count, 1))
+            * (1 - len(incomplete) / max(len(items), 1))
+        )
+        return confidence, issues
+
+    def build(self, page_no: str) -> Invoice:
+        companies = {
+            name: CompanyDetails(
+                **{key: value for key, value in details.items() if key != "BIN_Details"},
+                BIN_Details=[BusinessIdNumber(**bin_details) for bin_details in details["BIN_Details"]],
+            )
+            for name, details in self.companies.items()
+        }
+        return Invoice(
+            invoice_number=_text(self.header.get("invoice_number", "")),
+            invoice_date=_text(self.header.get("invoice_date", "")),
+            invoice_due_date=_text(self.header.get("invoice_due_date", "")),
+            seller_details=companies["seller_details"],
+            buyer_details=companies["buyer_details"],
+            items=[self._build_item(index, item) for index, item in enumerate(self.line_items, start=1)],
+            total_tax=[tax for tax in map(self._build_tax, self.total_tax) if not tax.is_empty],
+            total_charge=parse_number(self.header.get("total_charge", "")) or 0.0,
+            total_discount=parse_number(self.header.get("total_discount", "")) or 0.0,
+            total_amount=parse_number(self.header.get("total_amount", "")) or 0.0,
+            amount_paid=parse_number(self.header.get("amount_paid", "")) or 0.0,
+            amount_due=parse_number(self.header.get("amount_due", "")) or 0.0,
+            page_no=page_no,
+        )
+
+
+def parse_structured_text(text: str, page_no: str = "") -> ParsedPage:
+    """
+    Build an Invoice directly from the structured text of the vision stage.
+
+    Args:
+        text: The structured text output of a page
+        page_no: Page number recorded on the Invoice
+    Returns:
+        The parsed page, its invoice is None when the text does not follow the structured layout
+    """
+    if re.search(r"\bNO_INVOICE_FOUND", text, re.IGNORECASE):
+        return ParsedPage(invoice=None, issues=["no invoice on the page"])
+    parser = _StructuredTextParser()
+    for raw_line in text.splitlines():
+        line = _normalize_line(raw_line)
+        match = KEY_VALUE_PATTERN.match(line)
+        if match:
+            parser.feed(match.group("key").strip().rstrip(".").lower(), match.group("value").strip())
+        elif any(char.isalnum() for char in line) and not PAGE_NO_PATTERN.match(line):
+            parser.feed_continuation(line)
+    if "invoice_number" not in parser.header:
+        return ParsedPage(invoice=None, issues=["invoice number entry not found"])
+    confidence, issues = parser.score()
+    try:
+        invoice = parser.build(page_no)
+    except ValidationError as err:
+        return ParsedPage(invoice=None, issues=[*issues, str(err)])
+    numbered_items = [_printed_slno(item) is not None for item in parser.line_items]
+    return ParsedPage(invoice=invoice, confidence=confidence, issues=issues, numbered_items=numbered_items)
+
+
+def parse_item_rows(text: str) -> list[Item] | None:
+    """
+    Line items of a row band output, entries in the Item Details layout of the structured
+    text. Returns None when the text does not follow the layout.
+    """
+    rows = parse_numbered_item_rows(text)
+    return None if rows is None else [item for item, _ in rows]
+
+
+def parse_numbered_item_rows(text: str) -> list[tuple[Item, bool]] | None:
+    """`parse_item_rows` with whether each row carries a printed serial number."""
+    if re.search(r"\bNO_LINE_ITEMS", text, re.IGNORECASE):
+        return []
+    parsed = parse_structured_text(f"1. Invoice Number: {NOT_AVAILABLE}\n6. Item Details:\n{text}")
+    if parsed.invoice is None or not parsed.invoice.items:
+        return None
+    return list(zip(parsed.invoice.items, parsed.numbered_items, strict=True))
+
+
+def _line(indent: int, key: str, value: object) -> str:
+    text = " ".join(str(value).split()) or NOT_AVAILABLE
+    return f"{'    ' * indent}{key}: {text}"
+
+
+def _tax_lines(taxes: list[TaxComponents], indent: int) -> list[str]:
+    lines = []
+    for index, tax in enumerate(taxes, start=1):
+        lines += [
+            _line(indent, "Serial number", index),
+            _line(indent + 1, "Tax type", tax.Tax_Type),
+            _line(indent + 1, "Percentage", tax.Tax_Rate),
+            _line(indent + 1, "Tax amount", tax.Tax_Amount),
+        ]
+    return lines
+
+
+def _company_lines(title: str, company: CompanyDetails) -> list[str]:
+    lines = [f"{title}:", _line(1, "Company Name", company.name), "    Business identification numbers:"]
+    for index, bin_details in enumerate(company.BIN_Details, start=1):
+        lines += [
+            _line(2, "Serial number", index),
+            _line(3, "BIN Type", bin_details.BIN_Type),
+            _line(3, "BIN Number", bin_details.BIN_Number),
+        ]
+    return [
+        *lines,
+        _line(1, "Address", company.address),
+        _line(1, "State", company.state),
+        _line(1, "Country", company.country),
+        _line(1, "Pin code", company.pin_code),
+        _line(1, "Phone Number", company.phone_number),
+        _line(1, "Email", company.email),
+    ]
+
+
+def render_structured_text(invoice: Invoice) -> str:
+    """
+    Structured text of an Invoice in the layout of IMAGE_TO_TEXT_SYSTEM_MESSAGE, for pages
+    extracted as JSON. `parse_structured_text` reads it back into the same Invoice.
+    """
+    lines = [
+        _line(0, "1. Invoice Number", invoice.invoice_number),
+        _line(0, "2. Invoice Date", invoice.invoice_date),
+        _line(0, "3. Invoice Due Date", invoice.invoice_due_date),
+        *_company_lines("4. Seller Details", invoice.seller_details),
+        *_company_lines("5. Buyer Details", invoice.buyer_details),
+        "6. Item Details:",
+    ]
+    for index, item in enumerate(invoice.items, start=1):
+        lines += [
+            _line(1, "Item Serial number", index),
+            _line(2, "Serial no", item.slno),
+            _line(2, "HSN_CODE", item.HSN_CODE),
+            _line(2, "Description", item.description),
+            _line(2, "Inventory item flag", item.inventory_flag),
+            _line(2, "Quantity", item.quantity),
+            _line(2, "UOM", item.UOM),
+            _line(2, "Price", item.price),
+            "        Tax details:",
+            *_tax_lines(item.tax, 3),
+            _line(2, "Discount", item.discount),
+            _line(2, "Total Amount", item.amount),
+            _line(2, "Currency", item.currency),
+        ]
+    lines += [
+        "7. Total Tax:" if invoice.total_tax else _line(0, "7. Total Tax", NOT_AVAILABLE),
+        *_tax_lines(invoice.total_tax, 1),
+        _line(0, "8. Total Charges", invoice.total_charge),
+        _line(0, "9. Total Discount", invoice.total_discount),
+        _line(0, "10. Total Invoice Amount", invoice.total_amount),
+        _line(0, "11. Amount Paid", invoice.amount_paid),
+        _line(0, "12. Amount Due", invoice.amount_due),
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,408 @@
+import json
+import logging
+import re
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import pypdfium2 as pdfium
+from PIL import Image
+from pydantic import BaseModel, Field
+
+from src.config import InvoiceParserConfig
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice, Item, TaxComponents
+from src.structured_text import parse_number
+from src.utility import pdfium_lock
+from src.validation import apply_corrections, check_invoice, field_value, is_valid_gstin
+
+logger = logging.getLogger("asyncio")
+
+NOT_AVAILABLE = "NOT_AVAILABLE"
+# Top share of the page image the layout fingerprint is taken from
+HEADER_SHARE = 0.3
+HASH_SIDE = 8
+_COMPANY_FIELDS = ("name", "address", "state", "country", "pin_code", "phone_number", "email")
+# Fields of the buyer, which changes between the invoices of a seller
+BUYER_PREFIX = "buyer_details."
+# Fields read from the text layer with the learned rules, the seller details are kept with the template
+TEMPLATE_TEXT_FIELDS = (
+    "invoice_number",
+    "invoice_date",
+    "invoice_due_date",
+    *(f"{BUYER_PREFIX}{name}" for name in _COMPANY_FIELDS),
+)
+TEMPLATE_AMOUNT_FIELDS = ("total_charge", "total_discount", "total_amount", "amount_paid", "amount_due")
+# Fields a template must read before pages are extracted with it
+REQUIRED_FIELDS = ("invoice_number", "total_amount")
+# Text layer lines a value may span, addresses are often broken over lines
+MAX_VALUE_LINES = 3
+LABEL_SEPARATORS = " :-#\t"
+# A bare amount after a label, with an optional currency
+AMOUNT_PATTERN = re.compile(r"(?:Rs\.?|INR|₹)?\s*-?[\d,]*\d(?:\.\d+)?", re.IGNORECASE)
+
+
+def layout_fingerprint(image_path: str | Path) -> str:
+    """Difference hash of the header region of a page image, 64 bits as hex."""
+    with Image.open(image_path) as image:
+        header = image.convert("L").crop((0, 0, image.width, max(1, int(image.height * HEADER_SHARE))))
+        pixels = list(header.resize((HASH_SIDE + 1, HASH_SIDE)).getdata())
+    bits = 0
+    for row in range(HASH_SIDE):
+        for column in range(HASH_SIDE):
+            index = row * (HASH_SIDE + 1) + column
+            bits = bits << 1 | (pixels[index] > pixels[index + 1])
+    return f"{bits:016x}"
+
+
+def hash_distance(first: str, second: str) -> int:
+    return (int(first, 16) ^ int(second, 16)).bit_count()
+
+
+@contextmanager
+def text_layer_document(pdf_path: str | Path) -> Iterator[pdfium.PdfDocument]:
+    """The PDF opened for `text_layer_lines`, opened and closed under the pdfium lock."""
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        yield pdf
+    finally:
+        with pdfium_lock:
+            pdf.close()
+
+
+def text_layer_lines(pdf: pdfium.PdfDocument, page_index: int) -> list[str]:
+    """Lines of the text layer of a page, whitespace collapsed. Empty for scanned pages."""
+    with pdfium_lock:
+        page = pdf[page_index - 1]
+        textpage = page.get_textpage()
+        try:
+            text = textpage.get_text_bounded()
+        finally:
+            textpage.close()
+            page.close()
+    return [" ".join(line.split()) for line in text.splitlines() if line.strip()]
+
+
+def _is_missing(value: str | None) -> bool:
+    return not value or value.strip().upper().startswith(NOT_AVAILABLE)
+
+
+def _words(value: str) -> str:
+    return " ".join(re.findall(r"\w+", value.casefold()))
+
+
+def _printed(value: str, lines: list[str]) -> bool:
+    """Whether a value appears on the text layer lines, amounts compared by value."""
+    number = parse_number(value) if AMOUNT_PATTERN.fullmatch(value) else None
+    if number is not None:
+        return any(
+            (amount := parse_number(match.group())) is not None and abs(amount - number) < 0.005  # noqa: PLR2004
+            for line in lines
+            for match in AMOUNT_PATTERN.finditer(line)
+        )
+    return f" {_words(value)} " in f" {_words(' '.join(lines))} "
+
+
+class FieldRule(BaseModel):
+    """
+    Where a field is read on the text layer: after the label on the `occurrence`th line
+    starting with `label`, over `lines` lines. A rule without label holds a constant value,
+    read only from pages printing it.
+    """
+
+    label: str = ""
+    occurrence: int = 0
+    lines: int = 1
+    value: str = ""
+
+    def read(self, lines: list[str]) -> str | None:
+        if not self.label:
+            return self.value if _printed(self.value, lines) else None
+        starts = [index for index, line in enumerate(lines) if line.startswith(self.label)]
+        if len(starts) <= self.occurrence:
+            return None
+        start = starts[self.occurrence]
+        text = " ".join([lines[start][len(self.label) :], *lines[start + 1 : start + self.lines]])
+        return text.strip(LABEL_SEPARATORS) or None
+
+
+def _reads(rule: FieldRule, lines: list[str], value: str | float) -> bool:
+    text = rule.read(lines)
+    if text is None:
+        return False
+    if isinstance(value, float):
+        number = parse_number(text) if AMOUNT_PATTERN.fullmatch(text) else None
+        return number is not None and abs(number - value) < 0.005  # noqa: PLR2004
+    return _words(text) == _words(value)
+
+
+def learn_rules(lines: list[str], value: str | float, constant: bool = True) -> list[FieldRule]:
+    """
+    Every rule reading `value` from the text layer lines, labelled by the text before the
+    value on its line, and last, when `constant`, a constant rule for a value not printed as read.
+    """
+    rules = []
+    spans = [1] if isinstance(value, float) else range(1, MAX_VALUE_LINES + 1)
+    for start, line in enumerate(lines):
+        for boundary in re.finditer(r"[\s:]+", line):
+            label = line[: boundary.start()].rstrip(LABEL_SEPARATORS)
+            if not re.search(r"[A-Za-z]", label):
+                continue
+            occurrence = sum(previous.startswith(label) for previous in lines[:start])
+            rule = next(
+                (
+                    rule
+                    for span in spans
+                    if _reads(rule := FieldRule(label=label, occurrence=occurrence, lines=span), lines, value)
+                ),
+                None,
+            )
+            if rule is not None and rule not in rules:
+                rules.append(rule)
+    return [*rules, FieldRule(value=str(value))] if constant else rules
+
+
+def _template_fields(invoice: Invoice) -> list[str]:
+    bins = [f"{BUYER_PREFIX}BIN_Details[{index}].BIN_Number" for index in range(len(invoice.buyer_details.BIN_Details))]
+    return [*TEMPLATE_TEXT_FIELDS, *bins, *TEMPLATE_AMOUNT_FIELDS]
+
+
+def learn_sample(invoice: Invoice, lines: list[str]) -> dict[str, list[FieldRule] | None]:
+    """
+    Rules of each template field of an extracted invoice, None for the fields absent on the page.
+    The buyer fields get labelled rules only, the buyer changes between invoices of a seller.
+    """
+    sample: dict[str, list[FieldRule] | None] = {}
+    for path in _template_fields(invoice):
+        value = field_value(invoice, path)
+        absent = not value or (isinstance(value, str) and _is_missing(value))
+        sample[path] = None if absent else learn_rules(lines, value, constant=not path.startswith(BUYER_PREFIX))
+    return sample
+
+
+def seller_gstin(invoice: Invoice) -> str | None:
+    for bin_details in invoice.seller_details.BIN_Details:
+        if bin_details.BIN_Type.strip().upper() == "GSTIN" and is_valid_gstin(bin_details.BIN_Number):
+            return bin_details.BIN_Number.strip().upper()
+    return None
+
+
+class VendorTemplate(BaseModel):
+    """
+    Layout of the invoices of one seller, learned from the rules of its last extractions.
+    """
+
+    seller_gstin: str
+    fingerprint: str
+    seller_details: CompanyDetails
+    buyer_bin_types: list[str] = Field(default_factory=list)
+    samples: list[dict[str, list[FieldRule] | None]] = Field(default_factory=list)
+
+    def rules(self, min_samples: int) -> dict[str, FieldRule] | None:
+        """
+        The first rule of each field every one of the last `min_samples` samples learned. None
+        when they share no rule for a field or do not read the required fields. A field absent
+        on some samples, or a buyer field, needs a labelled rule, a constant would fill it on every page.
+        """
+        if len(self.samples) < min_samples:
+            return None
+        recent = self.samples[-min_samples:]
+        rules = {}
+        for path in {path for sample in recent for path in sample}:
+            learned = [sample.get(path) for sample in recent]
+            found = [candidates for candidates in learned if candidates is not None]
+            if not found:
+                continue
+            shared = [
+                rule
+                for rule in found[0]
+                if all(rule in candidates for candidates in found[1:])
+                and (rule.label or (len(found) == len(learned) and not path.startswith(BUYER_PREFIX)))
+            ]
+            if not shared:
+                return None
+            rules[path] = shared[0]
+        return rules if all(path in rules for path in REQUIRED_FIELDS) else None
+
+    def prefill(self, lines: list[str], min_samples: int) -> Invoice | None:
+        """Invoice of a page with the seller details and the header fields read from its text layer."""
+        rules = self.rules(min_samples)
+        if rules is None:
+            return None
+        values = {path: rule.read(lines) for path, rule in rules.items()}
+        # A page reading no total is not a whole invoice, e.g. the first page of a longer one
+        if (
+            any(_is_missing(values[path]) for path in REQUIRED_FIELDS)
+            or parse_number(values["total_amount"] or "") is None
+        ):
+            return None
+        invoice = Invoice(
+            seller_details=self.seller_details.model_copy(deep=True),
+            buyer_details=CompanyDetails(
+                BIN_Details=[BusinessIdNumber(BIN_Type=bin_type) for bin_type in self.buyer_bin_types]
+            ),
+        )
+        invoice, _ = apply_corrections(invoice, [(path, value) for path, value in values.items() if value is not None])
+        return invoice
+
+
+def assemble_invoice(prefilled: Invoice, items: list[Item] | None, page_no: int) -> Invoice | None:
+    """
+    Invoice of a template page from its prefilled header and the line items read from the
+    page, the total tax summed from the items. None when it does not reconcile.
+    """
+    if not items:
+        return None
+    taxes: dict[tuple[str, float], float] = {}
+    for item in items:
+        for tax in item.tax:
+            taxes[tax.Tax_Type, tax.Tax_Rate] = taxes.get((tax.Tax_Type, tax.Tax_Rate), 0.0) + tax.Tax_Amount
+    invoice = prefilled.model_copy(
+        update={
+            "items": items,
+            "total_tax": [
+                TaxComponents(Tax_Type=tax_type, Tax_Rate=rate, Tax_Amount=round(amount, 2))
+                for (tax_type, rate), amount in taxes.items()
+            ],
+            "page_no": str(page_no),
+        }
+    )
+    failures = check_invoice(invoice)
+    if failures:
+        logger.info(f"Template extraction of page {page_no} does not reconcile - {'; '.join(failures.values())}")
+        return None
+    return invoice
+
+
+def invoice_metadata(invoice: Invoice) -> dict[str, str | bool]:
+    """Page metadata of a page holding the whole `invoice`, as the vision stage reports it."""
+    return {
+        "invoice_number": invoice.invoice_number,
+        "line_item_start_number": str(invoice.items[0].slno) if invoice.items else NOT_AVAILABLE,
+        "line_item_end_number": str(invoice.items[-1].slno) if invoice.items else NOT_AVAILABLE,
+        "line_items_present": bool(invoice.items),
+        "total_invoice_amount": str(invoice.total_amount) if invoice.total_amount else NOT_AVAILABLE,
+        "seller_details_present": invoice.seller_details.name != NOT_AVAILABLE,
+        "buyer_details_present": invoice.buyer_details.name != NOT_AVAILABLE,
+        "invoice_date_present": invoice.invoice_date != NOT_AVAILABLE,
+        "invoice_due_date_present": invoice.invoice_due_date != NOT_AVAILABLE,
+        "total_tax_details_present": bool(invoice.total_tax),
+        "total_charges_present": bool(invoice.total_charge),
+        "total_discount_present": bool(invoice.total_discount),
+        "amount_paid_present": bool(invoice.amount_paid),
+        "amount_due_present": bool(invoice.amount_due),
+    }
+
+
+class VendorTemplateStore:
+    """
+    Learned layouts of repeat sellers, keyed by seller GSTIN and the fingerprint of the
+    page header, kept in a JSON file. Pages of digital PDFs whose text layer shows the GSTIN
+    of a template with a close fingerprint get their header fields read locally.
+    """
+
+    def __init__(self, config: InvoiceParserConfig) -> None:
+        self.path = Path(config.TEMPLATE_STORE_PATH or "")
+        self.min_samples = config.TEMPLATE_MIN_SAMPLES
+        self.max_distance = config.TEMPLATE_MAX_HASH_DISTANCE
+        self._lock = threading.Lock()
+        self.templates: list[VendorTemplate] | None = None
+
+    def _load(self) -> list[VendorTemplate]:
+        if self.templates is None:
+            self.templates = []
+            if self.path.exists():
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                self.templates = [VendorTemplate.model_validate(template) for template in data.get("templates", [])]
+        return self.templates
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        staging = self.path.with_suffix(".tmp")
+        templates = [template.model_dump() for template in self._load()]
+        staging.write_text(json.dumps({"templates": templates}), encoding="utf-8")
+        staging.replace(self.path)
+
+    def clear(self) -> None:
+        """Forget every template and delete the store file."""
+        with self._lock:
+            self.templates = []
+            self.path.unlink(missing_ok=True)
+
+    def _find(self, gstin: str, fingerprint: str) -> VendorTemplate | None:
+        candidates = [
+            template
+            for template in self._load()
+            if template.seller_gstin == gstin and hash_distance(template.fingerprint, fingerprint) <= self.max_distance
+        ]
+        return min(candidates, key=lambda template: hash_distance(template.fingerprint, fingerprint), default=None)
+
+    def prefill_pages(self, pdf_path: str | Path, pages: list[tuple[int, Path]]) -> dict[int, Invoice]:
+        """Prefilled invoice of each of the (page index, image path) pages of a known vendor layout."""
+        prefilled = {}
+        with text_layer_document(pdf_path) as pdf:
+            for page_index, image_path in pages:
+                lines = text_layer_lines(pdf, page_index)
+                if not lines:
+                    continue
+                compact = "".join(lines).upper().replace(" ", "")
+                fingerprint = layout_fingerprint(image_path)
+                with self._lock:
+                    templates = [
+                        template
+                        for gstin in {template.seller_gstin for template in self._load()}
+                        if gstin in compact
+                        for template in [self._find(gstin, fingerprint)]
+                        if template is not None
+                    ]
+                for template in templates:
+                    invoice = template.prefill(lines, self.min_samples)
+                    if invoice is not None:
+                        logger.info(f"Page {page_index} matches the template of seller {template.seller_gstin}")
+                        prefilled[page_index] = invoice
+                        break
+        return prefilled
+
+    def learn_pages(self, pdf_path: str | Path, pages: list[tuple[int, Path, Invoice]]) -> int:
+        """
+        Record the rules of the (page index, image path, invoice) pages holding a whole invoice
+        whose seller has a valid GSTIN. Returns the number of pages learned from.
+        """
+        learned = 0
+        with text_layer_document(pdf_path) as pdf:
+            for page_index, image_path, invoice in pages:
+                gstin = seller_gstin(invoice)
+                lines = text_layer_lines(pdf, page_index) if gstin else []
+                if gstin is None or not lines or not invoice.total_amount or check_invoice(invoice):
+                    continue
+                fingerprint = layout_fingerprint(image_path)
+                with self._lock:
+                    template = self._find(gstin, fingerprint)
+                    if template is None:
+                        template = VendorTemplate(
+                            seller_gstin=gstin, fingerprint=fingerprint, seller_details=invoice.seller_details
+                        )
+                        self._load().append(template)
+                    template.seller_details = invoice.seller_details
+                    template.buyer_bin_types = [
+                        bin_details.BIN_Type for bin_details in invoice.buyer_details.BIN_Details
+                    ]
+                    template.samples = [*template.samples, learn_sample(invoice, lines)][-self.min_samples :]
+                learned += 1
+        if learned:
+            with self._lock:
+                self._save()
+        return learned
+
+
+_stores: dict[str, VendorTemplateStore] = {}
+
+
+def vendor_template_store(config: InvoiceParserConfig) -> VendorTemplateStore | None:
+    """The process wide template store of `TEMPLATE_STORE_PATH`, None when templates are disabled."""
+    if not config.TEMPLATE_STORE_PATH:
+        return None
+    if config.TEMPLATE_STORE_PATH not in _stores:
+        _stores[config.TEMPLATE_STORE_PATH] = VendorTemplateStore(config)
+    return _stores[config.TEMPLATE_STORE_PATH]
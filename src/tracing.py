@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+
+
+class TraceRecorder:
+    """
+    Records spans of a workflow run as Chrome trace events, viewable in
+    chrome://tracing or Perfetto. Each asyncio task and worker thread gets its own
+    track so overlapping page calls do not collapse into one row.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.origin = time.perf_counter()
+        self.events: list[dict[str, Any]] = []
+        self.tracks: dict[Any, int] = {}
+        self._lock = threading.Lock()
+
+    def _track(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = ("task", id(task)) if task is not None else ("thread", threading.get_ident())
+        with self._lock:
+            if key not in self.tracks:
+                self.tracks[key] = len(self.tracks) + 1
+                track_name = task.get_name() if task is not None else threading.current_thread().name
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": self.tracks[key],
+                        "args": {"name": track_name},
+                    }
+                )
+            return self.tracks[key]
+
+    def _timestamp(self, counter: float) -> float:
+        return (counter - self.origin) * 1_000_000
+
+    def add_span(self, name: str, category: str, start: float, end: float, args: dict[str, Any]) -> None:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": self._timestamp(start),
+            "dur": (end - start) * 1_000_000,
+            "pid": os.getpid(),
+            "tid": self._track(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def to_chrome_trace(self) -> dict[str, Any]:
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event.get("ts", -1))
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"document": self.name}}
+
+    def write(self, path: str | Path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_chrome_trace()), encoding="utf-8")
+        return path
+
+
+current_trace: ContextVar[TraceRecorder | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def trace_span(name: str, category: str, **args: Any) -> Iterator[None]:
+    """Record a span on the trace of the current run, a no-op when no trace is recorded."""
+    recorder = current_trace.get()
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_span(name, category, start, time.perf_counter(), args)
+
+
+@contextmanager
+def record_trace(name: str, path: str | Path | None) -> Iterator[TraceRecorder | None]:
+    """Record the spans of the enclosed run and write them as a Chrome trace to `path`."""
+    if path is None:
+        yield None
+        return
+    recorder = TraceRecorder(name)
+    token = current_trace.set(recorder)
+    try:
+        yield recorder
+    finally:
+        current_trace.reset(token)
+        recorder.write(path)
@@ -2,12 +2,19 @@ import asyncio
 import io
 import os
 import re
+import threading
 from collections.abc import Mapping
 from pathlib import Path
 from typing import AsyncGenerator
 
 from PIL import Image
 from pydantic_ai.models import Model
+from pydantic_ai.usage import Usage
+
+from src.replay import active_replay_session
+
+# PDFium is not thread safe, every pypdfium2 call holds this lock, on the event loop or a worker thread
+pdfium_lock = threading.Lock()
 
 
 async def async_range(count: int) -> AsyncGenerator[int, None]:
@@ -38,12 +45,41 @@ async def sorted_images(image_dir: str | Path, image_ext: str = "png") -> AsyncG
         yield img_path, page_no
 
 
-def image_to_byte_string(image_path: str | Path) -> tuple[bytes, str]:
+def image_to_byte_string(
+    image_path: str | Path, scale: float = 1.0, box: tuple[int, int, int, int] | None = None
+) -> tuple[bytes, str]:
     image = Image.open(image_path)
+    mimetype = image.get_format_mimetype() or "image/png"
+    if box is not None:
+        image = image.crop(box)
+    if scale < 1.0:
+        # Downscaled pages cost fewer image tokens, used when a document is over its token budget
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
     img_byte_arr = io.BytesIO()
     image.save(img_byte_arr, format="PNG")  # or 'JPEG', etc.
     img_byte_arr = img_byte_arr.getvalue()
-    return img_byte_arr, image.get_format_mimetype() or "image/png"
+    return img_byte_arr, mimetype
+
+
+def text_line_spans(image_path: str | Path, ink_threshold: int = 160) -> tuple[list[tuple[int, int]], tuple[int, int]]:
+    """
+    Vertical spans of the text lines of a page image, runs of pixel rows holding any ink,
+    and the image size.
+    """
+    with Image.open(image_path) as image:
+        ink = image.convert("L").point(lambda value: 255 if value < ink_threshold else 0)
+    _, rows = ink.getprojection()
+    spans: list[tuple[int, int]] = []
+    start = None
+    for y, value in enumerate(rows):
+        if value and start is None:
+            start = y
+        elif not value and start is not None:
+            spans.append((start, y))
+            start = None
+    if start is not None:
+        spans.append((start, ink.height))
+    return spans, ink.size
 
 
 def extract_json_from_text(text: str) -> str | None:
@@ -80,6 +116,59 @@ def replace_json_from_text(text: str) -> str:
     return cleaned_text.strip()
 
 
+def cached_token_count(usage: Usage) -> int | None:
+    """Request tokens served from the provider prompt cache, as reported in the usage details."""
+    details = usage.details or {}
+    return details.get("cached_tokens") or None
+
+
+def estimate_image_tokens(image_size: tuple[int, int]) -> int:
+    """Rough estimate of the input tokens a vision model charges for an image of the given size."""
+    width, height = image_size
+    return max(1, int(width * height / 750))
+
+
+def split_usage(usage: Usage, parts: int, index: int) -> Usage:
+    """Split the usage of a shared request evenly, the remainder is assigned to the first part."""
+
+    def _split(token_count: int | None) -> int | None:
+        if not token_count:
+            return None
+        share, remainder = divmod(token_count, parts)
+        return share + remainder if index == 0 else share
+
+    return Usage(
+        requests=1 if index == 0 else 0,
+        request_tokens=_split(usage.request_tokens),
+        response_tokens=_split(usage.response_tokens),
+        details={"cached_tokens": _split(cached_token_count(usage)) or 0},
+    )
+
+
+def split_multi_page_output(text: str, page_nos: list[int]) -> dict[int, str]:
+    """
+    Split the response of a multi page request into the output of each page.
+
+    Args:
+        text: The model response with a `=== PAGE <no> ===` marker line before each page output
+        page_nos: The page numbers sent in the request
+    Returns:
+        The page outputs keyed by page number, pages with a missing, duplicated
+        or empty section are left out so that they can be processed again
+    """
+    marker_pattern = r"^\s*=+\s*PAGE\s*(?:NO\.?)?\s*(\d+)\s*=+\s*$"
+    markers = list(re.finditer(marker_pattern, text, re.MULTILINE | re.IGNORECASE))
+    sections: dict[int, list[str]] = {}
+    for index, marker in enumerate(markers):
+        end = markers[index + 1].start() if index + 1 < len(markers) else len(text)
+        sections.setdefault(int(marker.group(1)), []).append(text[marker.end() : end].strip())
+    return {
+        page_no: sections[page_no][0]
+        for page_no in page_nos
+        if page_no in sections and len(sections[page_no]) == 1 and sections[page_no][0]
+    }
+
+
 DEFAULT_INVOICE_METADATA = {
     "invoice_number": "NOT_AVAILABLE",
     "line_item_start_number": "NOT_AVAILABLE",
@@ -142,25 +231,37 @@ def extract_invoice_metadata(text: str) -> Mapping[str, str | bool]:
     return metadata
 
 
-def model_factory(model_name: str, provider: str = "openai") -> Model:
+def model_factory(model_name: str, provider: str = "openai", prompt_cache: bool = False) -> Model:
     """
     Factory function to create a model instance based on the model name and provider.
 
     Args:
         model_name: The name of the model to instantiate.
         provider: The provider of the model (default is "openai").
+        prompt_cache: Enable provider prompt caching where the model supports it,
+            OpenAI caches stable prompt prefixes automatically.
 
     Returns:
-        An instance of the specified model.
+        An instance of the specified model, wrapped for recording or replaced by a
+        replay model when a replay session is active.
     """
+    session = active_replay_session()
+    if session is not None:
+        return session.model(model_name, lambda: _provider_model(model_name, provider, prompt_cache))
+    return _provider_model(model_name, provider, prompt_cache)
+
+
+def _provider_model(model_name: str, provider: str, prompt_cache: bool) -> Model:
     if provider == "aws_bedrock":
         from pydantic_ai.models.bedrock import BedrockConverseModel
         from pydantic_ai.providers.bedrock import BedrockProvider
 
-        return BedrockConverseModel(
-            model_name=model_name,
-            provider=BedrockProvider(**get_aws_keys()),
-        )
+        from src.prompt_cache import CachedBedrockConverseModel, bedrock_supports_prompt_cache
+
+        bedrock_provider = BedrockProvider(**get_aws_keys())
+        if prompt_cache and bedrock_supports_prompt_cache(model_name):
+            return CachedBedrockConverseModel(model_name, provider=bedrock_provider)
+        return BedrockConverseModel(model_name=model_name, provider=bedrock_provider)
     if provider == "openai":
         from pydantic_ai.models.openai import OpenAIModel
 
@@ -0,0 +1,216 @@
+import re
+from collections.abc import Callable, Iterable, Mapping
+from typing import Any
+
+from src.output_format import Invoice, Item
+from src.structured_text import parse_number, parse_structured_text
+
+AMOUNT_TOLERANCE = 1.0
+RELATIVE_TOLERANCE = 0.005
+NOT_AVAILABLE = "NOT_AVAILABLE"
+GSTIN_CHARACTERS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+GSTIN_PATTERN = re.compile(r"\d{2}[0-9A-Z]{13}")
+FIELD_PATH_PATTERN = re.compile(r"(?P<name>\w+)(?:\[(?P<index>\d+)\])?")
+
+# Page metadata flags and the value of the extracted page they promise
+PRESENT_FIELDS: dict[str, Callable[[Invoice], Any]] = {
+    "seller_details_present": lambda invoice: invoice.seller_details.name,
+    "buyer_details_present": lambda invoice: invoice.buyer_details.name,
+    "invoice_date_present": lambda invoice: invoice.invoice_date,
+    "invoice_due_date_present": lambda invoice: invoice.invoice_due_date,
+    "line_items_present": lambda invoice: invoice.items,
+    "total_tax_details_present": lambda invoice: invoice.total_tax,
+    "total_charges_present": lambda invoice: invoice.total_charge,
+    "total_discount_present": lambda invoice: invoice.total_discount,
+    "amount_paid_present": lambda invoice: invoice.amount_paid,
+    "amount_due_present": lambda invoice: invoice.amount_due,
+}
+
+
+def amounts_match(value: float, expected: float) -> bool:
+    """Compare two amounts allowing for rounding off on the invoice."""
+    return abs(value - expected) <= max(AMOUNT_TOLERANCE, RELATIVE_TOLERANCE * abs(expected))
+
+
+def check_totals(invoice: Invoice) -> list[str]:
+    """
+    Check that a complete invoice is internally consistent.
+
+    Args:
+        invoice: The invoice to check, it must contain all the line items of the invoice
+    Returns:
+        A list of failed checks, empty when the invoice reconciles
+    """
+    return list(_total_checks(invoice).values())
+
+
+def _total_checks(invoice: Invoice) -> dict[str, str]:
+    failures = {}
+    if invoice.invoice_number == "NOT_AVAILABLE":
+        failures["invoice_number"] = "invoice_number is missing"
+    if invoice.items and invoice.total_amount:
+        items_total = sum(item.amount for item in invoice.items)
+        tax_total = sum(tax.Tax_Amount for tax in invoice.total_tax)
+        with_charges = items_total + tax_total + invoice.total_charge - invoice.total_discount
+        if not any(amounts_match(value, invoice.total_amount) for value in [items_total, with_charges]):
+            failures["total_amount"] = (
+                f"sum of item amounts {items_total:.2f} does not reconcile with total_amount {invoice.total_amount:.2f}"
+            )
+    if invoice.amount_paid and invoice.amount_due and invoice.total_amount:
+        paid_and_due = invoice.amount_paid + invoice.amount_due
+        if not amounts_match(paid_and_due, invoice.total_amount):
+            failures["amount_due"] = (
+                f"amount_paid + amount_due {paid_and_due:.2f} does not match total_amount {invoice.total_amount:.2f}"
+            )
+    return failures
+
+
+def gstin_check_character(gstin: str) -> str:
+    """Check character of a GSTIN from its first 14 characters, the mod 36 Luhn scheme of the GST network."""
+    total = 0
+    for index, char in enumerate(gstin[:14].upper()):
+        value = GSTIN_CHARACTERS.index(char) * (2 if index % 2 else 1)
+        total += value // 36 + value % 36
+    return GSTIN_CHARACTERS[(36 - total % 36) % 36]
+
+
+def is_valid_gstin(gstin: str) -> bool:
+    gstin = gstin.strip().upper()
+    return GSTIN_PATTERN.fullmatch(gstin) is not None and gstin[14] == gstin_check_character(gstin)
+
+
+def _item_amount_matches(item: Item) -> bool:
+    """The amount of a line item is its quantity times price, less discount, with or without its taxes."""
+    if not (item.quantity and item.price and item.amount):
+        return True
+    gross = item.quantity * item.price
+    net = gross - item.discount
+    with_tax = net + sum(tax.Tax_Amount for tax in item.tax)
+    return any(amounts_match(item.amount, expected) for expected in (gross, net, with_tax))
+
+
+def check_invoice(invoice: Invoice, complete: bool = True) -> dict[str, str]:
+    """
+    Check the arithmetic of an invoice and the GSTIN checksums field by field.
+
+    Args:
+        invoice: The invoice to check
+        complete: The invoice holds all its line items, so the totals must reconcile with them
+    Returns:
+        The failed checks keyed by the path of the field to correct, e.g. `items[2].amount`
+    """
+    failures = {}
+    for index, item in enumerate(invoice.items):
+        if not _item_amount_matches(item):
+            failures[f"items[{index}].amount"] = (
+                f"amount {item.amount:.2f} does not match quantity {item.quantity:g} x price {item.price:.2f}"
+            )
+    for party in ("seller_details", "buyer_details"):
+        for index, bin_details in enumerate(getattr(invoice, party).BIN_Details):
+            number = bin_details.BIN_Number
+            if (
+                bin_details.BIN_Type.strip().upper() == "GSTIN"
+                and number != NOT_AVAILABLE
+                and not is_valid_gstin(number)
+            ):
+                failures[f"{party}.BIN_Details[{index}].BIN_Number"] = f"GSTIN {number} fails its checksum"
+    if not complete:
+        return failures
+    items_tax = sum(tax.Tax_Amount for item in invoice.items for tax in item.tax)
+    total_tax = sum(tax.Tax_Amount for tax in invoice.total_tax)
+    if items_tax and total_tax and not amounts_match(items_tax, total_tax):
+        failures["total_tax"] = f"sum of item taxes {items_tax:.2f} does not match total_tax {total_tax:.2f}"
+    return failures | _total_checks(invoice)
+
+
+def _resolve(invoice: Invoice, path: str) -> tuple[Any, str] | None:
+    """Model holding the field at `path` and the field name, None when the path does not exist."""
+    parent: Any = invoice
+    segments = path.split(".")
+    for position, segment in enumerate(segments, start=1):
+        match = FIELD_PATH_PATTERN.fullmatch(segment.strip())
+        if match is None or not hasattr(parent, match.group("name")):
+            return None
+        if position == len(segments) and match.group("index") is None:
+            return parent, match.group("name")
+        parent = getattr(parent, match.group("name"))
+        if match.group("index") is not None:
+            index = int(match.group("index"))
+            if not isinstance(parent, list) or index >= len(parent):
+                return None
+            parent = parent[index]
+    return None
+
+
+def field_value(invoice: Invoice, path: str) -> Any:
+    """Value of the scalar field at `path` of an invoice, None when the path does not exist."""
+    resolved = _resolve(invoice, path)
+    return None if resolved is None else getattr(*resolved)
+
+
+def apply_corrections(invoice: Invoice, corrections: Iterable[tuple[str, Any]]) -> tuple[Invoice, list[str]]:
+    """
+    Copy of an invoice with the corrected values of scalar fields, given as (path, value).
+    Values are converted to the type of the field, corrections which do not fit are skipped.
+
+    Returns:
+        The corrected invoice and the paths of the fields corrected
+    """
+    corrected = invoice.model_copy(deep=True)
+    applied = []
+    for path, value in corrections:
+        resolved = _resolve(corrected, path)
+        if resolved is None:
+            continue
+        parent, name = resolved
+        current = getattr(parent, name)
+        if isinstance(current, str):
+            setattr(parent, name, str(value).strip())
+        elif isinstance(current, (int, float)) and not isinstance(current, bool):
+            number = parse_number(str(value))
+            if number is None:
+                continue
+            setattr(parent, name, type(current)(number))
+        else:
+            continue
+        applied.append(path)
+    return corrected, applied
+
+
+def _is_flagged(value: object) -> bool:
+    return value is True or str(value).strip().lower() == "true"
+
+
+def _is_missing(value: object) -> bool:
+    return not value or (isinstance(value, str) and value.strip().upper() == NOT_AVAILABLE)
+
+
+def check_extraction(text_content: str, metadata: Mapping[str, Any], max_missing_share: float) -> list[str]:
+    """
+    Check that the vision output of a page reads reliably.
+
+    Args:
+        text_content: The structured text of the page
+        metadata: The page metadata extracted with it
+        max_missing_share: Share of the fields flagged present which may read NOT_AVAILABLE
+    Returns:
+        A list of failed checks, empty when the page reads reliably or holds no invoice
+    """
+    if re.search(r"\bNO_INVOICE_FOUND", text_content, re.IGNORECASE):
+        return []
+    if not metadata:
+        return ["page metadata is missing"]
+    failures = []
+    if _is_missing(metadata.get("invoice_number")):
+        failures.append("invoice_number is missing")
+    invoice = parse_structured_text(text_content).invoice
+    if invoice is None:
+        return failures
+    flagged = [read for flag, read in PRESENT_FIELDS.items() if _is_flagged(metadata.get(flag))]
+    missing = sum(_is_missing(read(invoice)) for read in flagged)
+    if flagged and missing / len(flagged) > max_missing_share:
+        failures.append(f"{missing} of {len(flagged)} fields flagged present are NOT_AVAILABLE")
+    # Only a page starting with the first line item can hold the whole invoice its totals cover
+    if invoice.items and invoice.items[0].slno == 1:
+        failures.extend(failure for failure in check_totals(invoice) if not failure.startswith("invoice_number"))
+    return failures
@@ -1,14 +1,23 @@
+import asyncio
+import contextlib
 from asyncio.log import logger
 from dataclasses import dataclass
 from pathlib import Path
 
 from pydantic_graph import BaseNode, End, Graph, GraphRunContext
 
+from src.budget import plan_budget, tenant_ledger
 from src.config import app_config
+from src.memory import profile_memory
+from src.metrics import metrics, record_token_counts, timed_node
+from src.output_format import Invoice, TokenCount
+from src.parties import party_index
+from src.scheduler import Lane, scheduling_lane
+from src.templates import vendor_template_store
+from src.tracing import record_trace
 
-from .nodes import ImageToTextConverter, PageAggregator, PageGroupper, Pdf2ImgConverter, SinglePageFormator
+from .nodes import ImageToTextConverter, PageAggregator, PageGroupper, SinglePageFormator, pdf_converter_factory
 from .state import (
-    PageDetails,
     PageGroup,
     WorkflowState,
 )
@@ -16,20 +25,25 @@ from .state import (
 
 @dataclass
 class PageAggregatorNode(BaseNode[WorkflowState, None, str]):
+    @timed_node
     async def run(self, ctx: GraphRunContext[WorkflowState, None]) -> End[str]:
         logger.info("Running Page Aggregation")
         agent = PageAggregator(app_config)
         for group in ctx.state.page_group_info:
-            pages_2_process = group.pages
-            invoices_2_process = [
-                p_data.invoice
+            pages_2_process = [
+                p_data
                 for p_data in ctx.state.page_details
-                if p_data.page_index in pages_2_process and p_data.invoice is not None
+                if p_data.page_index in group.pages and p_data.invoice is not None
             ]
+            invoices_2_process = [p_data.invoice for p_data in pages_2_process if p_data.invoice is not None]
             if len(invoices_2_process) == 1:
                 ctx.state.final_output.append(invoices_2_process[0])
                 continue
-            invoice = await agent.run(invoices=invoices_2_process, merger_stratagy=group.details)
+            invoice = await agent.run(
+                invoices=invoices_2_process,
+                merger_stratagy=group.details,
+                pages=[(p_data.page_index, p_data.metadata) for p_data in pages_2_process],
+            )
             ctx.state.final_output.append(invoice)
         return End(data="Processing Completed")
 
@@ -38,34 +52,42 @@ class PageAggregatorNode(BaseNode[WorkflowState, None, str]):
 class PageFormatterNode(BaseNode[WorkflowState, None, str]):
     task_type: str = "simple"
 
+    @timed_node
     async def run(self, ctx: GraphRunContext[WorkflowState, None]) -> End[str] | PageAggregatorNode:
-        page_formatter = SinglePageFormator(app_config)
-
-        response, error = await page_formatter.run(
-            [
-                (p_data.page_index, p_data.append_page_no(), dict(p_data.metadata))
-                for p_data in ctx.state.page_details
-                if p_data.is_invoice_page
-            ]
-        )
-        if error:
-            ctx.state.error = f"PageFormatterNode| {error}"
-            return End(data=ctx.state.error)
-        for page_no, invoice, t_count in response:
-            ctx.state.token_count.append(t_count)
-            for page_detail in ctx.state.page_details:
-                if page_detail.page_index == page_no:
-                    page_detail.invoice = invoice
-                    break
-            if self.task_type == "simple":
-                ctx.state.final_output.append(invoice)
+        pending_pages = ctx.state.pages_pending_formatting()
+        if self.task_type == "complex" and app_config.MERGER_STRATEGY == "strategy":
+            # Pages holding no hinted field are never read by the strategy merger
+            required_pages = ctx.state.pages_required_for_merge()
+            skipped_pages = [page_no for page_no in pending_pages if page_no not in required_pages]
+            if skipped_pages:
+                logger.info(f"Skipping formatting of pages {skipped_pages}, no merge hint points to them")
+                metrics.inc("formatter_pages_skipped_total", len(skipped_pages))
+            pending_pages = [page_no for page_no in pending_pages if page_no in required_pages]
+        if pending_pages:
+            response, error = await format_pages(ctx.state, pending_pages, reconcile_totals=self.task_type == "simple")
+            if error:
+                ctx.state.error = f"PageFormatterNode| {error}"
+                return End(data=ctx.state.error)
+            for _, _, t_counts in response:
+                ctx.state.add_token_counts(t_counts)
+            ctx.state.add_formatted_pages(response)
+            single_pages = (
+                pending_pages
+                if self.task_type == "simple"
+                else [group.pages[0] for group in ctx.state.page_group_info if group.is_single_page and group.pages]
+            )
+            await learn_templates(ctx.state, [formatted for formatted in response if formatted[0] in single_pages])
         if self.task_type == "simple":
+            ctx.state.final_output.extend(
+                p_data.invoice for p_data in ctx.state.page_details if p_data.is_invoice_page and p_data.invoice
+            )
             return End(data="Processing Completed")
         return PageAggregatorNode()
 
 
 @dataclass
 class PageGrouperNode(BaseNode[WorkflowState, None, str]):
+    @timed_node
     async def run(self, ctx: GraphRunContext[WorkflowState, None]) -> PageFormatterNode | End[str]:
         logger.info("Running Page Grouping")
         agent = PageGroupper(app_config)
@@ -73,11 +95,25 @@ class PageGrouperNode(BaseNode[WorkflowState, None, str]):
             f"P{p_data.page_index}": p_data.metadata for p_data in ctx.state.page_details if p_data.is_invoice_page
         }
         page_index = "-".join([str(p_data.page_index) for p_data in ctx.state.page_details])
-        page_group_info, token_expenditure, error = await agent.run(page_metadata=page_metadata, page_no=page_index)
+        speculative_pages = ctx.state.speculative_single_pages() if app_config.SPECULATIVE_FORMATTING else []
+        # Same checks as the complex PageFormatterNode, committed pages are not formatted again
+        speculation = (
+            asyncio.create_task(format_pages(ctx.state, speculative_pages, reconcile_totals=False))
+            if speculative_pages
+            else None
+        )
+        try:
+            page_group_info, token_expenditure, error = await agent.run(page_metadata=page_metadata, page_no=page_index)
+        except BaseException:
+            if speculation is not None:
+                await discard_speculation(ctx.state, speculation)
+            raise
         if error:
+            if speculation is not None:
+                await discard_speculation(ctx.state, speculation)
             ctx.state.error = f"PageGrouperNode| {error}"
             return End(data=error)
-        ctx.state.token_count.append(token_expenditure)
+        ctx.state.add_token_counts([token_expenditure])
         logger.info(f"Page Grouping Result: {page_group_info!s}")
         for key, value in page_group_info.items():
             logger.info(f"Key: {key}, Value: {value!s}")
@@ -88,24 +124,40 @@ class PageGrouperNode(BaseNode[WorkflowState, None, str]):
                     details=value.get("details", {}),
                 )
             )
+        if speculation is not None:
+            await commit_speculation(ctx.state, speculation)
         return PageFormatterNode(task_type="complex")
 
 
 @dataclass
 class TextExtractionNode(BaseNode[WorkflowState, None, str]):
+    @timed_node
     async def run(self, ctx: GraphRunContext[WorkflowState, None]) -> End[str] | PageFormatterNode | PageGrouperNode:
-        agent = ImageToTextConverter(app_config)
-        agent_response, error = await agent.run(ctx.state.image_dir)
-        if error:
-            ctx.state.error = f"TextExtractionNode| {error}"
-            return End(data=error)
-        for p_no, text_content, meta_data, t_count in agent_response:
-            ctx.state.token_count.append(t_count)
-            for p_data in ctx.state.page_details:
-                if p_data.page_index == p_no:
-                    p_data.text_content = text_content
-                    p_data.metadata = meta_data
-                    break
+        pending_pages = ctx.state.pages_pending_extraction()
+        if pending_pages:
+            agent = ImageToTextConverter(app_config)
+            image_scale = ctx.state.budget.image_scale if ctx.state.budget else 1.0
+            templates = await match_templates(ctx.state, pending_pages)
+            known_parties = await match_parties(ctx.state, [page for page in pending_pages if page not in templates])
+            agent_response, error = await agent.run(
+                ctx.state.image_dir,
+                pages=pending_pages,
+                image_scale=image_scale,
+                templates=templates,
+                known_parties=known_parties,
+            )
+            if error:
+                ctx.state.error = f"TextExtractionNode| {error}"
+                return End(data=error)
+            for p_no, text_content, meta_data, t_count in agent_response:
+                ctx.state.add_token_counts([t_count])
+                for p_data in ctx.state.page_details:
+                    if p_data.page_index == p_no:
+                        p_data.text_content = text_content
+                        p_data.metadata = meta_data
+                        # Template pages are formatted already, their line items reconcile with the totals
+                        p_data.invoice = agent.template_invoices.get(p_no)
+                        break
         valid_invoices_count = ctx.state.valid_invoice_count()
         unique_invoices_count = ctx.state.unique_invoice_count()
         logger.info(f"Valid Invoices Count: {valid_invoices_count}, Unique Invoices Count: {unique_invoices_count}")
@@ -120,59 +172,236 @@ class TextExtractionNode(BaseNode[WorkflowState, None, str]):
 
 
 @dataclass
-class PdfToImageNode(BaseNode[WorkflowState, None]):
+class PdfToImageNode(BaseNode[WorkflowState, None, str]):
     pdf_path: Path
 
-    async def run(self, ctx: GraphRunContext[WorkflowState, None]) -> TextExtractionNode:
-        converter = Pdf2ImgConverter(app_config)
+    @timed_node
+    async def run(self, ctx: GraphRunContext[WorkflowState, None]) -> TextExtractionNode | End[str]:
+        converter = pdf_converter_factory(app_config)
         image_directory, page_details = await converter.run(self.pdf_path)
-        ctx.state.image_dir = str(image_directory)
-        for page_no, page_name, img_size in page_details:
-            ctx.state.page_details.append(
-                PageDetails(
-                    page_index=page_no,
-                    image_path=page_name.name,
-                    image_size=img_size,
-                )
-            )
+        ctx.state.add_rendered_pages(image_directory, page_details)
+        error = check_budget(ctx.state)
+        if error:
+            ctx.state.error = f"PdfToImageNode| {error}"
+            return End(data=ctx.state.error)
         return TextExtractionNode()
 
 
+async def match_templates(state: WorkflowState, pages: list[int]) -> dict[int, Invoice]:
+    """Prefilled invoices of the `pages` matching a learned vendor template, empty when templates are disabled."""
+    store = vendor_template_store(app_config)
+    if store is None or not state.pdf_path:
+        return {}
+    image_paths = [
+        (p_data.page_index, Path(state.image_dir) / p_data.image_path)
+        for p_data in state.page_details
+        if p_data.page_index in pages
+    ]
+    try:
+        return await asyncio.to_thread(store.prefill_pages, state.pdf_path, image_paths)
+    except Exception as err:
+        logger.warning(f"Vendor template matching failed for {state.pdf_name} - {err!s}")
+        return {}
+
+
+async def match_parties(state: WorkflowState, pages: list[int]) -> dict[int, list[str]]:
+    """GSTINs of the parties on file printed on the text layer of each of the `pages`."""
+    index = party_index(app_config)
+    if index is None or not state.pdf_path or not pages:
+        return {}
+    try:
+        known = await asyncio.to_thread(index.known_pages, state.pdf_path, pages)
+    except Exception as err:
+        logger.warning(f"Party index matching failed for {state.pdf_name} - {err!s}")
+        return {}
+    metrics.inc("party_index_pages_total", len(known))
+    return known
+
+
+async def record_parties(state: WorkflowState) -> None:
+    """Record the sellers and buyers of the extracted invoices into the party index."""
+    index = party_index(app_config)
+    if index is None or state.error or not state.final_output:
+        return
+    try:
+        await asyncio.to_thread(index.record, state.final_output)
+    except Exception as err:
+        logger.warning(f"Party index update failed for {state.pdf_name} - {err!s}")
+
+
+async def learn_templates(state: WorkflowState, formatted: list[tuple[int, Invoice, list[TokenCount]]]) -> None:
+    """Record the formatted pages holding a whole invoice into the vendor templates."""
+    store = vendor_template_store(app_config)
+    if store is None or not state.pdf_path or not formatted:
+        return
+    image_paths = {p_data.page_index: Path(state.image_dir) / p_data.image_path for p_data in state.page_details}
+    try:
+        learned = await asyncio.to_thread(
+            store.learn_pages,
+            state.pdf_path,
+            [(page_no, image_paths[page_no], invoice) for page_no, invoice, _ in formatted],
+        )
+    except Exception as err:
+        logger.warning(f"Vendor template learning failed for {state.pdf_name} - {err!s}")
+        return
+    metrics.inc("template_pages_learned_total", learned)
+
+
+async def format_pages(
+    state: WorkflowState, pages: list[int], reconcile_totals: bool
+) -> tuple[list[tuple[int, Invoice, list[TokenCount]]], str | None]:
+    """
+    Format the structured text of `pages` into an Invoice each, the details of the parties
+    on file filled in from the party index. When formatting fails the token expense of the
+    calls made is recorded on the state, there are no pages to return it with.
+    """
+    page_formatter = SinglePageFormator(app_config)
+    response, error = await page_formatter.run(
+        [
+            (p_data.page_index, p_data.append_page_no(), dict(p_data.metadata))
+            for p_data in state.page_details
+            if p_data.page_index in pages
+        ],
+        reconcile_totals=reconcile_totals,
+    )
+    if error:
+        state.add_token_counts(page_formatter.error_token_counts)
+        return response, error
+    index = party_index(app_config)
+    if index is None:
+        return response, error
+    invoices = await asyncio.to_thread(lambda: [index.fill_invoice(invoice) for _, invoice, _ in response])
+    return [
+        (page_no, invoice, t_counts) for (page_no, _, t_counts), invoice in zip(response, invoices, strict=True)
+    ], None
+
+
+async def commit_speculation(
+    state: WorkflowState, speculation: asyncio.Task[tuple[list[tuple[int, Invoice, list[TokenCount]]], str | None]]
+) -> None:
+    """
+    Keep the speculatively formatted pages the grouper confirmed as single page invoices,
+    the other pages are formatted again with their group. The calls are paid either way.
+    """
+    response, error = await speculation
+    if error:
+        logger.warning(f"Speculative formatting failed, pages are formatted after grouping - {error}")
+        return
+    single_pages = {group.pages[0] for group in state.page_group_info if group.is_single_page and group.pages}
+    confirmed = [formatted for formatted in response if formatted[0] in single_pages]
+    for _, _, t_counts in response:
+        state.add_token_counts(t_counts)
+    state.add_formatted_pages(confirmed)
+    await learn_templates(state, confirmed)
+    metrics.inc("speculative_pages_total", len(confirmed), outcome="committed")
+    metrics.inc("speculative_pages_total", len(response) - len(confirmed), outcome="discarded")
+    logger.info(f"Speculative formatting confirmed for pages {[page_no for page_no, _, _ in confirmed]}")
+
+
+async def discard_speculation(
+    state: WorkflowState, speculation: asyncio.Task[tuple[list[tuple[int, Invoice, list[TokenCount]]], str | None]]
+) -> None:
+    """
+    Cancel the speculative formatting of a document whose grouping failed and wait for it,
+    the token expense of a speculation which finished before the cancellation is recorded.
+    """
+    speculation.cancel()
+    with contextlib.suppress(asyncio.CancelledError, Exception):
+        response, _ = await speculation
+        for _, _, t_counts in response:
+            state.add_token_counts(t_counts)
+        metrics.inc("speculative_pages_total", len(response), outcome="discarded")
+
+
+def check_budget(state: WorkflowState) -> str | None:
+    """
+    Plan the token budget of a rendered document before any model is called.
+    Returns the reason when the document is rejected.
+    """
+    decision = plan_budget(state.tenant, [p_data.image_size for p_data in state.page_details], app_config)
+    state.budget = decision
+    metrics.inc("budget_decisions_total", mode=decision.mode)
+    logger.info(
+        f"Estimated {decision.estimate.total_tokens} tokens, {decision.estimate.cost:.4f} USD for {state.pdf_name}"
+    )
+    if decision.mode == "reduced_resolution":
+        logger.warning(f"Over budget, page images of {state.pdf_name} are downscaled by {decision.image_scale}")
+    if decision.mode == "rejected":
+        return f"Budget exceeded, {decision.reason}"
+    return None
+
+
 workflow = Graph(nodes=[PdfToImageNode, TextExtractionNode, PageGrouperNode, PageFormatterNode, PageAggregatorNode])
 
 
-async def run_workflow(pdf_path: Path) -> WorkflowState:
+def export_metrics(state: WorkflowState) -> None:
+    """
+    Record the token expense of a finished run against its tenant and write the metrics export if configured.
+    """
+    record_token_counts(state.token_count)
+    reserved = state.budget.estimate if state.budget and state.budget.mode != "rejected" else None
+    tenant_ledger.settle(state.tenant, reserved, state.usage)
+    if app_config.METRICS_EXPORT_PATH:
+        metrics.export(app_config.METRICS_EXPORT_PATH, app_config.METRICS_EXPORT_FORMAT)
+
+
+async def run_workflow(pdf_path: Path, tenant: str = "default", lane: Lane = "interactive") -> WorkflowState:
     """
     Run the workflow to process the PDF and extract invoice information.
+    The spend of the document is charged to the daily budget of `tenant`, its model calls
+    queue in the `lane` scheduling lane.
     """
-    initial_state = WorkflowState(pdf_name=pdf_path.name)
+    initial_state = WorkflowState(pdf_name=pdf_path.name, pdf_path=str(pdf_path), tenant=tenant)
 
     logger.info(f"Starting workflow for PDF: {pdf_path.name}")
-    try:
-        _ = await workflow.run(PdfToImageNode(pdf_path), state=initial_state)
-    except Exception as e:
-        logger.error(f"Workflow failed with error: {e!s}")
-        initial_state.error = str(e)
+    with scheduling_lane(lane), profile_memory(pdf_path.name, app_config.MEMORY_PROFILING) as profiler:
+        try:
+            _ = await workflow.run(PdfToImageNode(pdf_path), state=initial_state)
+        except Exception as e:
+            logger.error(f"Workflow failed with error: {e!s}")
+            initial_state.error = str(e)
+    if profiler is not None:
+        initial_state.memory_profile = profiler.nodes
+    await record_parties(initial_state)
+    export_metrics(initial_state)
     return initial_state
 
 
-async def iter_workflow(pdf_path: Path) -> WorkflowState:
+async def iter_workflow(
+    pdf_path: Path, trace_path: Path | None = None, tenant: str = "default", lane: Lane = "interactive"
+) -> WorkflowState:
     """
     Run the workflow to process the PDF and extract invoice information.
+    When `trace_path` is given, the spans of the nodes and page tasks are written there as a Chrome trace.
+    The spend of the document is charged to the daily budget of `tenant`, its model calls
+    queue in the `lane` scheduling lane.
     """
-    initial_state = WorkflowState(pdf_name=pdf_path.name)
+    initial_state = WorkflowState(pdf_name=pdf_path.name, pdf_path=str(pdf_path), tenant=tenant)
 
     logger.info(f"Starting workflow for PDF: {pdf_path.name}")
-    try:
-        async with workflow.iter(PdfToImageNode(pdf_path), state=initial_state) as run:
-            async for node in run:
-                logger.info(f"Node: {node.__class__.__name__}")
-                if isinstance(node, End):
-                    logger.info(f"returned data: {node.data!s}")
-                logger.info("------------------------------------------")
-    except Exception as e:
-        logger.error(f"Workflow failed with error: {e!s}")
-        initial_state.error = str(e)
+    failed = False
+    with (
+        scheduling_lane(lane),
+        record_trace(pdf_path.name, trace_path),
+        profile_memory(pdf_path.name, app_config.MEMORY_PROFILING) as profiler,
+    ):
+        try:
+            async with workflow.iter(PdfToImageNode(pdf_path), state=initial_state) as run:
+                async for node in run:
+                    logger.info(f"Node: {node.__class__.__name__}")
+                    if isinstance(node, End):
+                        logger.info(f"returned data: {node.data!s}")
+                    logger.info("------------------------------------------")
+        except Exception as e:
+            logger.error(f"Workflow failed with error: {e!s}")
+            initial_state.error = str(e)
+            failed = True
+    if profiler is not None:
+        initial_state.memory_profile = profiler.nodes
+    if failed:
+        export_metrics(initial_state)
         return initial_state
     logger.info(f"Workflow completed successfully. Final invoice count: {len(initial_state.final_output)}")
+    await record_parties(initial_state)
+    export_metrics(initial_state)
     return initial_state
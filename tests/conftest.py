@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# The application config is built on import, keep it independent of a local `.config`
+os.environ.setdefault("OUTPUT_PATH", tempfile.mkdtemp(prefix="invoice-parser-tests-"))
+os.environ.setdefault("POPPLER_PATH", "")
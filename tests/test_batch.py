@@ -0,0 +1,164 @@
+import asyncio
+from pathlib import Path
+from typing import Any
+
+import pytest
+from PIL import Image
+
+from src import batch
+from src.batch import BATCH_FAILED, BatchRequest, BatchWorkflowRunner, LocalBatchProvider, OpenAIBatchProvider
+from src.config import app_config
+from src.output_format import Invoice, Item
+from src.state import WorkflowState
+
+
+def _requests(count: int) -> list[BatchRequest]:
+    return [
+        BatchRequest(
+            custom_id=f"D0-P{page}", model_name="gpt-4o-mini", system_prompt="system", user_prompt=f"page {page}"
+        )
+        for page in range(1, count + 1)
+    ]
+
+
+def _echo(custom_id: str, body: dict[str, Any]) -> str:
+    return f"{custom_id} {body['messages'][1]['content'][0]['text']}"
+
+
+def test_local_provider_answers_every_request_after_polling(tmp_path: Path) -> None:
+    provider = LocalBatchProvider(tmp_path, responder=_echo, pending_polls=2)
+    results = asyncio.run(provider.run(_requests(3), poll_interval=0))
+    assert {custom_id: result.output for custom_id, result in results.items()} == {
+        "D0-P1": "D0-P1 page 1",
+        "D0-P2": "D0-P2 page 2",
+        "D0-P3": "D0-P3 page 3",
+    }
+    assert all(result.error is None for result in results.values())
+
+
+def test_local_provider_reports_failed_requests(tmp_path: Path) -> None:
+    def responder(custom_id: str, body: dict[str, Any]) -> str:
+        if custom_id == "D0-P2":
+            raise ValueError("rate limited")
+        return _echo(custom_id, body)
+
+    results = asyncio.run(LocalBatchProvider(tmp_path, responder=responder).run(_requests(2), poll_interval=0))
+    assert results["D0-P1"].output == "D0-P1 page 1"
+    assert "rate limited" in (results["D0-P2"].error or "")
+
+
+def test_empty_backlog_submits_no_job(tmp_path: Path) -> None:
+    assert asyncio.run(LocalBatchProvider(tmp_path).run([], poll_interval=0)) == {}
+    assert list(tmp_path.iterdir()) == []
+
+
+class FailingBatchProvider(LocalBatchProvider):
+    async def status(self, job_id: str) -> str:  # noqa: ARG002
+        return BATCH_FAILED
+
+
+def test_failed_job_returns_no_results(tmp_path: Path) -> None:
+    assert asyncio.run(FailingBatchProvider(tmp_path).run(_requests(2), poll_interval=0)) == {}
+
+
+def test_openai_request_body_carries_the_image_and_output_schema(tmp_path: Path) -> None:
+    Image.new("RGB", (4, 4), "white").save(tmp_path / "page.png")
+    request = BatchRequest(
+        custom_id="D0-P1",
+        model_name="gpt-4o-mini",
+        system_prompt="system",
+        user_prompt="page",
+        image_path=tmp_path / "page.png",
+        output_schema={"type": "object"},
+    )
+    body = OpenAIBatchProvider.request_body(request)
+    assert body["messages"][0] == {"role": "system", "content": "system"}
+    assert body["messages"][1]["content"][1]["image_url"]["url"].startswith("data:image/png;base64,")
+    assert body["response_format"]["json_schema"]["schema"] == {"type": "object"}
+
+
+def test_requests_over_the_job_limits_are_split_into_several_jobs(tmp_path: Path) -> None:
+    provider = LocalBatchProvider(tmp_path / "count", responder=_echo)
+    provider.max_requests = 2
+    results = asyncio.run(provider.run(_requests(5), poll_interval=0))
+    assert len(results) == 5
+    assert len(list((tmp_path / "count").glob("batch_*.jsonl"))) == 3
+
+    provider = LocalBatchProvider(tmp_path / "size", responder=_echo)
+    provider.max_file_bytes = 1
+    results = asyncio.run(provider.run(_requests(3), poll_interval=0))
+    assert results["D0-P3"].output == "D0-P3 page 3"
+    assert len(list((tmp_path / "size").glob("batch_*.jsonl"))) == 3
+
+
+def _pdfs(tmp_path: Path, count: int) -> list[Path]:
+    pdf_paths = [tmp_path / f"invoice-{doc}.pdf" for doc in range(1, count + 1)]
+    for pdf_path in pdf_paths:
+        Image.new("RGB", (200, 200), "white").save(pdf_path)
+    return pdf_paths
+
+
+def test_documents_resume_concurrently_with_the_post_run_hooks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    resumed: list[str] = []
+    recorded: list[str | None] = []
+
+    async def run_all() -> list[WorkflowState]:
+        both_resumed = asyncio.Event()
+
+        class Graph:
+            async def run(self, _: object, state: WorkflowState) -> None:
+                resumed.append(state.pdf_name)
+                if len(resumed) == 2:
+                    both_resumed.set()
+                # Documents resumed one after the other never get here
+                await asyncio.wait_for(both_resumed.wait(), timeout=5)
+
+        async def record_parties(state: WorkflowState) -> None:
+            recorded.append(state.pdf_path)
+
+        monkeypatch.setattr(batch, "workflow", Graph())
+        monkeypatch.setattr(batch, "record_parties", record_parties)
+        config = app_config.model_copy(update={"PDF_RENDERER": "pdfium"})
+        runner = BatchWorkflowRunner(config, provider=LocalBatchProvider(tmp_path / "batch"))
+        return await runner.run(pdf_paths)
+
+    pdf_paths = _pdfs(tmp_path, 2)
+    states = asyncio.run(run_all())
+    assert [state.error for state in states] == [None, None]
+    assert sorted(resumed) == ["invoice-1.pdf", "invoice-2.pdf"]
+    assert sorted(recorded) == [str(pdf_path) for pdf_path in pdf_paths]
+
+
+def test_batch_invoices_failing_the_checks_are_formatted_live(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    invoice = Invoice(
+        invoice_number="INV-1",
+        items=[Item(slno=1, description="Widget", quantity=1, price=100, amount=100)],
+        total_amount=100,
+    )
+
+    def responder(custom_id: str, body: dict[str, Any]) -> str:
+        if "response_format" not in body:
+            return 'Invoice INV-1\n```json\n{"invoice_number": "INV-1"}\n```'
+        # The first document is answered with totals a correction call would be asked to fix
+        return invoice.model_copy(update={"total_amount": 500 if custom_id == "D0-P1" else 100}).model_dump_json()
+
+    class Graph:
+        async def run(self, _: object, state: WorkflowState) -> None:
+            pass
+
+    monkeypatch.setattr(batch, "workflow", Graph())
+    config = app_config.model_copy(
+        update={
+            "PDF_RENDERER": "pdfium",
+            "OUTPUT_FORMATOR_SCHEMA": "invoice",
+            "OUTPUT_FORMATOR_CASCADE": False,
+            "OUTPUT_FORMATOR_CORRECTIONS": True,
+            "PARTY_INDEX_PATH": None,
+        }
+    )
+    runner = BatchWorkflowRunner(config, provider=LocalBatchProvider(tmp_path / "batch", responder=responder))
+    states = asyncio.run(runner.run(_pdfs(tmp_path, 2)))
+    assert states[0].page_details[0].invoice is None
+    assert states[1].page_details[0].invoice == invoice
+    # The batch call of the page formatted live is paid all the same
+    assert [len(state.token_count) for state in states] == [2, 2]
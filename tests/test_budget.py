@@ -0,0 +1,51 @@
+from src.budget import TenantBudgetLedger, UsageTotals, estimate_document, plan_budget, token_cost
+from src.config import InvoiceParserConfig, app_config
+from src.output_format import TokenCount
+
+PAGES = [(2500, 2500)] * 3
+
+
+def _config(**update: object) -> InvoiceParserConfig:
+    return app_config.model_copy(update=update)
+
+
+def test_token_cost_prices_cached_tokens_separately() -> None:
+    prices = {"model": (1.0, 2.0, 0.5)}
+    t_count = TokenCount(
+        model_name="model", page_no="P1", request_tokens=1_000_000, response_tokens=500_000, cached_tokens=400_000
+    )
+    assert token_cost(t_count, prices) == 0.6 + 0.2 + 1.0
+    assert token_cost(t_count.model_copy(update={"model_name": "unpriced"}), prices) == 0.0
+
+
+def test_document_within_budget_runs_at_full_resolution() -> None:
+    decision = plan_budget("tenant", PAGES, _config(), TenantBudgetLedger())
+    assert decision.mode == "full"
+    assert decision.image_scale == 1.0
+
+
+def test_document_over_budget_is_downscaled() -> None:
+    config = _config()
+    budget = estimate_document(PAGES, config, 0.5).total_tokens + 1
+    decision = plan_budget("tenant", PAGES, _config(DOCUMENT_TOKEN_BUDGET=budget), TenantBudgetLedger())
+    assert budget < estimate_document(PAGES, config, 0.75).total_tokens
+    assert decision.mode == "reduced_resolution"
+    assert decision.image_scale == 0.5
+
+
+def test_document_over_budget_at_the_smallest_image_side_is_rejected() -> None:
+    decision = plan_budget("tenant", PAGES, _config(DOCUMENT_TOKEN_BUDGET=10), TenantBudgetLedger())
+    assert decision.mode == "rejected"
+    assert "document budget" in (decision.reason or "")
+
+
+def test_tenant_budget_counts_reservations_until_settled() -> None:
+    config = _config(TENANT_DAILY_TOKEN_BUDGET=1_000_000)
+    ledger = TenantBudgetLedger()
+    decision = plan_budget("acme", PAGES, config, ledger)
+    tokens, cost = ledger.remaining("acme", config)
+    assert tokens == 1_000_000 - decision.estimate.total_tokens
+    assert cost is None
+    ledger.settle("acme", decision.estimate, UsageTotals(request_tokens=1000, response_tokens=500))
+    assert ledger.remaining("acme", config) == (1_000_000 - 1500, None)
+    assert ledger.remaining("other", config) == (1_000_000, None)
@@ -0,0 +1,53 @@
+import asyncio
+
+from src.config import app_config
+from src.hedging import LatencyTracker, RequestHedger
+
+MODEL_NAME = "model"
+
+
+def _hedger(tracker: LatencyTracker) -> RequestHedger:
+    config = app_config.model_copy(
+        update={"HEDGE_REQUESTS": True, "HEDGE_MIN_SAMPLES": 5, "HEDGE_MAX_EXTRA_FRACTION": 1.0}
+    )
+    return RequestHedger(config, tracker)
+
+
+def _tracker(seconds: float, samples: int) -> LatencyTracker:
+    tracker = LatencyTracker()
+    for _ in range(samples):
+        tracker.observe(MODEL_NAME, seconds)
+    return tracker
+
+
+async def _answer(seconds: float, answer: str) -> str:
+    await asyncio.sleep(seconds)
+    return answer
+
+
+def test_fast_call_is_not_hedged() -> None:
+    hedger = _hedger(_tracker(0.05, 5))
+    result = asyncio.run(hedger.run(MODEL_NAME, lambda: _answer(0, "primary")))
+    assert result == ("primary", MODEL_NAME)
+    assert hedger.hedges == 0
+
+
+def test_slow_call_is_hedged_and_the_cancelled_primary_is_timed() -> None:
+    tracker = _tracker(0.05, 5)
+    hedger = _hedger(tracker)
+    delay = hedger.hedge_delay(MODEL_NAME)
+    assert delay is not None
+    result = asyncio.run(
+        hedger.run(
+            MODEL_NAME,
+            lambda: _answer(10, "primary"),
+            hedge_request=lambda: _answer(0, "hedge"),
+            hedge_model_name="fallback",
+        )
+    )
+    assert result == ("hedge", "fallback")
+    assert hedger.hedges == 1
+    # The cancelled primary is recorded with the time it ran, at least the hedge delay
+    histogram = tracker.histograms[MODEL_NAME]
+    assert histogram.count == 6
+    assert histogram.total - 5 * 0.05 >= delay
@@ -0,0 +1,141 @@
+import asyncio
+from collections.abc import Callable
+
+import pytest
+from pydantic_ai.messages import ModelMessage, ModelResponse, ToolCallPart
+from pydantic_ai.models import Model
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+from src.config import InvoiceParserConfig, app_config
+from src.nodes import page_formator
+from src.nodes.page_formator import SinglePageFormator
+from src.output_format import Invoice, Item
+
+UNBALANCED = Invoice(
+    invoice_number="INV-1",
+    items=[Item(slno=1, description="Widget", quantity=1, price=100, amount=100)],
+    total_amount=500,
+)
+BALANCED = UNBALANCED.model_copy(update={"total_amount": 100})
+
+Responder = Callable[[list[ModelMessage], AgentInfo], ModelResponse]
+
+
+def answer(invoice: Invoice) -> Responder:
+    def respond(_: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        return ModelResponse(parts=[ToolCallPart(info.output_tools[0].name, invoice.model_dump_json())])
+
+    return respond
+
+
+def fail(_: list[ModelMessage], __: AgentInfo) -> ModelResponse:
+    raise RuntimeError("provider unavailable")
+
+
+@pytest.fixture
+def models(monkeypatch: pytest.MonkeyPatch) -> dict[str, Responder]:
+    responders: dict[str, Responder] = {}
+
+    def model_factory(model_name: str, **_: object) -> Model:
+        def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+            return responders[model_name](messages, info)
+
+        return FunctionModel(respond)
+
+    monkeypatch.setattr(page_formator, "model_factory", model_factory)
+    return responders
+
+
+def _format(**update: object) -> tuple[list[tuple[int, Invoice, list]], str | None]:
+    config = app_config.model_copy(
+        update={
+            "OUTPUT_FORMATOR_MODEL": "small",
+            "OUTPUT_FORMATOR_ESCALATION_MODEL": "large",
+            "OUTPUT_FORMATOR_SCHEMA": "invoice",
+            "OUTPUT_FORMATOR_CASCADE": False,
+            "OUTPUT_FORMATOR_CORRECTIONS": False,
+            "PARTY_INDEX_PATH": None,
+            **update,
+        }
+    )
+    return asyncio.run(SinglePageFormator(config).run([(1, "page text", {})]))
+
+
+def test_failing_page_is_escalated(models: dict[str, Responder]) -> None:
+    models.update(small=answer(UNBALANCED), large=answer(BALANCED))
+    outputs, error = _format()
+    assert error is None
+    assert outputs[0][1].total_amount == 100
+    assert [t_count.model_name for t_count in outputs[0][2]] == ["small", "large"]
+
+
+def test_failed_escalation_keeps_the_formatter_invoice(models: dict[str, Responder]) -> None:
+    models.update(small=answer(UNBALANCED), large=fail)
+    outputs, error = _format()
+    assert error is None
+    assert outputs[0][1].total_amount == 500
+    assert [t_count.model_name for t_count in outputs[0][2]] == ["small"]
+
+
+def test_no_escalation_by_default(models: dict[str, Responder]) -> None:
+    models.update(small=answer(UNBALANCED))
+    outputs, error = _format(
+        OUTPUT_FORMATOR_ESCALATION_MODEL=InvoiceParserConfig.model_fields["OUTPUT_FORMATOR_ESCALATION_MODEL"].default
+    )
+    assert error is None
+    assert outputs[0][1].total_amount == 500
+
+
+def test_failed_correction_falls_through_to_escalation(models: dict[str, Responder]) -> None:
+    calls: list[int] = []
+
+    def small(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        calls.append(len(calls))
+        if len(calls) > 1:
+            return fail(messages, info)
+        return answer(UNBALANCED)(messages, info)
+
+    models.update(small=small, large=answer(BALANCED))
+    outputs, error = _format(OUTPUT_FORMATOR_CORRECTIONS=True)
+    assert error is None
+    assert len(calls) == 2
+    assert outputs[0][1].total_amount == 100
+    assert [t_count.model_name for t_count in outputs[0][2]] == ["small", "large"]
+
+
+def invalid(_: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+    return ModelResponse(parts=[ToolCallPart(info.output_tools[0].name, '{"items": "none"}')])
+
+
+def test_without_escalation_the_formatter_retries_validation(models: dict[str, Responder]) -> None:
+    calls: list[int] = []
+
+    def small(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        calls.append(len(calls))
+        return invalid(messages, info) if len(calls) < 4 else answer(BALANCED)(messages, info)
+
+    models.update(small=small)
+    outputs, error = _format(OUTPUT_FORMATOR_ESCALATION_MODEL=None, OUTPUT_FORMATOR_RETRIES=None)
+    assert error is None
+    assert len(calls) == 4
+    assert outputs[0][1].total_amount == 100
+
+
+def test_failed_page_keeps_the_token_expense(models: dict[str, Responder]) -> None:
+    models.update(small=invalid)
+    config = app_config.model_copy(
+        update={
+            "OUTPUT_FORMATOR_MODEL": "small",
+            "OUTPUT_FORMATOR_ESCALATION_MODEL": None,
+            "OUTPUT_FORMATOR_RETRIES": 2,
+            "OUTPUT_FORMATOR_SCHEMA": "invoice",
+            "OUTPUT_FORMATOR_CASCADE": False,
+            "PARTY_INDEX_PATH": None,
+        }
+    )
+    formatter = SinglePageFormator(config)
+    outputs, error = asyncio.run(formatter.run([(1, "page text", {})]))
+    assert outputs == []
+    assert error is not None
+    assert [t_count.model_name for t_count in formatter.error_token_counts] == ["small"]
+    assert formatter.error_token_counts[0].request_tokens
@@ -0,0 +1,51 @@
+from pathlib import Path
+
+from src.config import app_config
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice
+from src.parties import PartyIndex
+
+PUNE_GSTIN = "27ABCDE1234F1Z0"
+BENGALURU_GSTIN = "29ABCDE1234F1ZW"
+PAN = "ABCDE1234F"
+
+
+def _index(tmp_path: Path) -> PartyIndex:
+    index = PartyIndex(app_config.model_copy(update={"PARTY_INDEX_PATH": str(tmp_path / "parties.db")}))
+    pune = CompanyDetails(
+        name="Acme Supplies",
+        address="Pune MH",
+        state="Maharashtra",
+        BIN_Details=[
+            BusinessIdNumber(BIN_Type="GSTIN", BIN_Number=PUNE_GSTIN),
+            BusinessIdNumber(BIN_Type="PAN", BIN_Number=PAN),
+        ],
+    )
+    index.record([Invoice(seller_details=pune)])
+    return index
+
+
+def test_party_is_filled_on_its_gstin(tmp_path: Path) -> None:
+    filled = _index(tmp_path).fill(
+        CompanyDetails(name="Acme Supplies", BIN_Details=[BusinessIdNumber(BIN_Type="GSTIN", BIN_Number=PUNE_GSTIN)])
+    )
+    assert (filled.address, filled.state) == ("Pune MH", "Maharashtra")
+    assert [bin_details.BIN_Number for bin_details in filled.BIN_Details] == [PUNE_GSTIN, PAN]
+
+
+def test_other_registration_of_the_pan_is_not_filled(tmp_path: Path) -> None:
+    branch = CompanyDetails(
+        name="Acme Supplies",
+        BIN_Details=[
+            BusinessIdNumber(BIN_Type="GSTIN", BIN_Number=BENGALURU_GSTIN),
+            BusinessIdNumber(BIN_Type="PAN", BIN_Number=PAN),
+        ],
+    )
+    assert _index(tmp_path).fill(branch) == branch
+
+
+def test_pan_fills_without_adding_stored_gstins(tmp_path: Path) -> None:
+    filled = _index(tmp_path).fill(
+        CompanyDetails(name="Acme Supplies", BIN_Details=[BusinessIdNumber(BIN_Type="PAN", BIN_Number=PAN)])
+    )
+    assert filled.address == "Pune MH"
+    assert [bin_details.BIN_Number for bin_details in filled.BIN_Details] == [PAN]
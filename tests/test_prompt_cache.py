@@ -0,0 +1,52 @@
+import asyncio
+from typing import Any
+
+import pytest
+from botocore.stub import Stubber
+from pydantic_ai import Agent
+from pydantic_ai.providers.bedrock import BedrockProvider
+
+from src.prompt_cache import CACHE_POINT, CachedBedrockConverseModel, bedrock_supports_prompt_cache
+
+MODEL_NAME = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+
+
+@pytest.fixture
+def model() -> CachedBedrockConverseModel:
+    provider = BedrockProvider(region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")  # noqa: S106
+    return CachedBedrockConverseModel(MODEL_NAME, provider=provider)
+
+
+def _converse_response(usage: dict[str, int]) -> dict[str, Any]:
+    return {
+        "output": {"message": {"role": "assistant", "content": [{"text": "NO_INVOICE_FOUND"}]}},
+        "stopReason": "end_turn",
+        "usage": {"inputTokens": 1200, "outputTokens": 5, "totalTokens": 1205, **usage},
+        "metrics": {"latencyMs": 10},
+        "ResponseMetadata": {"RequestId": "request-1"},
+    }
+
+
+def test_prompt_cache_models() -> None:
+    assert bedrock_supports_prompt_cache(MODEL_NAME)
+    assert not bedrock_supports_prompt_cache("us.meta.llama4-maverick-17b-instruct-v1:0")
+
+
+def test_cache_points_follow_the_shared_and_the_whole_system_prompt(model: CachedBedrockConverseModel) -> None:
+    sent = {}
+    client = model.wrapped.client
+    client.meta.events.register(
+        "before-parameter-build.bedrock-runtime.Converse", lambda params, **_: sent.update(system=params["system"])
+    )
+    with Stubber(client) as stubber:
+        stubber.add_response("converse", _converse_response({}))
+        asyncio.run(Agent(model, system_prompt=["shared", "stage"]).run("page"))
+    assert sent["system"] == [{"text": "shared"}, CACHE_POINT, {"text": "stage"}, CACHE_POINT]
+
+
+def test_cache_reads_are_merged_into_the_usage_details(model: CachedBedrockConverseModel) -> None:
+    with Stubber(model.wrapped.client) as stubber:
+        stubber.add_response("converse", _converse_response({"cacheReadInputTokens": 1000, "cacheWriteInputTokens": 0}))
+        usage = asyncio.run(Agent(model, system_prompt="system").run("page")).usage()
+    assert usage.request_tokens == 1200
+    assert usage.details == {"cached_tokens": 1000, "cache_write_tokens": 0}
@@ -0,0 +1,39 @@
+import asyncio
+from pathlib import Path
+
+from pydantic_ai import Agent
+from pydantic_ai.messages import ModelMessage, ModelResponse, TextPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+from src.replay import LatencyDistribution, RecordingModel, ReplayModel, ReplayStore
+
+
+def _text_model(text: str) -> FunctionModel:
+    def respond(_: list[ModelMessage], __: AgentInfo) -> ModelResponse:
+        return ModelResponse(parts=[TextPart(text)])
+
+    return FunctionModel(respond)
+
+
+def test_same_request_to_two_models_is_recorded_and_replayed_per_model(tmp_path: Path) -> None:
+    store = ReplayStore(tmp_path)
+    agent = Agent(system_prompt="Format the page")
+
+    async def run_both(small: object, large: object) -> list[str]:
+        return [
+            (await agent.run("page text", model=small)).output,
+            (await agent.run("page text", model=large)).output,
+        ]
+
+    recorded = asyncio.run(
+        run_both(
+            RecordingModel("small", _text_model("small answer"), store),
+            RecordingModel("large", _text_model("large answer"), store),
+        )
+    )
+    assert recorded == ["small answer", "large answer"]
+    assert len(list(tmp_path.glob("*.json"))) == 2
+
+    latency = LatencyDistribution.parse("fixed:0")
+    replayed = asyncio.run(run_both(ReplayModel("small", store, latency), ReplayModel("large", store, latency)))
+    assert replayed == recorded
@@ -0,0 +1,45 @@
+import asyncio
+
+from src.scheduler import Lane, PriorityLimiter, scheduling_lane
+
+
+async def _grant_order(limiter: PriorityLimiter, calls: list[tuple[Lane, str]]) -> list[str]:
+    order = []
+
+    async def call(lane: Lane, name: str) -> None:
+        with scheduling_lane(lane):
+            async with limiter:
+                order.append(name)
+
+    await limiter.acquire()
+    tasks = [asyncio.create_task(call(lane, name)) for lane, name in calls]
+    await asyncio.sleep(0)
+    limiter.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_interactive_calls_go_before_queued_bulk_calls() -> None:
+    limiter = PriorityLimiter("test", 1, interactive_burst=10)
+    calls: list[tuple[Lane, str]] = [("bulk", "b1"), ("bulk", "b2"), ("interactive", "i1")]
+    assert asyncio.run(_grant_order(limiter, calls)) == ["i1", "b1", "b2"]
+
+
+def test_bulk_gets_a_slot_after_an_interactive_burst() -> None:
+    limiter = PriorityLimiter("test", 1, interactive_burst=2)
+    calls: list[tuple[Lane, str]] = [("bulk", "b1"), *(("interactive", f"i{index}") for index in range(1, 5))]
+    assert asyncio.run(_grant_order(limiter, calls)) == ["i1", "i2", "b1", "i3", "i4"]
+
+
+def test_cancelled_waiter_does_not_hold_a_slot() -> None:
+    async def scenario() -> int:
+        limiter = PriorityLimiter("test", 1, interactive_burst=2)
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        limiter.release()
+        return limiter.in_use
+
+    assert asyncio.run(scenario()) == 0
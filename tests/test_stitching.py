@@ -0,0 +1,107 @@
+from src.nodes.image_to_text import stitch_row_bands
+from src.nodes.page_groupper import stitch_windows
+from src.output_format import Invoice, Item, MergeStrategy
+from src.structured_text import parse_structured_text, render_structured_text
+
+WINDOWS = [["P1", "P2", "P3", "P4"], ["P3", "P4", "P5", "P6"]]
+
+
+def test_windows_keep_their_own_pages_and_join_a_continued_invoice() -> None:
+    metadata = {f"P{page}": {"invoice_number": number} for page, number in zip(range(1, 7), "AABBBC", strict=True)}
+    window_groups = [
+        {"invoice_1": {"pages": ["P1", "P2"]}, "invoice_2": {"pages": ["P3", "P4"]}},
+        {"invoice_1": {"pages": ["P3", "P4", "P5"]}, "invoice_2": {"pages": ["P6"]}},
+    ]
+    assert stitch_windows(WINDOWS, window_groups, metadata) == {
+        "invoice_1": {"pages": ["P1", "P2"]},
+        "invoice_2": {"pages": ["P3", "P4", "P5"]},
+        "invoice_2_2": {"pages": ["P6"]},
+    }
+
+
+def test_window_groups_join_on_line_item_continuity() -> None:
+    metadata = {
+        "P3": {"invoice_number": "B", "line_item_end_number": "10"},
+        "P4": {"invoice_number": "NOT_AVAILABLE", "line_item_start_number": "11"},
+    }
+    window_groups = [
+        {"invoice_1": {"pages": ["P1", "P2", "P3"]}},
+        {"invoice_1": {"pages": ["P4", "P5", "P6"]}},
+    ]
+    assert stitch_windows(WINDOWS, window_groups, metadata) == {
+        "invoice_1": {"pages": ["P1", "P2", "P3", "P4", "P5", "P6"]}
+    }
+
+
+def test_fields_no_window_hinted_keep_the_hints_incomplete() -> None:
+    metadata = {
+        "P3": {"invoice_number": "B", "line_item_end_number": "10"},
+        "P4": {"invoice_number": "NOT_AVAILABLE", "line_item_start_number": "11"},
+    }
+    first_window = {
+        "invoice_number": "P1",
+        "invoice_date": "P1",
+        "line_item_details": ["P1", "P2", "P3"],
+        "total_invoice_amount": "NOT_AVAILABLE",
+    }
+    window_groups = [
+        {"invoice_1": {"pages": ["P1", "P2", "P3"], "details": first_window}},
+        {"invoice_1": {"pages": ["P4", "P5", "P6"]}},
+    ]
+    details = stitch_windows(WINDOWS, window_groups, metadata)["invoice_1"]["details"]
+    assert details == {"invoice_number": "P1", "invoice_date": "P1", "line_item_details": ["P1", "P2", "P3"]}
+    assert MergeStrategy(details=details).required_pages() is None
+
+
+def _rows(*items: Item) -> str:
+    text = render_structured_text(Invoice(items=list(items)))
+    return text[text.index("6. Item Details:\n") + len("6. Item Details:\n") : text.index("\n7. Total Tax")]
+
+
+def test_row_bands_are_stitched_by_serial_number() -> None:
+    header = render_structured_text(Invoice(invoice_number="INV-1", total_amount=60))
+    cut_row = Item(slno=2, description="Bolt")
+    full_row = Item(slno=2, description="Bolt", quantity=2, price=10, amount=20)
+    bands = [
+        _rows(Item(slno=1, description="Nut", quantity=4, price=5, amount=20), cut_row),
+        _rows(full_row, Item(slno=3, description="Washer", quantity=10, price=2, amount=20)),
+    ]
+    stitched = stitch_row_bands(header, {"line_items_present": False}, bands, 1)
+    assert stitched is not None
+    text_content, metadata = stitched
+    invoice = parse_structured_text(text_content).invoice
+    assert invoice is not None
+    assert [item.slno for item in invoice.items] == [1, 2, 3]
+    assert invoice.items[1] == full_row
+    assert metadata == {"line_items_present": True, "line_item_start_number": "1", "line_item_end_number": "3"}
+
+
+def test_row_bands_which_do_not_parse_are_rejected() -> None:
+    header = render_structured_text(Invoice(invoice_number="INV-1"))
+    assert stitch_row_bands(header, {}, ["not the item layout"], 1) is None
+
+
+def _unnumbered_rows(*items: Item) -> str:
+    return "\n".join(
+        "        Serial no: NOT_AVAILABLE" if line.strip().startswith("Serial no:") else line
+        for line in _rows(*items).splitlines()
+    )
+
+
+def test_row_bands_without_serial_numbers_keep_every_row() -> None:
+    header = render_structured_text(Invoice(invoice_number="INV-1", total_amount=60))
+    nut = Item(slno=1, description="Nut", quantity=4, price=5, amount=20)
+    cut_bolt = Item(slno=1, description="Bolt")
+    bolt = Item(slno=1, description="Bolt", quantity=2, price=10, amount=20)
+    washer = Item(slno=1, description="Washer", quantity=10, price=2, amount=20)
+    bands = [_unnumbered_rows(nut, cut_bolt), _unnumbered_rows(bolt, washer), _unnumbered_rows(nut)]
+    stitched = stitch_row_bands(header, {"line_items_present": False}, bands, 1)
+    assert stitched is not None
+    invoice = parse_structured_text(stitched[0]).invoice
+    assert invoice is not None
+    assert [(item.slno, item.description, item.amount) for item in invoice.items] == [
+        (1, "Nut", 20),
+        (2, "Bolt", 20),
+        (3, "Washer", 20),
+        (4, "Nut", 20),
+    ]
@@ -0,0 +1,91 @@
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice, Item, TaxComponents
+from src.structured_text import parse_item_rows, parse_number, parse_structured_text, render_structured_text
+
+
+def _invoice() -> Invoice:
+    return Invoice(
+        invoice_number="INV-1",
+        invoice_date="01/04/2025",
+        seller_details=CompanyDetails(
+            name="Acme Traders",
+            BIN_Details=[BusinessIdNumber(BIN_Type="GSTIN", BIN_Number="27AAPFU0939F1ZV")],
+            address="12 MG Road, Pune",
+            state="Maharashtra",
+            country="India",
+            pin_code="411001",
+        ),
+        buyer_details=CompanyDetails(name="Globex Corporation", address="4 Park Street, Kolkata"),
+        items=[
+            Item(
+                slno=1,
+                description="Widget",
+                quantity=2,
+                UOM="NOS",
+                price=50,
+                tax=[TaxComponents(Tax_Type="IGST", Tax_Rate=18, Tax_Amount=18)],
+                amount=100,
+            ),
+            Item(slno=2, description="Bolt", quantity=10, price=5, amount=50),
+        ],
+        total_tax=[TaxComponents(Tax_Type="IGST", Tax_Rate=18, Tax_Amount=27)],
+        total_amount=177,
+        amount_due=177,
+        page_no="1",
+    )
+
+
+def test_parse_number() -> None:
+    assert parse_number("₹ 1,18,000.00 (after rounding)") == 118000.0
+    assert parse_number("-12.5") == -12.5
+    assert parse_number("NOT_AVAILABLE") is None
+    assert parse_number("") is None
+
+
+def test_rendered_text_parses_back_into_the_same_invoice() -> None:
+    invoice = _invoice()
+    parsed = parse_structured_text(render_structured_text(invoice), page_no="1")
+    assert parsed.invoice == invoice
+    assert parsed.confidence == 1.0
+    assert parsed.issues == []
+
+
+def test_unknown_entries_lower_the_confidence() -> None:
+    text = render_structured_text(_invoice()) + "\nShipping Terms: FOB\nVehicle Number: MH12AB1234"
+    parsed = parse_structured_text(text)
+    assert parsed.invoice is not None
+    assert parsed.confidence < 1.0
+    assert any("unknown entries" in issue for issue in parsed.issues)
+
+
+def test_pages_without_an_invoice() -> None:
+    assert parse_structured_text("NO_INVOICE_FOUND").invoice is None
+    assert parse_structured_text("Some free text\nwith no layout").invoice is None
+
+
+def test_parse_item_rows() -> None:
+    text = render_structured_text(_invoice())
+    rows = text[text.index("6. Item Details:\n") + len("6. Item Details:\n") : text.index("\n7. Total Tax")]
+    assert parse_item_rows(rows) == _invoice().items
+    assert parse_item_rows("NO_LINE_ITEMS") == []
+    assert parse_item_rows("nothing to read") is None
+
+
+def test_wrapped_free_text_continues_the_previous_entry() -> None:
+    text = render_structured_text(_invoice()).replace("Address: 12 MG Road, Pune", "Address: 12 MG Road,\n        Pune")
+    parsed = parse_structured_text(f"Page No 1\n\n{text}", page_no="1")
+    assert parsed.invoice == _invoice()
+    assert parsed.confidence == 1.0
+
+
+def test_lines_outside_the_layout_lower_the_confidence() -> None:
+    lines = render_structured_text(_invoice()).splitlines()
+    # A wrapped row the parser cannot place, its values would be lost
+    stray = [*lines[:20], "2 NOS 50.00 100.00", "IGST 18% 18.00", *lines[20:]]
+    parsed = parse_structured_text("\n".join(stray))
+    assert parsed.confidence < 1.0
+    assert "2 lines outside the layout" in parsed.issues
+    garbled = parse_structured_text(
+        "\n".join(line.replace(":", "") if index % 4 == 3 else line for index, line in enumerate(lines))
+    )
+    assert garbled.invoice is not None
+    assert garbled.confidence < 0.9
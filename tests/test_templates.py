@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+import pypdfium2 as pdfium
+
+from src.output_format import CompanyDetails, Invoice
+from src.templates import VendorTemplate, learn_sample, text_layer_document, text_layer_lines
+from src.utility import pdfium_lock
+
+SELLER = CompanyDetails(name="Acme Supplies")
+
+
+def _template(samples: list[tuple[Invoice, list[str]]]) -> VendorTemplate:
+    return VendorTemplate(
+        seller_gstin="29ABCDE1234F1Z5",
+        fingerprint="0" * 16,
+        seller_details=SELLER,
+        samples=[learn_sample(invoice, lines) for invoice, lines in samples],
+    )
+
+
+def _page(number: int, buyer: str, total: float, charge: str | None = None) -> list[str]:
+    return [
+        "Tax Invoice",
+        f"Invoice No: INV-{number}",
+        *[line for line in (buyer, charge) if line],
+        f"Total: {total:.2f}",
+    ]
+
+
+def test_buyer_is_never_filled_from_a_constant() -> None:
+    buyer = CompanyDetails(name="Globex Corporation")
+    template = _template(
+        [
+            (
+                Invoice(invoice_number=f"INV-{number}", buyer_details=buyer, total_amount=100.0 * number),
+                _page(number, "Globex Corporation", 100.0 * number),
+            )
+            for number in (1, 2)
+        ]
+    )
+    assert template.prefill(_page(9, "Initech Ltd", 250.0), min_samples=2) is None
+
+
+def test_constant_is_read_only_from_pages_printing_it() -> None:
+    template = _template(
+        [
+            (
+                Invoice(invoice_number=f"INV-{number}", total_charge=50.0, total_amount=100.0 * number),
+                _page(number, "", 100.0 * number, charge="50.00"),
+            )
+            for number in (1, 2)
+        ]
+    )
+    printed = template.prefill(_page(9, "", 250.0, charge="50.00"), min_samples=2)
+    assert printed is not None
+    assert printed.total_charge == 50.0
+    unprinted = template.prefill(_page(9, "", 250.0), min_samples=2)
+    assert unprinted is not None
+    assert unprinted.invoice_number == "INV-9"
+    assert unprinted.total_charge == 0.0
+
+
+def test_text_layer_reads_wait_for_the_pdfium_lock(tmp_path: Path) -> None:
+    pdf_path = tmp_path / "blank.pdf"
+    pdf = pdfium.PdfDocument.new()
+    pdf.new_page(595, 842).close()
+    pdf.save(pdf_path)
+    pdf.close()
+
+    def read() -> list[str]:
+        with text_layer_document(pdf_path) as document:
+            return text_layer_lines(document, 1)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with pdfium_lock:
+            reading = executor.submit(read)
+            done, _ = wait([reading], timeout=0.2)
+            assert not done
+        assert reading.result(timeout=5) == []
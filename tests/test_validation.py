@@ -0,0 +1,83 @@
+from src.output_format import BusinessIdNumber, CompanyDetails, Invoice, Item, TaxComponents
+from src.validation import apply_corrections, check_extraction, check_invoice, gstin_check_character, is_valid_gstin
+
+GSTIN = "27AAPFU0939F1ZV"
+
+
+def _invoice(**update: object) -> Invoice:
+    invoice = Invoice(
+        invoice_number="INV-1",
+        seller_details=CompanyDetails(name="Acme", BIN_Details=[BusinessIdNumber(BIN_Type="GSTIN", BIN_Number=GSTIN)]),
+        items=[
+            Item(
+                slno=1,
+                description="Widget",
+                quantity=2,
+                price=50,
+                tax=[TaxComponents(Tax_Type="IGST", Tax_Rate=18, Tax_Amount=18)],
+                amount=100,
+            ),
+        ],
+        total_tax=[TaxComponents(Tax_Type="IGST", Tax_Rate=18, Tax_Amount=18)],
+        total_amount=118,
+    )
+    return invoice.model_copy(update=update)
+
+
+def test_gstin_checksum() -> None:
+    assert is_valid_gstin(GSTIN)
+    assert is_valid_gstin(GSTIN.lower())
+    assert gstin_check_character(GSTIN[:14]) == GSTIN[14]
+    assert not is_valid_gstin(GSTIN[:14] + "A")
+    assert not is_valid_gstin("27AAPFU0939F1Z")
+
+
+def test_consistent_invoice_passes() -> None:
+    assert check_invoice(_invoice()) == {}
+
+
+def test_failures_are_keyed_by_field_path() -> None:
+    invoice = _invoice()
+    invoice.items[0].amount = 150
+    invoice.seller_details.BIN_Details[0].BIN_Number = GSTIN[:14] + "A"
+    invoice.total_tax[0].Tax_Amount = 30
+    assert set(check_invoice(invoice)) == {
+        "items[0].amount",
+        "seller_details.BIN_Details[0].BIN_Number",
+        "total_tax",
+        "total_amount",
+    }
+
+
+def test_partial_invoice_skips_the_totals() -> None:
+    assert check_invoice(_invoice(total_amount=500), complete=False) == {}
+    assert "total_amount" in check_invoice(_invoice(total_amount=500))
+
+
+def test_rounding_off_is_tolerated() -> None:
+    assert check_invoice(_invoice(total_amount=118.6)) == {}
+
+
+def test_apply_corrections_converts_values_and_skips_unknown_paths() -> None:
+    corrected, applied = apply_corrections(
+        _invoice(),
+        [("items[0].amount", "₹ 1,00.00"), ("total_amount", "not a number"), ("items[3].amount", "1"), ("x", "y")],
+    )
+    assert applied == ["items[0].amount"]
+    assert corrected.items[0].amount == 100.0
+    assert corrected.total_amount == 118
+
+
+def test_check_extraction() -> None:
+    assert check_extraction("NO_INVOICE_FOUND", {}, 0.5) == []
+    assert check_extraction("1. Invoice Number: INV-1", {}, 0.5) == ["page metadata is missing"]
+    assert check_extraction("1. Invoice Number: INV-1", {"invoice_number": "NOT_AVAILABLE"}, 0.5) == [
+        "invoice_number is missing"
+    ]
+
+
+def test_copied_invoices_rank_on_their_current_fields() -> None:
+    invoice = _invoice()
+    assert invoice > Invoice()
+    stripped = invoice.model_copy(update={"items": []})
+    assert invoice > stripped
@@ -0,0 +1,83 @@
+import asyncio
+import importlib
+
+import pytest
+from pydantic_graph import GraphRunContext
+
+from src.config import app_config
+from src.output_format import TokenCount
+from src.state import PageDetails, WorkflowState
+
+# `src.workflow` is the graph exported by the package, the module is imported by name
+workflow = importlib.import_module("src.workflow")
+
+
+class Grouper:
+    def __init__(self, _: object) -> None:
+        pass
+
+    async def run(self, **_: object) -> tuple[dict, TokenCount, None]:
+        groups = {"invoice_1": {"pages": ["P1"]}, "invoice_2": {"pages": ["P2"]}}
+        return groups, TokenCount(model_name="grouper", page_no="1-2"), None
+
+
+def test_speculative_pages_are_checked_like_grouped_pages(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: list[tuple[list[int], bool]] = []
+
+    async def format_pages(_: WorkflowState, pages: list[int], reconcile_totals: bool) -> tuple[list, None]:
+        calls.append((pages, reconcile_totals))
+        return [], None
+
+    monkeypatch.setattr(workflow, "format_pages", format_pages)
+    monkeypatch.setattr(workflow, "PageGroupper", Grouper)
+    monkeypatch.setattr(app_config, "SPECULATIVE_FORMATTING", True)
+    monkeypatch.setattr(app_config, "MERGER_STRATEGY", "smart")
+    state = WorkflowState(
+        pdf_name="statement.pdf",
+        page_details=[
+            PageDetails(
+                page_index=page_no,
+                image_path=f"{page_no}.png",
+                text_content="text",
+                metadata={"invoice_number": f"A{page_no}"},
+            )
+            for page_no in (1, 2)
+        ],
+    )
+    ctx = GraphRunContext(state=state, deps=None)
+
+    formatter_node = asyncio.run(workflow.PageGrouperNode().run(ctx))
+    asyncio.run(formatter_node.run(ctx))
+
+    assert calls == [([1, 2], False), ([1, 2], False)]
+
+
+def test_failed_grouping_keeps_the_finished_speculation_expense(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def format_pages(_: WorkflowState, pages: list[int], reconcile_totals: bool) -> tuple[list, None]:  # noqa: ARG001
+        return [(page_no, None, [TokenCount(model_name="formatter", page_no=f"P{page_no}")]) for page_no in pages], None
+
+    class FailingGrouper(Grouper):
+        async def run(self, **_: object) -> tuple[dict, TokenCount, str]:
+            await asyncio.sleep(0)
+            return {}, TokenCount(model_name="grouper", page_no="1-2"), "grouping failed"
+
+    monkeypatch.setattr(workflow, "format_pages", format_pages)
+    monkeypatch.setattr(workflow, "PageGroupper", FailingGrouper)
+    monkeypatch.setattr(app_config, "SPECULATIVE_FORMATTING", True)
+    state = WorkflowState(
+        pdf_name="statement.pdf",
+        page_details=[
+            PageDetails(
+                page_index=page_no,
+                image_path=f"{page_no}.png",
+                text_content="text",
+                metadata={"invoice_number": f"A{page_no}"},
+            )
+            for page_no in (1, 2)
+        ],
+    )
+
+    asyncio.run(workflow.PageGrouperNode().run(GraphRunContext(state=state, deps=None)))
+
+    assert state.error == "PageGrouperNode| grouping failed"
+    assert [t_count.page_no for t_count in state.token_count] == ["P1", "P2"]